@@ -12,7 +12,6 @@
 
 import os
 import secrets
-import httpx
 from typing import Any, Dict, List, Optional
 
 from fastapi import APIRouter, Depends, HTTPException, Request, status, Form, Query
@@ -22,6 +21,7 @@ from fastapi.templating import Jinja2Templates
 from sqlalchemy import text
 
 from app.security_admin import verify_admin  # protezione admin
+from app.services import http as http_clients
 
 # --- DB engine
 try:
@@ -231,12 +231,12 @@ async def ui_refresh_token(
     }
 
     try:
-        async with httpx.AsyncClient(base_url=os.getenv("BASE_URL", ""), timeout=10.0) as client:
-            resp = await client.post(
-                "/save-token",
-                json=payload,
-                headers={"x-api-key": api_key},
-            )
+        resp = await http_clients.client("self").post(
+            f"{os.getenv('BASE_URL', '').rstrip('/')}/save-token",
+            json=payload,
+            headers={"x-api-key": api_key},
+            timeout=10.0,
+        )
         if resp.status_code >= 400:
             return RedirectResponse(url=f"/ui2?err=token_refresh_failed_{resp.status_code}", status_code=303)
     except Exception:
@@ -18,6 +18,8 @@ from sqlalchemy import text
 from app.db import engine  # async engine
 from app.services.client_prompts import list_prompts_for_client, upsert_prompt_for_client
 from app.routers import meta_webhook  # >>> ADD
+from app.services import http as http_clients
+from app.services import metrics, tenant_registry
 
 
 # === CREA APP
@@ -405,8 +407,141 @@ CREATE TABLE IF NOT EXISTS mfai_app.client_prompts (
   updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
   UNIQUE (client_id, key)
 );
+
+-- Coda persistente eventi webhook (claim con FOR UPDATE SKIP LOCKED)
+CREATE TABLE IF NOT EXISTS mfai_app.inbound_events (
+  id BIGSERIAL PRIMARY KEY,
+  ig_user_id TEXT NOT NULL,
+  thread_key TEXT NOT NULL,
+  payload TEXT NOT NULL,
+  status TEXT NOT NULL DEFAULT 'pending' CHECK (status IN ('pending','processing','done','dead')),
+  attempts INT NOT NULL DEFAULT 0,
+  available_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  locked_until TIMESTAMPTZ,
+  locked_by TEXT,
+  last_error TEXT,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_inbound_events_open
+  ON mfai_app.inbound_events(id)
+  WHERE status IN ('pending','processing');
+
+CREATE INDEX IF NOT EXISTS idx_inbound_events_thread_open
+  ON mfai_app.inbound_events(thread_key, id)
+  WHERE status IN ('pending','processing');
+
+-- Deduplica ri-consegne Meta (message.mid / timestamp entry)
+ALTER TABLE mfai_app.inbound_events ADD COLUMN IF NOT EXISTS dedup_key TEXT;
+
+CREATE UNIQUE INDEX IF NOT EXISTS uniq_inbound_events_dedup
+  ON mfai_app.inbound_events(dedup_key);
+
+-- Rilettura history dai log: mittente e testo estratti + indice coprente
+-- (range scan su (account, utente) senza leggere il JSON del payload)
+ALTER TABLE mfai_app.message_logs ADD COLUMN IF NOT EXISTS peer_id TEXT;
+ALTER TABLE mfai_app.message_logs ADD COLUMN IF NOT EXISTS body TEXT;
+
+CREATE INDEX IF NOT EXISTS idx_message_logs_thread
+  ON mfai_app.message_logs(ig_account_id, peer_id, id DESC)
+  INCLUDE (direction, body, created_at)
+  WHERE peer_id IS NOT NULL;
+
+-- Stato conversazione condiviso tra worker/istanze (STATE_BACKEND=postgres)
+CREATE TABLE IF NOT EXISTS mfai_app.conv_turns (
+  id BIGSERIAL PRIMARY KEY,
+  ig_user_id TEXT NOT NULL,
+  user_id TEXT NOT NULL,
+  role TEXT NOT NULL,
+  content TEXT NOT NULL,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_conv_turns_thread
+  ON mfai_app.conv_turns(ig_user_id, user_id, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_conv_turns_created
+  ON mfai_app.conv_turns(created_at);
+
+-- Riassunto dei turni più vecchi di un thread (services/summarizer)
+CREATE TABLE IF NOT EXISTS mfai_app.conv_summaries (
+  ig_user_id TEXT NOT NULL,
+  user_id TEXT NOT NULL,
+  summary TEXT NOT NULL,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY (ig_user_id, user_id)
+);
+
+CREATE TABLE IF NOT EXISTS mfai_app.conv_handover (
+  ig_user_id TEXT NOT NULL,
+  user_id TEXT NOT NULL,
+  human_until TIMESTAMPTZ NOT NULL,
+  PRIMARY KEY (ig_user_id, user_id)
+);
+
+-- Knowledge base per cliente (services/knowledge: indice BM25 locale)
+CREATE TABLE IF NOT EXISTS mfai_app.kb_documents (
+  id BIGSERIAL PRIMARY KEY,
+  client_id BIGINT NOT NULL REFERENCES mfai_app.clients(id) ON DELETE CASCADE,
+  title TEXT NOT NULL DEFAULT '',
+  content TEXT NOT NULL,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_kb_documents_client
+  ON mfai_app.kb_documents(client_id, id);
+
+-- Risposte fisse per parola chiave, senza LLM (services/triggers)
+CREATE TABLE IF NOT EXISTS mfai_app.client_triggers (
+  id BIGSERIAL PRIMARY KEY,
+  client_id BIGINT NOT NULL REFERENCES mfai_app.clients(id) ON DELETE CASCADE,
+  trigger TEXT NOT NULL,
+  response TEXT NOT NULL,
+  match_mode TEXT NOT NULL DEFAULT 'keyword' CHECK (match_mode IN ('exact','keyword')),
+  active BOOLEAN NOT NULL DEFAULT true,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_client_triggers_client
+  ON mfai_app.client_triggers(client_id, id);
 """
 
+# Trigger NOTIFY per il registry tenant in memoria (services/tenant_registry):
+# ogni modifica ad account/token/prompt invalida subito le voci su tutte le istanze.
+# Eseguiti uno alla volta (contengono ';' dentro $$ ... $$).
+TENANT_NOTIFY_SQL = [
+    """
+    CREATE OR REPLACE FUNCTION mfai_app.notify_tenant_change() RETURNS trigger AS $$
+    DECLARE
+        r RECORD;
+    BEGIN
+        IF TG_OP = 'DELETE' THEN r := OLD; ELSE r := NEW; END IF;
+        IF TG_TABLE_NAME = 'instagram_accounts' THEN
+            PERFORM pg_notify('mfai_tenant', 'ig:' || r.ig_user_id);
+            IF TG_OP = 'UPDATE' AND OLD.ig_user_id IS DISTINCT FROM NEW.ig_user_id THEN
+                PERFORM pg_notify('mfai_tenant', 'ig:' || OLD.ig_user_id);
+            END IF;
+        ELSIF TG_TABLE_NAME = 'tokens' THEN
+            PERFORM pg_notify('mfai_tenant', 'acct:' || r.ig_account_id);
+        ELSIF TG_TABLE_NAME = 'client_prompts' THEN
+            PERFORM pg_notify('mfai_tenant', 'client:' || r.client_id);
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql;
+    """,
+    "DROP TRIGGER IF EXISTS trg_tenant_notify ON mfai_app.instagram_accounts",
+    """CREATE TRIGGER trg_tenant_notify AFTER INSERT OR UPDATE OR DELETE
+       ON mfai_app.instagram_accounts FOR EACH ROW EXECUTE FUNCTION mfai_app.notify_tenant_change()""",
+    "DROP TRIGGER IF EXISTS trg_tenant_notify ON mfai_app.tokens",
+    """CREATE TRIGGER trg_tenant_notify AFTER INSERT OR UPDATE OR DELETE
+       ON mfai_app.tokens FOR EACH ROW EXECUTE FUNCTION mfai_app.notify_tenant_change()""",
+    "DROP TRIGGER IF EXISTS trg_tenant_notify ON mfai_app.client_prompts",
+    """CREATE TRIGGER trg_tenant_notify AFTER INSERT OR UPDATE OR DELETE
+       ON mfai_app.client_prompts FOR EACH ROW EXECUTE FUNCTION mfai_app.notify_tenant_change()""",
+]
+
 def _split_sql(sql: str):
     for part in sql.split(";"):
         stmt = part.strip()
@@ -442,6 +577,17 @@ async def ensure_schema():
         except Exception as e:
             logger.warning(f"bot_enabled check skipped: {e}")
 
+        # --- Trigger NOTIFY per il registry tenant ---
+        # savepoint: se fallisce (es. permessi) si annulla solo questo blocco,
+        # non l'intera transazione dello schema
+        try:
+            async with conn.begin_nested():
+                for stmt in TENANT_NOTIFY_SQL:
+                    await conn.exec_driver_sql(stmt)
+            logger.info("Tenant notify triggers ensured.")
+        except Exception as e:
+            logger.warning(f"tenant notify triggers skipped: {e}")
+
         # --- FIX DEADLOCK: seed demo eseguito una sola volta, senza blocchi ---
         if os.getenv("PUBLIC_SEED_DEMO", "1") == "1":
             try:
@@ -1014,6 +1160,7 @@ async def admin_accounts_patch(body: PatchAccountPayload):
         row = res.first()
         if not row:
             raise HTTPException(status_code=404, detail="Instagram account non trovato")
+    tenant_registry.invalidate(ig_user_id=ig)
     return {"status": "ok", "ig_user_id": ig, "bot_enabled": body.bot_enabled}
 
 # 3) Logs (GET)
@@ -1117,6 +1264,7 @@ async def ui2_put_prompts(client_id: int, body: ClientPromptSystem):
           VALUES (:cid, 'system', :v)
           ON CONFLICT (client_id, key) DO UPDATE SET value = EXCLUDED.value, updated_at = now()
         """), {"cid": client_id, "v": body.system})
+    tenant_registry.invalidate(client_id=client_id)
     return {"status": "ok"}
 
 # -----------------------------------------------------------
@@ -1182,6 +1330,7 @@ async def save_token(data: SaveTokenPayload):
               VALUES (:id, 'in', :p)
             """), {"id": ig_account_id, "p": f"Saved token (len={len(data.token)})"})
 
+        tenant_registry.invalidate(ig_user_id=data.ig_user_id)
         return {"status":"ok","client_id":client_id,"ig_account_id":ig_account_id,"expires_at":exp.isoformat()}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"{e.__class__.__name__}: {e}")
@@ -1219,6 +1368,7 @@ async def refresh_token(data: RefreshTokenPayload):
           INSERT INTO mfai_app.tokens (ig_account_id, access_token, expires_at, long_lived, active)
           VALUES (:ig, :token, :exp, TRUE, TRUE)
         """), {"ig": ig_account_id, "token": data.token, "exp": exp})
+    tenant_registry.invalidate(ig_user_id=data.ig_user_id)
     return {"status": "ok", "ig_user_id": data.ig_user_id, "expires_at": exp.isoformat()}
 
 # -----------------------------------------------------------
@@ -1264,10 +1414,22 @@ def __debug():
 def __routes():
     return {"routes":[getattr(r, "path", None) for r in app.routes]}
 
+@app.get("/__metrics")
+def __metrics():
+    return metrics.snapshot()
+
+@app.on_event("startup")
+async def _start_webhook_workers():
+    # registry tenant (snapshot + LISTEN) e worker che processano gli eventi del webhook Meta
+    tenant_registry.start()
+    meta_webhook.start_workers()
+
 @app.on_event("shutdown")  # >>> ADD
 async def _shutdown_pool():
-    # chiude il client httpx riusato dal webhook Meta
-    await meta_webhook._close_httpx()
+    # prima svuota la coda eventi, poi chiude i client HTTP condivisi (services/http)
+    await meta_webhook.stop_workers()
+    await tenant_registry.stop()
+    await http_clients.close_all()
   
   
   
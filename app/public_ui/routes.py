@@ -10,6 +10,7 @@ from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel, Field
 
 from app.db import engine  # usa lo stesso engine async
+from app.services import http as http_clients
 
 router = APIRouter(prefix="/c", tags=["Public UI"])
 templates = Jinja2Templates(directory="app/public_ui/templates")
@@ -69,8 +70,9 @@ async def chat(slug: str, body: ChatIn):
     }
 
     try:
-        async with httpx.AsyncClient(timeout=25.0) as client:
-            r = await client.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
+        r = await http_clients.client("openai").post(
+            "https://api.openai.com/v1/chat/completions", headers=headers, json=payload, timeout=25.0
+        )
         if r.status_code == 401:
             return JSONResponse({"reply": "⚠️ Chiave OpenAI rifiutata (401). Controlla OPENAI_API_KEY."})
         r.raise_for_status()
@@ -7,6 +7,7 @@ from sqlalchemy import text
 
 from app.security_admin import verify_admin
 from app.db_session import get_session
+from app.services import knowledge, tenant_registry, triggers
 
 router = APIRouter(prefix="/admin", tags=["admin"])
 
@@ -75,6 +76,7 @@ async def delete_client_by_path(
 ):
     async with db.begin():
         await _delete_client_tx(db, client_id)
+    tenant_registry.invalidate(client_id=client_id)
     return {"status": "deleted", "id": client_id}
 
 @router.delete("/clients")
@@ -92,6 +94,7 @@ async def delete_client_by_body(
 
     async with db.begin():
         await _delete_client_tx(db, client_id)
+    tenant_registry.invalidate(client_id=client_id)
     return {"status": "deleted", "id": client_id}
 
 # --------------- Accounts ---------------
@@ -148,8 +151,10 @@ async def create_account(
         "ig_user_id": ig_user_id,
         "username": username,
     })
+    row = dict(res.mappings().one())
     await db.commit()
-    return dict(res.mappings().one())
+    tenant_registry.invalidate(ig_user_id=ig_user_id)  # toglie l'eventuale voce negativa
+    return row
 
 @router.patch("/accounts/{ig_user_id}")
 async def update_account_mapping(
@@ -182,6 +187,7 @@ async def update_account_mapping(
         raise HTTPException(status_code=404, detail="Account IG non trovato")
 
     await db.commit()
+    tenant_registry.invalidate(ig_user_id=ig_user_id)
     return dict(row)
 
 # ---------------- Tokens ----------------
@@ -242,8 +248,181 @@ async def save_token(
             VALUES (:aid, :tok, true, :ll, :exp)
             RETURNING id, ig_account_id, active, long_lived, expires_at, created_at
         """), {"aid": ig_account_id, "tok": access_token, "ll": long_lived, "exp": expires_at})
+    tenant_registry.invalidate(ig_user_id=ig_user_id)
     return dict(res.mappings().one())
 
+# ---------------- Knowledge base ----------------
+@router.get("/clients/{client_id}/kb")
+async def list_kb_documents(
+    client_id: int = Path(..., ge=1),
+    _: dict = Depends(verify_admin),
+    db: AsyncSession = Depends(get_session),
+):
+    q = text("""
+        SELECT id, client_id, title, length(content) AS chars, created_at, updated_at
+        FROM mfai_app.kb_documents
+        WHERE client_id = :c
+        ORDER BY id
+    """)
+    rows = await db.execute(q, {"c": client_id})
+    return [dict(r) for r in rows.mappings().all()]
+
+@router.post("/clients/{client_id}/kb")
+async def create_kb_document(
+    client_id: int = Path(..., ge=1),
+    payload: dict = Body(...),
+    _: dict = Depends(verify_admin),
+    db: AsyncSession = Depends(get_session),
+):
+    # payload atteso: {"title": "Orari", "content": "Siamo aperti..."}
+    title = (payload.get("title") or "").strip()
+    content = (payload.get("content") or "").strip()
+    if not content:
+        raise HTTPException(status_code=400, detail="content è obbligatorio")
+
+    exists_q = text("SELECT 1 FROM mfai_app.clients WHERE id = :c")
+    if not (await db.execute(exists_q, {"c": client_id})).first():
+        raise HTTPException(status_code=404, detail="Client non trovato")
+
+    q = text("""
+        INSERT INTO mfai_app.kb_documents (client_id, title, content)
+        VALUES (:c, :t, :body)
+        RETURNING id, client_id, title, created_at, updated_at
+    """)
+    res = await db.execute(q, {"c": client_id, "t": title, "body": content})
+    row = dict(res.mappings().one())
+    await db.commit()
+    knowledge.invalidate(client_id)
+    return row
+
+@router.delete("/kb/{doc_id}")
+async def delete_kb_document(
+    doc_id: int = Path(..., ge=1),
+    _: dict = Depends(verify_admin),
+    db: AsyncSession = Depends(get_session),
+):
+    q = text("DELETE FROM mfai_app.kb_documents WHERE id = :id RETURNING client_id")
+    row = (await db.execute(q, {"id": doc_id})).first()
+    if not row:
+        raise HTTPException(status_code=404, detail="Documento non trovato")
+    await db.commit()
+    knowledge.invalidate(row[0])
+    return {"status": "deleted", "id": doc_id}
+
+@router.get("/clients/{client_id}/kb/search")
+async def search_kb(
+    client_id: int = Path(..., ge=1),
+    q: str = Query(..., min_length=1),
+    k: int = Query(knowledge.TOP_K, ge=1, le=20),
+    _: dict = Depends(verify_admin),
+):
+    # per verificare cosa finirebbe nel prompt per una data domanda
+    hits = await knowledge.search(client_id, q, k, min_score=0.0)
+    return [{"score": round(s, 3), "chunk": c} for s, c in hits]
+
+# ---------------- Triggers (risposte senza LLM) ----------------
+@router.get("/clients/{client_id}/triggers")
+async def list_triggers(
+    client_id: int = Path(..., ge=1),
+    _: dict = Depends(verify_admin),
+    db: AsyncSession = Depends(get_session),
+):
+    q = text("""
+        SELECT id, client_id, trigger, response, match_mode, active, created_at, updated_at
+        FROM mfai_app.client_triggers
+        WHERE client_id = :c
+        ORDER BY id
+    """)
+    rows = await db.execute(q, {"c": client_id})
+    return [dict(r) for r in rows.mappings().all()]
+
+@router.post("/clients/{client_id}/triggers")
+async def create_trigger(
+    client_id: int = Path(..., ge=1),
+    payload: dict = Body(...),
+    _: dict = Depends(verify_admin),
+    db: AsyncSession = Depends(get_session),
+):
+    # payload atteso: {"trigger": "orari", "response": "Siamo aperti...", "match_mode": "keyword"}
+    trigger = (payload.get("trigger") or "").strip()
+    response = (payload.get("response") or "").strip()
+    match_mode = (payload.get("match_mode") or "keyword").strip().lower()
+    if not trigger or not response:
+        raise HTTPException(status_code=400, detail="trigger e response sono obbligatori")
+    if match_mode not in triggers.MODES:
+        raise HTTPException(status_code=400, detail="match_mode deve essere 'exact' o 'keyword'")
+
+    exists_q = text("SELECT 1 FROM mfai_app.clients WHERE id = :c")
+    if not (await db.execute(exists_q, {"c": client_id})).first():
+        raise HTTPException(status_code=404, detail="Client non trovato")
+
+    q = text("""
+        INSERT INTO mfai_app.client_triggers (client_id, trigger, response, match_mode)
+        VALUES (:c, :t, :r, :m)
+        RETURNING id, client_id, trigger, response, match_mode, active, created_at, updated_at
+    """)
+    res = await db.execute(q, {"c": client_id, "t": trigger, "r": response, "m": match_mode})
+    row = dict(res.mappings().one())
+    await db.commit()
+    triggers.invalidate(client_id)
+    return row
+
+@router.patch("/triggers/{trigger_id}")
+async def update_trigger(
+    trigger_id: int = Path(..., ge=1),
+    payload: dict = Body(...),
+    _: dict = Depends(verify_admin),
+    db: AsyncSession = Depends(get_session),
+):
+    # campi opzionali: trigger, response, match_mode, active
+    fields, params = [], {"id": trigger_id}
+    for key in ("trigger", "response"):
+        if key in payload:
+            val = (payload.get(key) or "").strip()
+            if not val:
+                raise HTTPException(status_code=400, detail=f"{key} non può essere vuoto")
+            fields.append(f"{key} = :{key}")
+            params[key] = val
+    if "match_mode" in payload:
+        mode = (payload.get("match_mode") or "").strip().lower()
+        if mode not in triggers.MODES:
+            raise HTTPException(status_code=400, detail="match_mode deve essere 'exact' o 'keyword'")
+        fields.append("match_mode = :match_mode")
+        params["match_mode"] = mode
+    if "active" in payload:
+        fields.append("active = :active")
+        params["active"] = bool(payload.get("active"))
+    if not fields:
+        raise HTTPException(status_code=400, detail="Nessun campo da aggiornare")
+
+    q = text(f"""
+        UPDATE mfai_app.client_triggers
+        SET {", ".join(fields)}, updated_at = now()
+        WHERE id = :id
+        RETURNING id, client_id, trigger, response, match_mode, active, created_at, updated_at
+    """)
+    row = (await db.execute(q, params)).mappings().first()
+    if not row:
+        raise HTTPException(status_code=404, detail="Trigger non trovato")
+    row = dict(row)
+    await db.commit()
+    triggers.invalidate(row["client_id"])
+    return row
+
+@router.delete("/triggers/{trigger_id}")
+async def delete_trigger(
+    trigger_id: int = Path(..., ge=1),
+    _: dict = Depends(verify_admin),
+    db: AsyncSession = Depends(get_session),
+):
+    q = text("DELETE FROM mfai_app.client_triggers WHERE id = :id RETURNING client_id")
+    row = (await db.execute(q, {"id": trigger_id})).first()
+    if not row:
+        raise HTTPException(status_code=404, detail="Trigger non trovato")
+    await db.commit()
+    triggers.invalidate(row[0])
+    return {"status": "deleted", "id": trigger_id}
+
 # ---------------- Logs ----------------
 @router.get("/logs")
 async def list_logs(
@@ -9,10 +9,11 @@ import json
 from typing import Dict, Any, Optional
 from urllib.parse import urlencode
 
-import httpx
 from fastapi import APIRouter, Request, HTTPException, Form
 from fastapi.responses import HTMLResponse, RedirectResponse
 
+from app.services import http as http_clients
+
 router = APIRouter()
 
 GRAPH_VER = "v21.0"
@@ -181,86 +182,87 @@ async def meta_callback(request: Request):
     if not code:
         return HTMLResponse("<h3>Missing ?code</h3>", status_code=400)
 
-    async with httpx.AsyncClient(timeout=25.0) as client:
-        # short-lived user token
-        token_resp = await client.get(
-            f"https://graph.facebook.com/{GRAPH_VER}/oauth/access_token",
-            params={
-                "client_id": META_APP_ID,
-                "redirect_uri": REDIRECT_URI,
-                "client_secret": META_APP_SECRET,
-                "code": code,
-            },
-        )
-        token_data = token_resp.json()
-        if "access_token" not in token_data:
-            return HTMLResponse(f"<h3>Token error</h3><pre>{h(token_resp.text[:2000])}</pre>", status_code=400)
-        user_access_token = token_data["access_token"]
+    # client Graph condiviso (services/http): connessione riusata tra login
+    client = http_clients.client("graph")
+    # short-lived user token
+    token_resp = await client.get(
+        f"https://graph.facebook.com/{GRAPH_VER}/oauth/access_token",
+        params={
+            "client_id": META_APP_ID,
+            "redirect_uri": REDIRECT_URI,
+            "client_secret": META_APP_SECRET,
+            "code": code,
+        },
+    )
+    token_data = token_resp.json()
+    if "access_token" not in token_data:
+        return HTMLResponse(f"<h3>Token error</h3><pre>{h(token_resp.text[:2000])}</pre>", status_code=400)
+    user_access_token = token_data["access_token"]
 
-        # 2) Long-lived user token
-        ll_resp = await client.get(
-            f"https://graph.facebook.com/{GRAPH_VER}/oauth/access_token",
-            params={
-                "grant_type": "fb_exchange_token",
-                "client_id": META_APP_ID,
-                "client_secret": META_APP_SECRET,
-                "fb_exchange_token": user_access_token,
-            },
-        )
-        ll_data = ll_resp.json()
-        long_lived_user_token = ll_data.get("access_token", user_access_token)
+    # 2) Long-lived user token
+    ll_resp = await client.get(
+        f"https://graph.facebook.com/{GRAPH_VER}/oauth/access_token",
+        params={
+            "grant_type": "fb_exchange_token",
+            "client_id": META_APP_ID,
+            "client_secret": META_APP_SECRET,
+            "fb_exchange_token": user_access_token,
+        },
+    )
+    ll_data = ll_resp.json()
+    long_lived_user_token = ll_data.get("access_token", user_access_token)
 
-        # 3) Pages + IG linkage
-        pages_resp = await client.get(
-            f"https://graph.facebook.com/{GRAPH_VER}/me/accounts",
+    # 3) Pages + IG linkage
+    pages_resp = await client.get(
+        f"https://graph.facebook.com/{GRAPH_VER}/me/accounts",
+        params={
+            "access_token": long_lived_user_token,
+            "fields": "id,name,access_token,instagram_business_account",
+        },
+    )
+    pages_data = pages_resp.json()
+    if "data" not in pages_data or not pages_data["data"]:
+        return HTMLResponse("<h3>No Pages found for this user</h3>", status_code=400)
+
+    selected_page: Optional[Dict[str, Any]] = None
+    for p in pages_data["data"]:
+        if p.get("instagram_business_account"):
+            selected_page = p
+            break
+    if not selected_page:
+        selected_page = pages_data["data"][0]
+
+    page_id = selected_page["id"]
+    page_name = selected_page.get("name", "")
+    page_access_token = selected_page.get("access_token", "")
+
+    # 4) IG User ID dalla Page (se necessario)
+    if selected_page.get("instagram_business_account", {}).get("id"):
+        ig_user_id = selected_page["instagram_business_account"]["id"]
+    else:
+        page_detail_resp = await client.get(
+            f"https://graph.facebook.com/{GRAPH_VER}/{page_id}",
             params={
                 "access_token": long_lived_user_token,
-                "fields": "id,name,access_token,instagram_business_account",
+                "fields": "instagram_business_account",
             },
         )
-        pages_data = pages_resp.json()
-        if "data" not in pages_data or not pages_data["data"]:
-            return HTMLResponse("<h3>No Pages found for this user</h3>", status_code=400)
-
-        selected_page: Optional[Dict[str, Any]] = None
-        for p in pages_data["data"]:
-            if p.get("instagram_business_account"):
-                selected_page = p
-                break
-        if not selected_page:
-            selected_page = pages_data["data"][0]
+        page_detail = page_detail_resp.json()
+        iba = page_detail.get("instagram_business_account")
+        ig_user_id = iba.get("id") if iba else None
 
-        page_id = selected_page["id"]
-        page_name = selected_page.get("name", "")
-        page_access_token = selected_page.get("access_token", "")
-
-        # 4) IG User ID dalla Page (se necessario)
-        if selected_page.get("instagram_business_account", {}).get("id"):
-            ig_user_id = selected_page["instagram_business_account"]["id"]
-        else:
-            page_detail_resp = await client.get(
-                f"https://graph.facebook.com/{GRAPH_VER}/{page_id}",
-                params={
-                    "access_token": long_lived_user_token,
-                    "fields": "instagram_business_account",
-                },
+    # 5) IG username (best effort)
+    ig_username: Optional[str] = None
+    if ig_user_id and page_access_token:
+        try:
+            igq = await client.get(
+                f"https://graph.facebook.com/{GRAPH_VER}/{ig_user_id}",
+                params={"access_token": page_access_token, "fields": "username"},
             )
-            page_detail = page_detail_resp.json()
-            iba = page_detail.get("instagram_business_account")
-            ig_user_id = iba.get("id") if iba else None
-
-        # 5) IG username (best effort)
-        ig_username: Optional[str] = None
-        if ig_user_id and page_access_token:
-            try:
-                igq = await client.get(
-                    f"https://graph.facebook.com/{GRAPH_VER}/{ig_user_id}",
-                    params={"access_token": page_access_token, "fields": "username"},
-                )
-                igd = igq.json()
-                ig_username = igd.get("username")
-            except Exception:
-                ig_username = None
+            igd = igq.json()
+            ig_username = igd.get("username")
+        except Exception:
+            ig_username = None
 
     summary = {
         "page_id": page_id,
@@ -462,8 +464,9 @@ async def meta_save(
     target_url = f"{(BASE_URL or origin).rstrip('/')}/save-token"
 
     try:
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            resp = await client.post(target_url, json=body, headers={"x-api-key": API_KEY})
+        resp = await http_clients.client("self").post(
+            target_url, json=body, headers={"x-api-key": API_KEY}, timeout=15.0
+        )
         if resp.status_code >= 400:
             return HTMLResponse(
                 f"<h3>Save failed</h3><pre>Status: {resp.status_code}\n{h(resp.text[:1000])}</pre>",
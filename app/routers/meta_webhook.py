@@ -1,19 +1,24 @@
 # app/routers/meta_webhook.py
 import os
-import json
 import logging
-from time import time
-from typing import Any, Dict, List, Tuple, Optional
+from time import monotonic, time
+from typing import Any, Awaitable, Dict, List, Sequence, Tuple, Optional
 
 from fastapi import APIRouter, Request, HTTPException
 from fastapi.responses import PlainTextResponse, JSONResponse
 import httpx
-from sqlalchemy import text
 
 import asyncio  # <<< AGGIUNGI
+from contextlib import aclosing
 
-
-from app.db import engine  # async SQLAlchemy engine verso Neon
+from app.services import (
+    admission, burst, circuit, codec, deadline, dedup, hedge, inbound_queue, knowledge, log_writer, message_history,
+    llm, metrics, model_router, reply_cache, send_retry, sessions, state, summarizer, tenant_registry, tokens, triggers,
+    worker_pool,
+)
+from app.services import http as http_clients
+from app.services import prompts as global_prompts
+from app.services.account_context import AccountContext
 
 logger = logging.getLogger("meta_webhook")
 logger.setLevel(logging.INFO)
@@ -36,131 +41,74 @@ OPENAI_API_KEY    = os.getenv("OPENAI_API_KEY")
 INBOX_APP_ID      = 263902037430900  # Facebook Page Inbox
 RESPECT_HUMAN     = os.getenv("RESPECT_HUMAN", "true").lower() == "true"
 HUMAN_TTL_SEC     = int(os.getenv("HUMAN_TTL_SEC", "900"))  # 15 minuti default
+# Raffiche di DM: finestra di debounce, opt-in perché ritarda ogni risposta
+# (override per cliente: client_prompts BURST_WINDOW_MS, 0 = off)
+BURST_WINDOW_MS   = float(os.getenv("BURST_WINDOW_MS", "0"))
+BURST_MAX_FACTOR  = float(os.getenv("BURST_MAX_FACTOR", "3"))  # attesa massima = finestra x fattore
+# Streaming: primo DM appena la prima frase è pronta (override per cliente: client_prompts STREAM_REPLY)
+LLM_STREAMING     = os.getenv("LLM_STREAMING", "false").lower() == "true"
+# Load shedding: prompt statico inviato quando la chiamata LLM viene scartata (HANDOFF / FALLBACK)
+SHED_PROMPT_KEY   = os.getenv("SHED_PROMPT_KEY", "HANDOFF").upper()
 
 logger.info(f"[DEBUG] OPENAI_API_KEY loaded: {bool(OPENAI_API_KEY)}")
 
 
-# ---- Conversational memory (in-RAM) ----
-# key = f"{ig_user_id}:{user_id}", value = list of {"role":"user/assistant","content": "..."}
-_SESS: Dict[str, List[Dict[str, str]]] = {}
-_SESS_TTL_SEC = int(os.getenv("SESSION_TTL_SEC", "3600"))  # reset dopo 1h inattività
-_SESS_LAST_AT: Dict[str, float] = {}
+# ---- Conversational memory + stato "umano attivo" ----
+# key = (ig_user_id, user_id); history = turni (ruolo, testo)
+# Backend in memoria o condiviso su Postgres (STATE_BACKEND): vedi app/services/state.py
+_STATE = state.BACKEND
 
 def _skey(ig_user_id: str, user_id: str) -> str:
     return f"{ig_user_id}:{user_id}"
 
-def _sess_get(ig_user_id: str, user_id: str) -> List[Dict[str, str]]:
-    key = _skey(ig_user_id, user_id)
-    if _SESS_LAST_AT.get(key, 0) + _SESS_TTL_SEC < time():
-        _SESS.pop(key, None)
-    _SESS_LAST_AT[key] = time()
-    return _SESS.setdefault(key, [])
-
-def _sess_add(ig_user_id: str, user_id: str, role: str, content: str, cap: int = 12):
-    s = _sess_get(ig_user_id, user_id)
-    s.append({"role": role, "content": content})
-    if len(s) > cap:
-        del s[: len(s) - cap]
-    _SESS_LAST_AT[_skey(ig_user_id, user_id)] = time()
-
-def _sess_clear(ig_user_id: str, user_id: str):
-    key = _skey(ig_user_id, user_id)
-    _SESS.pop(key, None)
-    _SESS_LAST_AT.pop(key, None)
-
-# Stato in-memory per "umano attivo" per thread (chiave = f"{ig_user_id}:{user_id}")
-_HUMAN_UNTIL: Dict[str, float] = {}
-
-def _key(ig_user_id: str, user_id: str) -> str:
-    return f"{ig_user_id}:{user_id}"
+def _key(ig_user_id: str, user_id: str) -> sessions.ThreadKey:
+    return (ig_user_id, user_id)
 
-def _human_active(ig_user_id: str, user_id: str) -> bool:
-    return _HUMAN_UNTIL.get(_key(ig_user_id, user_id), 0) > time()
+async def _sess_get(ig_user_id: str, user_id: str) -> Sequence[sessions.Turn]:
+    return await _STATE.history(_key(ig_user_id, user_id))
 
-def _mark_human(ig_user_id: str, user_id: str, ttl: int | None = None) -> None:
-    _HUMAN_UNTIL[_key(ig_user_id, user_id)] = time() + (ttl or HUMAN_TTL_SEC)
+async def _sess_add(ig_user_id: str, user_id: str, role: str, content: str):
+    await _STATE.append(_key(ig_user_id, user_id), role, content)
 
-def _clear_human(ig_user_id: str, user_id: str) -> None:
-    _HUMAN_UNTIL.pop(_key(ig_user_id, user_id), None)
+async def _sess_clear(ig_user_id: str, user_id: str):
+    await _STATE.clear(_key(ig_user_id, user_id))
 
-# ------------------------------------------------------------------
-# HTTP client condiviso (HTTP/2 + keep-alive) per ridurre latenza
-# ------------------------------------------------------------------
-_HTTPX: Optional[httpx.AsyncClient] = None
-GRAPH_BASE = "https://graph.facebook.com/v21.0"  # v21.0
+async def _sess_rehydrate(ctx: AccountContext, user_id: str, before: Optional[float]) -> None:
+    """Thread freddo (es. dopo un riavvio): ricarica gli ultimi turni da message_logs."""
+    key = _key(ctx.ig_user_id, user_id)
+    if ctx.ig_account_id is None or not await _STATE.is_cold(key):
+        return
+    turns = await message_history.load_turns(
+        ctx.ig_account_id, user_id, limit=sessions.SESSION_MAX_TURNS,
+        max_age=sessions.SESSION_TTL_SEC, before=before or time(),
+    )
+    if turns:
+        await _STATE.seed(key, turns)
+        metrics.incr("sessions.rehydrated")
 
-_HTTPX = None
+async def _human_active(ig_user_id: str, user_id: str) -> bool:
+    return await _STATE.human_active(_key(ig_user_id, user_id))
 
-def _httpx() -> httpx.AsyncClient:
-    global _HTTPX
-    if _HTTPX is None:
-        _HTTPX = httpx.AsyncClient(
-            timeout=httpx.Timeout(12.0, connect=6.0)
-            # niente http2=True
-        )
-    return _HTTPX
+async def _mark_human(ig_user_id: str, user_id: str, ttl: int | None = None) -> None:
+    await _STATE.mark_human(_key(ig_user_id, user_id), ttl or HUMAN_TTL_SEC)
 
+async def _clear_human(ig_user_id: str, user_id: str) -> None:
+    await _STATE.clear_human(_key(ig_user_id, user_id))
 
-async def _close_httpx():
-    global _HTTPX
-    if _HTTPX is not None:
-        await _HTTPX.aclose()
-        _HTTPX = None
+# ------------------------------------------------------------------
+# HTTP in uscita: client condivisi per upstream (services/http: pool + keep-alive)
+# ------------------------------------------------------------------
+GRAPH_BASE = "https://graph.facebook.com/v21.0"  # v21.0
 
 # ------------------------------------------------------------------
-# DB HELPERS (client_id, system prompt, bot flag, tokens, logs)
+# DB HELPERS (logs) — account/token/prompt: vedi services/account_context
 # ------------------------------------------------------------------
-async def _get_client_id_by_ig(ig_user_id: str) -> int | None:
-    q = text("SELECT client_id FROM mfai_app.instagram_accounts WHERE ig_user_id = :ig LIMIT 1")
-    async with engine.connect() as conn:
-        row = (await conn.execute(q, {"ig": ig_user_id})).first()
-    return int(row[0]) if row else None
-
-async def _get_system_prompt(client_id: int) -> str | None:
-    q = text("""
-      SELECT value FROM mfai_app.client_prompts
-      WHERE client_id = :cid AND key = 'system'
-      LIMIT 1
-    """)
-    async with engine.connect() as conn:
-        row = (await conn.execute(q, {"cid": client_id})).first()
-    return str(row[0]) if row else None
-
-async def _bot_is_enabled(ig_user_id: str) -> bool:
-    q = text("SELECT bot_enabled FROM mfai_app.instagram_accounts WHERE ig_user_id = :ig LIMIT 1")
-    async with engine.connect() as conn:
-        row = (await conn.execute(q, {"ig": ig_user_id})).first()
-    return bool(row[0]) if row else False
-
-async def _get_ig_account_id(ig_user_id: str) -> int | None:
-    q = text("SELECT id FROM mfai_app.instagram_accounts WHERE ig_user_id = :ig LIMIT 1")
-    async with engine.connect() as conn:
-        row = (await conn.execute(q, {"ig": ig_user_id})).first()
-    return int(row[0]) if row else None
-
-async def _get_active_page_token(ig_user_id: str) -> str | None:
-    q = text("""
-        SELECT t.access_token
-        FROM mfai_app.tokens t
-        JOIN mfai_app.instagram_accounts ia ON ia.id = t.ig_account_id
-        WHERE ia.ig_user_id = :ig AND t.active = TRUE
-        LIMIT 1
-    """)
-    async with engine.connect() as conn:
-        row = (await conn.execute(q, {"ig": ig_user_id})).first()
-    return row[0] if row else None
-
-async def _log_message(ig_account_id: int | None, direction: str, payload: Any):
-    q = text("""
-        INSERT INTO mfai_app.message_logs (ig_account_id, direction, payload)
-        VALUES (:ig_account_id, :direction, :payload)
-    """)
-    async with engine.begin() as conn:
-        await conn.execute(q, {
-            "ig_account_id": ig_account_id,
-            "direction": direction,
-            "payload": json.dumps(payload, ensure_ascii=False)
-        })
+def _log_message(ig_account_id: int | None, direction: str, payload: Any,
+                 peer_id: str | None = None, body: str | None = None) -> None:
+    """Accoda il log al writer a lotti (services/log_writer): non blocca il flusso di risposta.
+    `payload` può essere già serializzato (str): in quel caso va scritto così com'è.
+    `peer_id`/`body` servono a ricostruire la history dopo un riavvio."""
+    log_writer.write(ig_account_id, direction, payload, peer_id=peer_id, body=body)
 
 def _needs_takeover(resp: Dict[str, Any]) -> bool:
     try:
@@ -183,7 +131,7 @@ async def meta_verify(request: Request):
     logger.info(f"[VERIFY] VERIFY_TOKEN={VERIFY_TOKEN}")
     
     if mode == "subscribe" and token == VERIFY_TOKEN and challenge:
-        logger.info(f"[VERIFY] OK, returning challenge")
+        logger.info("[VERIFY] OK, returning challenge")
         return PlainTextResponse(challenge)
     
     logger.warning(f"[VERIFY] FAILED: mode={mode!r}, token_match={token==VERIFY_TOKEN}, challenge={challenge!r}")
@@ -192,34 +140,10 @@ async def meta_verify(request: Request):
 # ------------------------------------------------------------------
 # RECEIVER
 # ------------------------------------------------------------------
-@router.post("/webhook/meta")
-async def meta_webhook(request: Request):
-    print("🔴 WEBHOOK POST RICEVUTO!", file=sys.stderr)
-    logger.warning("🔴 [WEBHOOK] POST ricevuto!")
-    
-    # 🔍 DEBUG: log TUTTO
-    logger.info(f"[WEBHOOK-DEBUG] Received POST from {request.client.host}")
-    logger.info(f"[WEBHOOK-DEBUG] Headers: {dict(request.headers)}")
-    
-    # --- Parse body ---
-    try:
-        body: Dict[str, Any] = await request.json()
-        logger.info(f"[WEBHOOK-DEBUG] Body parsed OK: {json.dumps(body, ensure_ascii=False)[:500]}")
-    except Exception as e:
-        logger.error(f"[WEBHOOK-DEBUG] Body parse failed: {e}")
-        raise HTTPException(status_code=400, detail="Invalid JSON")
-
-    logger.info("[IG_WEBHOOK] %s", json.dumps(body, ensure_ascii=False))
-
-    # Accetta sia object=instagram che object=page
-    if body.get("object") not in ("instagram", "page"):
-        logger.info("Webhook object ignored: %s", body.get("object"))
-        return JSONResponse({"status": "ignored"}, status_code=200)
-
+def _collect_events(body: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Normalizza il payload in una lista piatta di {"ig_user_id", "evt", "raw", "key", "dedup"}."""
+    out: List[Dict[str, Any]] = []
     entries: List[Dict[str, Any]] = body.get("entry", []) or []
-    if not entries:
-        logger.info("No entries in payload")
-        return JSONResponse({"status": "ok", "note": "no entries"}, status_code=200)
 
     # === Loop sugli entry (uno per pagina/ig_user_id) ===
     for entry in entries:
@@ -231,7 +155,7 @@ async def meta_webhook(request: Request):
         # Costruisci una lista unificata di eventi "messaging"
         messaging_list: List[Dict[str, Any]] = entry.get("messaging", []) or []
 
-             # Se vuota, prova il formato Instagram moderno con 'changes'
+        # Se vuota, prova il formato Instagram moderno con 'changes'
         if not messaging_list:
             changes = entry.get("changes", []) or []
 
@@ -246,10 +170,14 @@ async def meta_webhook(request: Request):
                     sender_from = str(m.get("from") or "")
                     text_body = (m.get("text") or {}).get("body")
                     if sender_from and isinstance(text_body, str) and text_body.strip():
+                        msg: Dict[str, Any] = {"text": text_body}
+                        if m.get("id"):
+                            msg["mid"] = m.get("id")  # serve alla deduplica
                         messaging_list.append({
                             "sender": {"id": sender_from},
                             "recipient": {"id": ig_user_id},
-                            "message": {"text": text_body}
+                            "message": msg,
+                            "timestamp": m.get("timestamp"),
                         })
                 # fallback Messenger-like
                 for m in val.get("messaging", []) or []:
@@ -258,151 +186,540 @@ async def meta_webhook(request: Request):
                     if snd and isinstance(txt, str) and txt.strip():
                         messaging_list.append(m)
 
-
         if not messaging_list:
             logger.info("No messaging/changes messages for ig_user_id=%s", ig_user_id)
             continue
 
-        ig_account_id = await _get_ig_account_id(ig_user_id)
-
-        # === Loop sugli eventi messaggio ===
         for evt in messaging_list:
-            # --- HANDOVER: pausa/riprendi AI quando l'umano prende/lascia il thread ---
-            handover = evt.get("pass_thread_control") or evt.get("take_thread_control")
-            if isinstance(handover, dict):
-                try:
-                    new_owner = handover.get("new_owner_app_id") or handover.get("recipient_app_id")
-                    prev_owner = handover.get("previous_owner_app_id")
-                    sender_id = str((evt.get("sender") or {}).get("id") or "")
-                    recipient_id = str((evt.get("recipient") or {}).get("id") or "")
-                    user_id = sender_id if sender_id and sender_id != ig_user_id else recipient_id
-                    if new_owner == INBOX_APP_ID:
-                        _mark_human(ig_user_id, user_id)
-                        logger.info("Handover to INBOX: pause AI for %s", _key(ig_user_id, user_id))
-                    elif prev_owner == INBOX_APP_ID:
-                        _clear_human(ig_user_id, user_id)
-                        logger.info("Handover from INBOX: resume AI for %s", _key(ig_user_id, user_id))
-                except Exception as e:
-                    logger.warning("handover parse err: %s", e)
-                continue
-
-            sender = (evt.get("sender") or {})
-            recipient = (evt.get("recipient") or {})
-            message = evt.get("message")
-
-            sender_id = str(sender.get("id") or "")
-            recipient_id = str(recipient.get("id") or "")
-
-            # Log IN (best-effort)
-            try:
-                await _log_message(ig_account_id, "in", evt)
-            except Exception as e:
-                logger.warning("DB log(in) failed: %s", e)
-
-            # --- SOLO messaggi di testo non-echo da UTENTE ---
-            if not isinstance(message, dict):
-                logger.info("Skip: message not dict")
-                continue
-            if message.get("is_echo"):
-                logger.info("Skip: echo")
-                continue
-            text_msg = message.get("text")
-            if not isinstance(text_msg, str) or not text_msg.strip():
-                logger.info("Skip: not text")
-                continue
-            if sender_id == ig_user_id:
-                logger.info("Skip: page echo")
-                continue
-
-            # Rispetto umano attivo?
-            if RESPECT_HUMAN and _human_active(ig_user_id, sender_id):
-                logger.info("Human active: skip AI reply for %s", _key(ig_user_id, sender_id))
-                continue
-
-            # Bot abilitato?
-            if not await _bot_is_enabled(ig_user_id):
-                logger.info("Bot disabled for ig_user_id=%s, skip reply", ig_user_id)
-                try:
-                    await _log_message(ig_account_id, "out", {"skip": "bot disabled"})
-                except Exception:
-                    pass
-                continue
-
-            # Page token (servirà per typing+invio)
-            page_token = await _get_active_page_token(ig_user_id)
-            if not page_token:
-                logger.warning("No active PAGE TOKEN for IG %s", ig_user_id)
-                continue
-
-            # Typing immediato (non blocca)
-            try:
-                asyncio.create_task(_send_typing_via_me(page_token, sender_id))
-            except Exception as e:
-                logger.warning("typing_on schedule failed: %s", e)
+            # chiave del thread: l'utente è il sender, oppure il recipient
+            # se il sender è la pagina stessa (echo / handover)
+            sender_id = str((evt.get("sender") or {}).get("id") or "")
+            recipient_id = str((evt.get("recipient") or {}).get("id") or "")
+            user_id = sender_id if sender_id and sender_id != ig_user_id else recipient_id
+            out.append({
+                "ig_user_id": ig_user_id,
+                "evt": evt,
+                # serializzato UNA volta: riusato per coda su DB e message_logs
+                "raw": codec.dumps(evt),
+                "key": _skey(ig_user_id, user_id),
+                "dedup": dedup.event_key(ig_user_id, entry.get("time"), evt),
+                "received_at": time(),
+            })
+    return out
 
-            # Memoria conversazionale: append input utente
-            _sess_add(ig_user_id, sender_id, "user", text_msg)
 
-            # System prompt per cliente (se presente)
-            system_override: Optional[str] = None
-            try:
-                cid = await _get_client_id_by_ig(ig_user_id)
-                if cid:
-                    system_override = await _get_system_prompt(cid)
-            except Exception as e:
-                logger.warning("system prompt load failed: %s", e)
-                
-                            # Chiamata AI (con history) + fallback
-            try:
-                reply_text = await ai_reply_with_history(
-                    ig_user_id, sender_id, system_override=system_override
-                )
-            except Exception as e:
-                logger.error("AI error: %s", e)
-                reply_text = _fallback_reply(text_msg)
-
-            # Takeover preventivo se non vogliamo rispettare l'umano
-            if not RESPECT_HUMAN:
-                try:
-                    took_pre = await _take_thread_control(page_token, FB_PAGE_ID, sender_id)
-                    logger.info("take_thread_control (pre-send) took=%s", took_pre)
-                except Exception as e:
-                    logger.warning("take_thread_control (pre-send) error: %s", e)
-
-            # Invio messaggio (primo tentativo)
-            ok, resp = await _send_dm_via_me(page_token, sender_id, reply_text)
-
-            # Se fallisce per ownership, prova takeover/rispetto umano e ritenta
-            if not ok and _needs_takeover(resp):
-                if RESPECT_HUMAN:
-                    _mark_human(ig_user_id, sender_id)
-                    logger.info("Got 2534037: respect human -> pause AI for %s", _key(ig_user_id, sender_id))
-                else:
-                    try:
-                        took_retry = await _take_thread_control(page_token, FB_PAGE_ID, sender_id)
-                        logger.info("take_thread_control (retry) took=%s", took_retry)
-                        if took_retry:
-                            ok, resp = await _send_dm_via_me(page_token, sender_id, reply_text)
-                    except Exception as e:
-                        logger.warning("take_thread_control (retry) error: %s", e)
-
-            # Se inviato con successo, append risposta in memoria
-            if ok:
-                _sess_add(ig_user_id, sender_id, "assistant", reply_text)
-
-            # Log OUT (best-effort)
+@router.post("/webhook/meta")
+async def meta_webhook(request: Request):
+    # --- Parse body: bytes letti una volta, decodificati una volta ---
+    raw = await request.body()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[WEBHOOK-DEBUG] Headers: %s", dict(request.headers))
+    try:
+        body: Dict[str, Any] = codec.loads(raw)
+    except Exception as e:
+        logger.error(f"[WEBHOOK-DEBUG] Body parse failed: {e}")
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+
+    # log dei byte originali (troncati): niente ri-serializzazione del body
+    logger.info("[IG_WEBHOOK] %s bytes from %s: %s", len(raw),
+                request.client.host if request.client else "?",
+                raw[:500].decode("utf-8", errors="replace"))
+
+    # Accetta sia object=instagram che object=page
+    if body.get("object") not in ("instagram", "page"):
+        logger.info("Webhook object ignored: %s", body.get("object"))
+        return JSONResponse({"status": "ignored"}, status_code=200)
+
+    if not (body.get("entry") or []):
+        logger.info("No entries in payload")
+        return JSONResponse({"status": "ok", "note": "no entries"}, status_code=200)
+
+    # Ack-first: accoda e rispondi subito, i worker fanno DB/OpenAI/Graph.
+    # Ogni thread (_skey) ha la sua corsia: ordine rigoroso nel thread,
+    # thread diversi in parallelo.
+    start_workers()
+
+    # Ri-consegne di Meta: scarta subito gli id già visti (prima di DB/OpenAI)
+    events = [e for e in _collect_events(body) if not dedup.seen(e["dedup"])]
+    if not events:
+        return JSONResponse({"status": "ok", "queued": 0}, status_code=200)
+
+    # Coda persistente: un solo INSERT, poi i poller (di qualunque istanza)
+    # reclamano gli eventi. Se il DB non risponde, ripiega sulla coda in RAM.
+    # L'indice UNIQUE su dedup_key scarta i duplicati visti da altre istanze.
+    if inbound_queue.ENABLED:
+        try:
+            queued = await inbound_queue.enqueue(events)
+            return JSONResponse({"status": "ok", "queued": queued}, status_code=200)
+        except Exception as e:
+            logger.warning("inbound queue write failed, fallback in-memory: %s", e)
+
+    rejected = 0
+    for item in events:
+        if not worker_pool.submit(item["key"], item):
+            dedup.forget(item["dedup"])
+            rejected += 1
+
+    if rejected:
+        # Coda piena: 503 così Meta ritenta la consegna più tardi
+        logger.warning("Webhook queue full: %s/%s eventi rifiutati", rejected, len(events))
+        return JSONResponse({"status": "busy"}, status_code=503)
+
+    return JSONResponse({"status": "ok", "queued": len(events)}, status_code=200)
+
+
+def start_workers() -> None:
+    log_writer.start()
+    _STATE.start()
+    send_retry.start()
+    global_prompts.refresh_soon()  # prompt statici già in cache per shed / fallback
+    worker_pool.start(_handle_item)
+    inbound_queue.start(lambda row: worker_pool.submit(row["key"], row), worker_pool.capacity)
+
+
+async def stop_workers() -> None:
+    # prima ferma il poller (niente nuovi claim), poi svuota le corsie,
+    # infine scrive gli ultimi log rimasti in coda
+    await inbound_queue.stop()
+    n = burst.flush_all(_burst_due)  # raffiche aperte: risposte subito, prima di svuotare le corsie
+    if n:
+        logger.info("shutdown: %s raffiche chiuse in anticipo", n)
+    await worker_pool.stop()
+    await send_retry.stop()
+    await log_writer.stop()
+    await _STATE.stop()
+
+
+async def _handle_item(item: Dict[str, Any]) -> None:
+    """Esegue l'evento e, se arriva dalla coda su DB, lo conferma o lo rimette in coda."""
+    qid = item.get("qid")
+    try:
+        # budget end-to-end dalla ricezione: letto da ogni stadio (services/deadline)
+        with deadline.bind(deadline.Deadline(item.get("received_at"))):
+            await _process_event(item)
+    except Exception as e:
+        if qid is not None:
+            await inbound_queue.fail(qid, repr(e), item.get("attempts", 1))
+        raise
+    if qid is not None:
+        await inbound_queue.ack(qid)
+
+
+async def _process_event(item: Dict[str, Any]) -> None:
+    """Gestisce un singolo evento messaging (eseguito dai worker del pool)."""
+    if item.get("kind") == "burst":
+        await _process_burst(item)
+        return
+
+    ig_user_id: str = item["ig_user_id"]
+    evt: Dict[str, Any] = item["evt"]
+
+    # --- HANDOVER: pausa/riprendi AI quando l'umano prende/lascia il thread ---
+    handover = evt.get("pass_thread_control") or evt.get("take_thread_control")
+    if isinstance(handover, dict):
+        try:
+            new_owner = handover.get("new_owner_app_id") or handover.get("recipient_app_id")
+            prev_owner = handover.get("previous_owner_app_id")
+            sender_id = str((evt.get("sender") or {}).get("id") or "")
+            recipient_id = str((evt.get("recipient") or {}).get("id") or "")
+            user_id = sender_id if sender_id and sender_id != ig_user_id else recipient_id
+            if new_owner == INBOX_APP_ID:
+                await _mark_human(ig_user_id, user_id)
+                logger.info("Handover to INBOX: pause AI for %s", _skey(ig_user_id, user_id))
+            elif prev_owner == INBOX_APP_ID:
+                await _clear_human(ig_user_id, user_id)
+                logger.info("Handover from INBOX: resume AI for %s", _skey(ig_user_id, user_id))
+        except Exception as e:
+            logger.warning("handover parse err: %s", e)
+        return
+
+    # Account, client, bot flag, token e system prompt: dal registry in memoria
+    # (una sola query solo se la voce manca o è stata invalidata)
+    dl = deadline.current()
+    t_lookup = monotonic()
+    ctx = await tenant_registry.get(ig_user_id)
+    ig_account_id = ctx.ig_account_id
+    if dl is not None:
+        dl.mark("lookup", t_lookup)
+
+    sender = (evt.get("sender") or {})
+    recipient = (evt.get("recipient") or {})
+    message = evt.get("message")
+
+    sender_id = str(sender.get("id") or "")
+    recipient_id = str(recipient.get("id") or "")
+
+    # Log IN (best-effort): riusa la serializzazione fatta in ricezione
+    try:
+        _log_message(ig_account_id, "in", item.get("raw") or evt,
+                     peer_id=sender_id, body=message_history.inbound_text(evt))
+    except Exception as e:
+        logger.warning("DB log(in) failed: %s", e)
+
+    # --- SOLO messaggi di testo non-echo da UTENTE ---
+    if not isinstance(message, dict):
+        logger.info("Skip: message not dict")
+        return
+    if message.get("is_echo"):
+        logger.info("Skip: echo")
+        return
+    text_msg = message.get("text")
+    if not isinstance(text_msg, str) or not text_msg.strip():
+        logger.info("Skip: not text")
+        return
+    if sender_id == ig_user_id:
+        logger.info("Skip: page echo")
+        return
+
+    # Rispetto umano attivo?
+    if RESPECT_HUMAN and await _human_active(ig_user_id, sender_id):
+        logger.info("Human active: skip AI reply for %s", _skey(ig_user_id, sender_id))
+        return
+
+    # Bot abilitato?
+    if not ctx.bot_enabled:
+        logger.info("Bot disabled for ig_user_id=%s, skip reply", ig_user_id)
+        try:
+            _log_message(ig_account_id, "out", {"skip": "bot disabled"}, peer_id=sender_id)
+        except Exception:
+            pass
+        return
+
+    # Page token (servirà per typing+invio)
+    page_token = ctx.page_token
+    if not page_token:
+        logger.warning("No active PAGE TOKEN for IG %s", ig_user_id)
+        return
+
+    key = _skey(ig_user_id, sender_id)
+
+    # Typing immediato (non blocca); durante una raffica basta il primo
+    if not burst.pending(key):
+        try:
+            asyncio.create_task(_send_typing_via_me(page_token, sender_id))
+        except Exception as e:
+            logger.warning("typing_on schedule failed: %s", e)
+
+    # Raffica di DM: accumula e rispondi una volta sola allo scadere della finestra
+    window = ctx.setting_float("BURST_WINDOW_MS", BURST_WINDOW_MS) / 1000.0
+    if window > 0:
+        burst.add(key, text_msg, window, window * BURST_MAX_FACTOR, _burst_due,
+                  meta={"ig_user_id": ig_user_id, "sender_id": sender_id,
+                        "received_at": item.get("received_at")})
+        return
+
+    await _reply(ctx, sender_id, text_msg, item.get("received_at"))
+
+
+def _burst_due(key: str) -> None:
+    """Finestra scaduta: il flush passa dalla corsia del thread, così resta in ordine."""
+    if worker_pool.submit(key, {"kind": "burst", "key": key}):
+        return
+    if not worker_pool.running():
+        # pool fermo (shutdown): niente più tentativi, la raffica si perde
+        buf = burst.pop(key)
+        metrics.incr("burst.dropped")
+        logger.warning("Burst %s scartato: worker pool fermo (%s messaggi)",
+                       key, len(buf["texts"]) if buf else 0)
+        return
+    # pool pieno: riprova tra poco, il testo resta nel buffer
+    asyncio.get_running_loop().call_later(0.5, _burst_due, key)
+
+
+async def _process_burst(item: Dict[str, Any]) -> None:
+    buf = burst.pop(item["key"])
+    if not buf or not buf["texts"]:
+        return
+    ig_user_id = buf["meta"]["ig_user_id"]
+    sender_id = buf["meta"]["sender_id"]
+    # ricontrolla: nel frattempo può essere subentrato un operatore o cambiato il bot flag
+    if RESPECT_HUMAN and await _human_active(ig_user_id, sender_id):
+        logger.info("Human active: skip AI reply for %s", _skey(ig_user_id, sender_id))
+        return
+    ctx = await tenant_registry.get(ig_user_id)
+    if not ctx.bot_enabled or not ctx.page_token:
+        return
+    if len(buf["texts"]) > 1:
+        logger.info("Burst %s: %s messaggi -> 1 risposta", item["key"], len(buf["texts"]))
+    # la scadenza parte dal PRIMO messaggio della raffica, non dal flush
+    received_at = buf["meta"].get("received_at")
+    with deadline.bind(deadline.Deadline(received_at)):
+        await _reply(ctx, sender_id, burst.join(buf["texts"]), received_at)
+
+
+def _shed_reply(ctx: AccountContext) -> str:
+    """Risposta statica quando la chiamata LLM viene scartata (override per cliente, poi globale)."""
+    return _static_prompt(ctx, SHED_PROMPT_KEY)
+
+
+def _static_prompt(ctx: AccountContext, key: str) -> str:
+    """Nessun I/O: si usa quando il budget è finito o un upstream è giù."""
+    return (ctx.setting(key) or global_prompts.cached_prompt(key)
+            or global_prompts.default_prompt("HANDOFF"))
+
+
+async def _reply(ctx: AccountContext, sender_id: str, text_msg: str,
+                 received_at: Optional[float] = None) -> None:
+    """Turno utente -> risposta AI -> invio DM (+ takeover/retry) -> memoria e log."""
+    dl = deadline.current()
+    if dl is None:
+        with deadline.bind(deadline.Deadline(received_at)):
+            return await _reply(ctx, sender_id, text_msg, received_at)
+    dl.set_budget(ctx.setting_float("REPLY_DEADLINE_SEC", deadline.BUDGET_SEC))
+    ig_user_id = ctx.ig_user_id
+    ig_account_id = ctx.ig_account_id
+    page_token = ctx.page_token
+
+    # Memoria conversazionale: thread freddo -> rilettura da message_logs
+    # (solo log precedenti alla ricezione: il messaggio corrente lo aggiungiamo qui sotto)
+    try:
+        await _within(dl, "rehydrate", _sess_rehydrate(ctx, sender_id, received_at))
+    except Exception as e:
+        logger.warning("session rehydrate failed: %s", e)
+    # Trigger del cliente (parola chiave -> risposta fissa): nessuna chiamata LLM
+    trigger = await _within(dl, "trigger", triggers.match(ctx.client_id, text_msg))
+    # Cache risposte: solo primo turno (nessuna history né riassunto), così le
+    # risposte che dipendono dal contesto non vengono mai riusate
+    cache_key = None
+    if trigger is None and _reply_cache_enabled(ctx) and not await _sess_get(ig_user_id, sender_id) \
+            and not await _STATE.summary(_key(ig_user_id, sender_id)):
+        # la versione della knowledge base entra nella chiave: documenti cambiati = nuove risposte
+        # (lettura scaduta = niente cache, mai una chiave con la versione sbagliata)
+        # None = lettura scaduta o versione KB sconosciuta: niente cache (chiave non affidabile)
+        kb_version = await _within(dl, "cache", knowledge.version(ctx.client_id))
+        if kb_version is not None:
+            cache_key = reply_cache.make_key(ctx.client_id, f"{ctx.system_prompt or ''}\x00kb:{kb_version}", text_msg)
+    # append input utente
+    await _sess_add(ig_user_id, sender_id, "user", text_msg)
+
+    # Chiamata AI (con history + system prompt del cliente, se presente) + fallback.
+    # Ammissione: limite globale di chiamate in volo + budget di attesa dalla ricezione;
+    # se non c'è posto rispondiamo subito con il prompt statico (load shedding).
+    # In modalità streaming i DM partono già durante la generazione (delivered).
+    token_budget = int(ctx.setting_float("HISTORY_TOKEN_BUDGET", tokens.HISTORY_TOKEN_BUDGET))
+    kb_k = int(ctx.setting_float("KB_TOP_K", knowledge.TOP_K))
+    route: Optional[model_router.Route] = None
+    circuit_open = False
+    shed: Optional[str] = None
+    # trigger o cache: reply_text già pronto, nessuna chiamata LLM
+    reply_text = trigger.response if trigger else None
+    if reply_text is None and cache_key:
+        reply_text = reply_cache.get(cache_key)
+    cache_hit = reply_text is not None and trigger is None
+    delivered: Optional[Tuple[bool, Any, str]] = None
+    t_llm = monotonic()
+    try:
+        if reply_text is None and not circuit.get("openai").available():
+            # OpenAI in difficoltà: risposta statica del cliente, senza aspettare timeout
+            reply_text = _static_prompt(ctx, "FALLBACK")
+            circuit_open = True
+        elif reply_text is None and not dl.can_afford(deadline.LLM_MIN_SEC):
+            shed = "deadline"  # il budget residuo non copre una chiamata LLM + invio
+        elif reply_text is None:  # né trigger né cache: chiamata LLM
+            reply_text = ""
+            route = await _choose_route(ctx, sender_id, text_msg)
+            async with admission.llm_slot(received_at) as shed:
+                if shed is None and not dl.can_afford(deadline.LLM_MIN_SEC):
+                    shed = "deadline"  # l'attesa per lo slot ha consumato il budget
+                if shed is None and _streaming_enabled(ctx) and circuit.get("graph").available():
+                    streamed = await _stream_reply(ctx, sender_id, token_budget, received_at, kb_k, route)
+                    if streamed is None:  # stream vuoto: nessun DM inviato
+                        reply_text = _fallback_reply(text_msg)
+                    else:
+                        ok, resp, sent_text, complete = streamed
+                        delivered = (ok, resp, sent_text)
+                        if cache_key and ok and complete:
+                            reply_cache.put(cache_key, sent_text)
+                elif shed is None and cache_key:
+                    # single-flight: domande identiche in contemporanea -> una sola chiamata
+                    reply_text = await reply_cache.compute_once(cache_key, lambda: _cacheable_reply(
+                        ig_user_id, sender_id, ctx.system_prompt, token_budget,
+                        kb_client_id=ctx.client_id, kb_k=kb_k, route=route,
+                        hedged=_hedge_enabled(ctx),
+                    ))
+                elif shed is None:
+                    reply_text = await ai_reply_with_history(
+                        ig_user_id, sender_id, system_override=ctx.system_prompt,
+                        token_budget=token_budget, kb_client_id=ctx.client_id, kb_k=kb_k,
+                        route=route, hedged=_hedge_enabled(ctx),
+                    )
+    except Exception as e:
+        logger.error("AI error: %s", e)
+        reply_text = _fallback_reply(text_msg)
+    dl.mark("llm", t_llm)
+    if shed:
+        logger.warning("LLM shed (%s) for %s", shed, _skey(ig_user_id, sender_id))
+        reply_text = _shed_reply(ctx)
+
+    if delivered is not None:
+        ok, resp, reply_text = delivered
+    else:
+        with dl.stage("send"):
+            await _pre_send_takeover(page_token, sender_id)
+            ok, resp = await _send_with_takeover(ctx, sender_id, reply_text)
+        if ok and received_at:
+            metrics.observe("reply.time_to_first_dm_ms", (time() - received_at) * 1000.0)
+
+    # Se inviato con successo (o rimandato alla coda di retry), append risposta in memoria
+    queued = ok or (isinstance(resp, dict) and bool(resp.get("deferred")))
+    if queued:
+        await _sess_add(ig_user_id, sender_id, "assistant", reply_text)
+        # thread lungo -> riassunto dei turni vecchi in background (non blocca la risposta)
+        try:
+            await summarizer.maybe_schedule(_key(ig_user_id, sender_id))
+        except Exception as e:
+            logger.warning("summarizer schedule failed: %s", e)
+
+    # Log OUT (best-effort)
+    try:
+        out_payload = {"request": {"to": sender_id, "text": reply_text}, "response": resp}
+        if shed:
+            out_payload["shed"] = shed
+        if cache_hit:
+            out_payload["cache"] = "hit"
+        if trigger:
+            out_payload["trigger"] = trigger.id
+        if route and not shed:
+            out_payload["route"] = route.name
+        if circuit_open:
+            out_payload["circuit"] = "open"
+        out_payload["stages_ms"] = dl.stages
+        _log_message(ig_account_id, "out", out_payload,
+                     peer_id=sender_id, body=reply_text if queued else None)
+    except Exception as e:
+        logger.warning("DB log(out) failed: %s", e)
+
+    dl.finish()
+    logger.info("Send result ok=%s resp=%s", ok, resp)
+
+
+async def _within(dl: deadline.Deadline, stage: str, aw: Awaitable[Any]) -> Any:
+    """Lettura prima dell'LLM con timeout stretto al budget (lasciando LLM + invio); scaduta -> None."""
+    with dl.stage(stage):
+        try:
+            return await asyncio.wait_for(aw, dl.timeout(deadline.LOOKUP_MAX_SEC,
+                                                         deadline.LLM_MIN_SEC + deadline.SEND_RESERVE_SEC))
+        except asyncio.TimeoutError:
+            metrics.incr(f"stage.{stage}.timeout")
+            logger.warning("stage %s oltre il budget: saltato", stage)
+            return None
+
+
+async def _pre_send_takeover(page_token: str, sender_id: str) -> None:
+    """Takeover preventivo se non vogliamo rispettare l'umano."""
+    if RESPECT_HUMAN:
+        return
+    try:
+        took_pre = await _take_thread_control(page_token, FB_PAGE_ID, sender_id)
+        logger.info("take_thread_control (pre-send) took=%s", took_pre)
+    except Exception as e:
+        logger.warning("take_thread_control (pre-send) error: %s", e)
+
+
+async def _send_with_takeover(ctx: AccountContext, sender_id: str, reply_text: str) -> Tuple[bool, Any]:
+    """Invio DM; se fallisce per ownership (2534037) rispetta l'umano o fa takeover e ritenta."""
+    page_token = ctx.page_token
+    ok, resp = await _send_dm_via_me(page_token, sender_id, reply_text)
+    if not ok and _needs_takeover(resp):
+        if RESPECT_HUMAN:
+            await _mark_human(ctx.ig_user_id, sender_id)
+            logger.info("Got 2534037: respect human -> pause AI for %s", _skey(ctx.ig_user_id, sender_id))
+        else:
             try:
-                out_payload = {"request": {"to": sender_id, "text": reply_text}, "response": resp}
-                await _log_message(ig_account_id, "out", out_payload)
+                took_retry = await _take_thread_control(page_token, FB_PAGE_ID, sender_id)
+                logger.info("take_thread_control (retry) took=%s", took_retry)
+                if took_retry:
+                    ok, resp = await _send_dm_via_me(page_token, sender_id, reply_text)
             except Exception as e:
-                logger.warning("DB log(out) failed: %s", e)
+                logger.warning("take_thread_control (retry) error: %s", e)
+    return ok, resp
+
+
+def _reply_cache_enabled(ctx: AccountContext) -> bool:
+    return ctx.setting_bool("REPLY_CACHE", reply_cache.ENABLED)
+
 
-            logger.info("Send result ok=%s resp=%s", ok, resp)
+async def _choose_route(ctx: AccountContext, sender_id: str, text_msg: str) -> model_router.Route:
+    """Modello + max_tokens dalle feature del messaggio (history già con il turno corrente)."""
+    sess = await _sess_get(ctx.ig_user_id, sender_id)
+    summary = await _STATE.summary(_key(ctx.ig_user_id, sender_id))
+    f = model_router.features(text_msg, max(len(sess) - 1, 0), bool(summary))
+    return model_router.choose(ctx, f)
 
 
-      
+def _hedge_enabled(ctx: AccountContext) -> bool:
+    return ctx.setting_bool("LLM_HEDGE", hedge.ENABLED)
+
+
+def _streaming_enabled(ctx: AccountContext) -> bool:
+    if not OPENAI_API_KEY:
+        return False
+    return ctx.setting_bool("STREAM_REPLY", LLM_STREAMING)
+
+
+async def _stream_reply(ctx: AccountContext, sender_id: str, token_budget: int,
+                        received_at: Optional[float], kb_k: int = knowledge.TOP_K,
+                        route: model_router.Route = model_router.DEFAULT,
+                        ) -> Optional[Tuple[bool, Any, str, bool]]:
+    """Streaming: la prima frase completa parte subito come DM, il resto a paragrafi.
+    Se un invio finisce nella coda di retry (circuito Graph aperto) si smette di inviare
+    a paragrafi: il resto della risposta viene raccolto e rimandato come UN solo DM.
+    Ritorna (ok, resp, testo inviato o rimandato, completo) oppure None se il modello non
+    ha prodotto testo. Un errore prima del primo DM viene rilanciato (il chiamante usa il fallback)."""
+    messages = await _build_messages(ctx.ig_user_id, sender_id, ctx.system_prompt, token_budget,
+                                     kb_client_id=ctx.client_id, kb_k=kb_k)
+    sent: List[str] = []
+    deferred: List[str] = []
+    ok, resp = False, None
+    complete = False
+    usage: Dict[str, Any] = {}
+    t0 = time()
+    send_sec = 0.0  # tempo speso negli invii Graph, escluso dalla latenza della route
+    try:
+        # entrambi i generatori chiusi subito all'uscita (break, scadenza, errore):
+        # stream_chat tiene aperti lo stream HTTP OpenAI e la sua connessione
+        async with aclosing(llm.stream_chat(messages, model=route.model, max_tokens=route.max_tokens,
+                                            usage_out=usage)) as deltas, \
+                aclosing(llm.stream_segments(deltas)) as segments:
+            async for seg in segments:
+                if deferred:  # Graph giù: si raccoglie il resto senza inviare (né takeover)
+                    deferred.append(seg)
+                    continue
+                t_send = time()
+                if not sent:
+                    await _pre_send_takeover(ctx.page_token, sender_id)
+                ok, resp = await _send_with_takeover(ctx, sender_id, seg)
+                send_sec += time() - t_send
+                if not ok and isinstance(resp, dict) and resp.get("deferred"):
+                    deferred.append(seg)
+                    continue
+                if not ok:
+                    break
+                if not sent:
+                    metrics.observe("reply.first_dm_after_llm_ms", (time() - t0) * 1000.0)
+                    if received_at:
+                        metrics.observe("reply.time_to_first_dm_ms", (time() - received_at) * 1000.0)
+                sent.append(seg)
+            else:
+                complete = True
+    except Exception as e:
+        if not sent and resp is None:
+            raise
+        metrics.incr("llm.stream.interrupted")
+        logger.warning("stream interrotto dopo %s messaggi: %s", len(sent), e)
+    if len(deferred) > 1:
+        # il primo segmento è già in coda: il resto lo segue come un unico DM
+        rest = "\n\n".join(deferred[1:])
+        rid = _defer_dm(ctx.page_token, sender_id, rest)
+        resp = {"error": "graph circuit open", "deferred": True, "retry_id": rid}
+        metrics.incr("llm.stream.deferred")
+    if not sent and resp is None:
+        return None
+    if complete:
+        model_router.record(route, (time() - t0 - send_sec) * 1000.0, usage)
+    metrics.observe("reply.stream_messages", len(sent))
+    return bool(sent), resp, "\n\n".join(sent + deferred), complete
 
-    return JSONResponse({"status": "ok"}, status_code=200)
 
 # ------------------------------------------------------------------
 # AI + FALLBACK
@@ -426,52 +743,112 @@ def _system_prompt_for_thread(has_history: bool) -> str:
         base += " NON ripetere domande già fatte; usa le informazioni appena fornite dall’utente."
     return base
 
-async def ai_reply_with_history(ig_user_id: str, user_id: str, system_override: str | None = None) -> str:
-    """Costruisce i messaggi includendo history in-RAM e system override per cliente."""
-    sess = _sess_get(ig_user_id, user_id)
-    use_history = len(sess) > 1  # c'è già almeno 1 turno precedente
+async def _build_messages(ig_user_id: str, user_id: str, system_override: str | None = None,
+                          token_budget: int | None = None, kb_client_id: int | None = None,
+                          kb_k: int = knowledge.TOP_K) -> List[Dict[str, str]]:
+    """System (+ riassunto + top-k chunk della knowledge base del cliente)
+    + history in-RAM tagliata a `token_budget` token (system compreso)."""
+    sess = await _sess_get(ig_user_id, user_id)
+    summary = await _STATE.summary(_key(ig_user_id, user_id))  # turni vecchi già riassunti
+    use_history = len(sess) > 1 or bool(summary)  # c'è già almeno 1 turno precedente
 
     # Se esiste un system personalizzato, usalo; altrimenti usa quello base
     sys = (system_override or _system_prompt_for_thread(use_history)).strip()
     # Se abbiamo history e il system personalizzato NON lo menziona, rinforza il vincolo.
     if use_history and system_override:
         sys += "\nNon ripetere domande già fatte; usa le informazioni già emerse nel thread."
-
-    # Costruisci i messaggi per OpenAI: system + history (max 10) + ultimo user già appeso in sess
-    history = sess[-10:]
-    messages = [{"role": "system", "content": sys}] + history
-
+    sys += summarizer.format_for_prompt(summary)
+    # Grounding: solo i chunk più pertinenti all'ultimo messaggio dell'utente
+    last_user = next((c for r, c in reversed(sess) if r == sessions.USER), "")
+    sys += knowledge.format_for_prompt(await knowledge.search(kb_client_id, last_user, kb_k))
+
+    # Costruisci i messaggi per OpenAI: system + history a budget di token + ultimo user già appeso in sess
+    turns, prompt_tokens = tokens.trim_to_budget(sys, sess, token_budget or tokens.HISTORY_TOKEN_BUDGET)
+    metrics.observe("llm.prompt_tokens.estimated", prompt_tokens)
+    metrics.observe("llm.history_turns", len(turns))
+    if len(turns) < len(sess):
+        metrics.incr("llm.history_trimmed")
+    logger.info("LLM prompt tokens est=%s turns=%s/%s", prompt_tokens, len(turns), len(sess))
+    return [{"role": "system", "content": sys}] + sessions.to_messages(turns)
+
+
+async def _chat_completion(messages: List[Dict[str, str]],
+                           route: model_router.Route = model_router.DEFAULT) -> str:
+    """Chiamata OpenAI non-streaming con modello e max_tokens della route;
+    solleva llm.LLMError se non c'è una risposta valida."""
     if not OPENAI_API_KEY:
-        logger.warning("OPENAI_API_KEY assente: uso fallback (con history)")
-        # fallback: rispondi usando l'ultimo user
-        last_user = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
-        return _fallback_reply(last_user)
-
+        raise llm.LLMError("OPENAI_API_KEY assente")
     headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"}
     payload = {
-        "model": "gpt-4o-mini",
+        "model": route.model,
         "messages": messages,
         "temperature": 0.7,
-        "max_tokens": 220,
+        "max_tokens": route.max_tokens,
     }
-    # Nota: qui lasciamo l'AsyncClient locale per non toccare altri pezzi;
-    # se vuoi, possiamo poi migrare anche questa chiamata al pool _httpx().
-    timeout = httpx.Timeout(12.0, connect=6.0)
-    async with httpx.AsyncClient(timeout=timeout) as client:
-        r = await client.post("https://api.openai.com/v1/chat/completions",
-                              headers=headers, json=payload)
-        if r.status_code != 200:
-            logger.error("OpenAI HTTP %s: %s", r.status_code, r.text)
-            last_user = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
-            return _fallback_reply(last_user)
-        j = r.json()
-        try:
-            txt = (j["choices"][0]["message"]["content"]).strip()
-            return txt or _fallback_reply(messages[-1]["content"])
-        except Exception as e:
-            logger.error("OpenAI parse error: %s | payload=%s", e, j)
-            last_user = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
-            return _fallback_reply(last_user)
+    # circuito aperto: niente attesa del timeout, il chiamante usa subito il fallback
+    breaker = circuit.get("openai")
+    if not breaker.allow():
+        raise llm.LLMError("circuito OpenAI aperto")
+    # client OpenAI condiviso (connessione già aperta), timeout adattivo dalle latenze recenti
+    t0 = time()
+    try:
+        r = await http_clients.client("openai").post("https://api.openai.com/v1/chat/completions",
+                                                     headers=headers, json=payload,
+                                                     timeout=deadline.fit(breaker.timeout(), deadline.SEND_RESERVE_SEC))
+    except httpx.HTTPError:
+        breaker.record(False, (time() - t0) * 1000.0)
+        raise
+    breaker.record(not circuit.failed_status(r.status_code), (time() - t0) * 1000.0)
+    if r.status_code != 200:
+        raise llm.LLMError(f"OpenAI HTTP {r.status_code}: {r.text}")
+    j = r.json()
+    usage = j.get("usage") or {}
+    if usage.get("prompt_tokens"):
+        metrics.observe("llm.prompt_tokens", usage["prompt_tokens"])
+    model_router.record(route, (time() - t0) * 1000.0, usage)
+    try:
+        txt = (j["choices"][0]["message"]["content"]).strip()
+    except Exception as e:
+        raise llm.LLMError(f"OpenAI parse error: {e} | payload={j}")
+    if not txt:
+        raise llm.LLMError("OpenAI: risposta vuota")
+    return txt
+
+
+async def _complete(messages: List[Dict[str, str]], route: model_router.Route, hedged: bool) -> str:
+    """_chat_completion, con eventuale seconda richiesta oltre la soglia di latenza della route."""
+    if not hedged:
+        return await _chat_completion(messages, route)
+    return await hedge.call(lambda: _chat_completion(messages, route), f"route.{route.name}.latency_ms")
+
+
+async def ai_reply_with_history(ig_user_id: str, user_id: str, system_override: str | None = None,
+                                token_budget: int | None = None, kb_client_id: int | None = None,
+                                kb_k: int = knowledge.TOP_K,
+                                route: model_router.Route = model_router.DEFAULT,
+                                hedged: bool = False) -> str:
+    """Costruisce i messaggi includendo history in-RAM e system override per cliente.
+    La history viene tagliata a `token_budget` token (system prompt compreso)."""
+    messages = await _build_messages(ig_user_id, user_id, system_override, token_budget,
+                                     kb_client_id=kb_client_id, kb_k=kb_k)
+    try:
+        return await _complete(messages, route, hedged)
+    except llm.LLMError as e:
+        logger.error("%s", e)
+        # fallback: rispondi usando l'ultimo user
+        last_user = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+        return _fallback_reply(last_user)
+
+
+async def _cacheable_reply(ig_user_id: str, user_id: str, system_override: str | None,
+                           token_budget: int, kb_client_id: int | None = None,
+                           kb_k: int = knowledge.TOP_K,
+                           route: model_router.Route = model_router.DEFAULT,
+                           hedged: bool = False) -> str:
+    """Come ai_reply_with_history ma senza fallback: un errore non deve finire in cache."""
+    messages = await _build_messages(ig_user_id, user_id, system_override, token_budget,
+                                     kb_client_id=kb_client_id, kb_k=kb_k)
+    return await _complete(messages, route, hedged)
 
 # ------------------------------------------------------------------
 # GRAPH HELPERS (v21.0 + client riusato)
@@ -481,7 +858,8 @@ async def _take_thread_control(page_token: str, page_id: str, recipient_id: str)
     params = {"access_token": page_token}
     payload = {"recipient": {"id": recipient_id}, "metadata": "mf.ai auto-take"}
     try:
-        r = await _httpx().post(url, params=params, json=payload)
+        r = await http_clients.client("graph").post(url, params=params, json=payload,
+                                                    timeout=deadline.fit(circuit.get("graph").timeout()))
         j = r.json() if r.headers.get("content-type","").startswith("application/json") else {}
         return (r.status_code == 200) and (j.get("success") is True)
     except Exception as e:
@@ -496,7 +874,8 @@ async def _send_typing_via_me(page_token: str, recipient_id: str) -> Tuple[bool,
         "sender_action": "typing_on",
     }
     try:
-        r = await _httpx().post(url, params=params, json=payload)
+        r = await http_clients.client("graph").post(url, params=params, json=payload,
+                                                    timeout=deadline.fit(circuit.get("graph").timeout()))
         try:
             data = r.json()
         except Exception:
@@ -506,6 +885,21 @@ async def _send_typing_via_me(page_token: str, recipient_id: str) -> Tuple[bool,
         return (False, {"error": str(e)})
 
 async def _send_dm_via_me(page_token: str, recipient_id: str, text: str) -> Tuple[bool, Dict[str, Any]]:
+    """Invio DM; con il circuito Graph aperto l'invio va nella coda di retry (resp["deferred"])."""
+    ok, resp = await _post_dm(page_token, recipient_id, text)
+    if not ok and resp.get("circuit_open"):
+        rid = _defer_dm(page_token, recipient_id, text)
+        resp = {"error": "graph circuit open", "deferred": True, "retry_id": rid}
+    return ok, resp
+
+
+def _defer_dm(page_token: str, recipient_id: str, text: str) -> int:
+    """Mette il DM nella coda di retry (inviato in ordine quando Graph torna disponibile)."""
+    return send_retry.defer(lambda: _post_dm(page_token, recipient_id, text),
+                            f"dm->{recipient_id}", _retriable_send)
+
+
+async def _post_dm(page_token: str, recipient_id: str, text: str) -> Tuple[bool, Dict[str, Any]]:
     url = f"{GRAPH_BASE}/me/messages"  # v21.0
     params = {"access_token": page_token}
     payload = {
@@ -513,15 +907,32 @@ async def _send_dm_via_me(page_token: str, recipient_id: str, text: str) -> Tupl
         "recipient": {"id": recipient_id},
         "message": {"text": text},
     }
+    breaker = circuit.get("graph")
+    if not breaker.allow():
+        return (False, {"error": "graph circuit open", "circuit_open": True})
+    t0 = time()
     try:
-        r = await _httpx().post(url, params=params, json=payload)
-        try:
-            data = r.json()
-        except Exception:
-            data = {"status_code": r.status_code, "text": r.text}
-        return (200 <= r.status_code < 300, data)
+        r = await http_clients.client("graph").post(url, params=params, json=payload,
+                                                    timeout=deadline.fit(breaker.timeout()))
     except Exception as e:
+        breaker.record(False, (time() - t0) * 1000.0)
         return (False, {"error": str(e)})
+    breaker.record(not circuit.failed_status(r.status_code), (time() - t0) * 1000.0)
+    try:
+        data = r.json()
+    except Exception:
+        data = {"status_code": r.status_code, "text": r.text}
+    return (200 <= r.status_code < 300, data)
+
+
+def _retriable_send(resp: Dict[str, Any]) -> bool:
+    """Errori di rete/timeout/circuito, 5xx o errori Graph transitori: si riprova; gli altri 4xx no."""
+    err = resp.get("error")
+    if isinstance(err, str):
+        return True
+    if isinstance(err, dict):
+        return bool(err.get("is_transient")) or err.get("code") in (1, 2, 4, 17, 341)
+    return (resp.get("status_code") or 0) >= 500
     
     
     
@@ -0,0 +1,111 @@
+# app/services/account_context.py
+# ------------------------------------------------------------
+# Contesto account per il webhook: id account IG, client, flag bot,
+# token pagina attivo, system prompt e impostazioni del cliente
+# (tutte le chiavi di client_prompts) in UNA query
+# (una sola connessione dal pool, un solo round trip verso Neon).
+# ------------------------------------------------------------
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+from sqlalchemy import text
+
+from app.db import engine
+from app.services import codec
+
+
+@dataclass(frozen=True)
+class AccountContext:
+    ig_user_id: str
+    ig_account_id: Optional[int] = None
+    client_id: Optional[int] = None
+    bot_enabled: bool = False
+    page_token: Optional[str] = None
+    system_prompt: Optional[str] = None
+    settings: Dict[str, str] = field(default_factory=dict)  # client_prompts, chiavi MAIUSCOLE
+
+    @property
+    def known(self) -> bool:
+        return self.ig_account_id is not None
+
+    def setting(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        v = self.settings.get(key.upper())
+        return v if v not in (None, "") else default
+
+    def setting_float(self, key: str, default: float) -> float:
+        try:
+            return float(self.setting(key, None) or default)
+        except ValueError:
+            return default
+
+    def setting_bool(self, key: str, default: bool) -> bool:
+        """Flag per cliente ("1"/"true"/"on"/"yes" = attivo); `default` se non impostato."""
+        v = self.setting(key, None)
+        if v is None:
+            return default
+        return v.strip().lower() in {"1", "true", "on", "yes"}
+
+
+_CONTEXT_SELECT = """
+    SELECT ia.ig_user_id    AS ig_user_id,
+           ia.id            AS ig_account_id,
+           ia.client_id     AS client_id,
+           ia.bot_enabled   AS bot_enabled,
+           t.access_token   AS page_token,
+           cp.value         AS system_prompt,
+           s.settings       AS settings
+    FROM mfai_app.instagram_accounts ia
+    LEFT JOIN LATERAL (
+        SELECT access_token
+        FROM mfai_app.tokens
+        WHERE ig_account_id = ia.id AND active = TRUE
+        ORDER BY created_at DESC
+        LIMIT 1
+    ) t ON TRUE
+    LEFT JOIN mfai_app.client_prompts cp
+           ON cp.client_id = ia.client_id AND cp.key = 'system'
+    LEFT JOIN LATERAL (
+        SELECT json_object_agg(upper(key), value) AS settings
+        FROM mfai_app.client_prompts
+        WHERE client_id = ia.client_id
+    ) s ON TRUE
+"""
+
+_CONTEXT_SQL = text(_CONTEXT_SELECT + " WHERE ia.ig_user_id = :ig LIMIT 1")
+_ALL_SQL = text(_CONTEXT_SELECT)
+
+
+async def resolve_account(ig_user_id: str) -> AccountContext:
+    """Se l'account non esiste ritorna un contesto "vuoto" (known=False, bot spento)."""
+    async with engine.connect() as conn:
+        row = (await conn.execute(_CONTEXT_SQL, {"ig": ig_user_id})).mappings().first()
+    if not row:
+        return AccountContext(ig_user_id=ig_user_id)
+    return _from_row(row)
+
+
+async def load_all_accounts() -> Dict[str, AccountContext]:
+    """Snapshot di tutti gli account (per il registry in memoria)."""
+    async with engine.connect() as conn:
+        rows = (await conn.execute(_ALL_SQL)).mappings().all()
+    return {str(r["ig_user_id"]): _from_row(r) for r in rows}
+
+
+def _from_row(row) -> AccountContext:
+    return AccountContext(
+        ig_user_id=str(row["ig_user_id"]),
+        ig_account_id=int(row["ig_account_id"]),
+        client_id=int(row["client_id"]) if row["client_id"] is not None else None,
+        bot_enabled=bool(row["bot_enabled"]),
+        page_token=row["page_token"] or None,
+        system_prompt=str(row["system_prompt"]) if row["system_prompt"] is not None else None,
+        settings=_settings(row["settings"]),
+    )
+
+
+def _settings(raw) -> Dict[str, str]:
+    # asyncpg restituisce json come stringa
+    if not raw:
+        return {}
+    data = codec.loads(raw) if isinstance(raw, (str, bytes)) else raw
+    return {str(k): str(v) for k, v in (data or {}).items()}
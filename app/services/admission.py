@@ -0,0 +1,74 @@
+# app/services/admission.py
+# ------------------------------------------------------------
+# Controllo di ammissione per le chiamate LLM del webhook:
+# - limite globale di chiamate in volo (LLM_MAX_INFLIGHT, default WEBHOOK_WORKERS - 2)
+# - budget di tempo in coda dalla ricezione dell'evento (LLM_QUEUE_BUDGET_SEC)
+# Se non c'è posto entro il budget la richiesta viene "scartata" (shed):
+# il chiamante risponde con un prompt statico invece di accodarsi all'infinito.
+# ------------------------------------------------------------
+import os
+import asyncio
+from contextlib import asynccontextmanager
+from time import time
+from typing import AsyncIterator, Optional
+
+from app.services import metrics
+from app.services.worker_pool import WORKERS
+
+# default sotto il numero di worker: con più slot che worker lo scarto "inflight"
+# non potrebbe mai scattare (ogni worker tiene al massimo uno slot)
+MAX_INFLIGHT     = int(os.getenv("LLM_MAX_INFLIGHT", str(max(1, WORKERS - 2))))
+QUEUE_BUDGET_SEC = float(os.getenv("LLM_QUEUE_BUDGET_SEC", "8"))
+
+_SEM: Optional[asyncio.Semaphore] = None
+_INFLIGHT = 0
+_WAITING = 0
+
+
+def _sem() -> asyncio.Semaphore:
+    global _SEM
+    if _SEM is None:
+        _SEM = asyncio.Semaphore(MAX_INFLIGHT)
+    return _SEM
+
+
+@asynccontextmanager
+async def llm_slot(received_at: Optional[float]) -> AsyncIterator[Optional[str]]:
+    """Yield None se ammesso, altrimenti il motivo dello scarto ("queue_time" / "inflight").
+
+        async with admission.llm_slot(item["received_at"]) as shed:
+            if shed: ...risposta statica...
+    """
+    global _INFLIGHT, _WAITING
+    remaining = QUEUE_BUDGET_SEC - (time() - received_at) if received_at else QUEUE_BUDGET_SEC
+    if remaining <= 0:
+        metrics.incr("admission.shed.queue_time")
+        yield "queue_time"
+        return
+
+    sem = _sem()
+    _WAITING += 1
+    try:
+        await asyncio.wait_for(sem.acquire(), timeout=remaining)
+        admitted = True
+    except asyncio.TimeoutError:
+        admitted = False
+    finally:
+        _WAITING -= 1
+    if not admitted:
+        metrics.incr("admission.shed.inflight")
+        yield "inflight"
+        return
+
+    _INFLIGHT += 1
+    metrics.incr("admission.admitted")
+    try:
+        yield None
+    finally:
+        _INFLIGHT -= 1
+        sem.release()
+
+
+metrics.register_gauge("admission", lambda: {
+    "inflight": _INFLIGHT, "waiting": _WAITING, "max_inflight": MAX_INFLIGHT,
+})
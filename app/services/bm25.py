@@ -0,0 +1,182 @@
+# app/services/bm25.py
+# ------------------------------------------------------------
+# Indice BM25 locale in array NumPy (usato da services/knowledge).
+# Indice invertito: per ogni termine gli id dei chunk e il peso BM25 già
+# calcolato, quindi una query = somma di poche slice. Nessun servizio esterno.
+# Gli array possono stare su disco memory-mapped (mmap_dir): ogni build scrive
+# in una sua sottocartella nuova, mai sopra file che un indice precedente (o
+# un altro processo) ha ancora mappati; prune() toglie le versioni vecchie.
+# ------------------------------------------------------------
+import os
+import re
+import shutil
+import tempfile
+import unicodedata
+from collections import Counter
+from time import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+CHUNK_WORDS = int(os.getenv("KB_CHUNK_WORDS", "120"))
+BM25_K1     = 1.2
+BM25_B      = 0.75
+
+_STOPWORDS = frozenset("""
+a ad al alla alle agli ai anche che chi ci con da dal dalla dei del della delle di e è ed gli
+ha hai ho i il in io la le lo ma mi ne nel nella no non o per più qui se si sono su sul sulla
+ti tra tu un una uno vi voi
+an and are as at be by do for from how i if in is it me my of on or so the to we what when
+where which who why with you your
+""".split())
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def _terms(text_in: str) -> List[str]:
+    """Minuscolo, senza accenti, niente stopword; stemming minimo (vocale finale)
+    così "prezzo"/"prezzi" e "costa"/"costi" coincidono."""
+    t = unicodedata.normalize("NFKD", text_in.lower())
+    t = "".join(c for c in t if not unicodedata.combining(c))
+    out = []
+    for w in _WORD.findall(t):
+        if w in _STOPWORDS or len(w) < 2:
+            continue
+        if len(w) > 4 and w[-1] in "aeiou":
+            w = w[:-1]
+        out.append(w)
+    return out
+
+
+def chunk(title: str, content: str, max_words: int = CHUNK_WORDS) -> List[str]:
+    """Paragrafi accorpati fino a ~max_words parole; il titolo apre ogni chunk."""
+    head = f"{title.strip()}: " if title and title.strip() else ""
+    chunks, cur, n = [], [], 0
+    for para in re.split(r"\n\s*\n", content or ""):
+        para = " ".join(para.split())
+        if not para:
+            continue
+        words = para.split(" ")
+        while len(words) > max_words:  # paragrafo troppo lungo: a pezzi
+            if cur:
+                chunks.append(head + " ".join(cur))
+                cur, n = [], 0
+            chunks.append(head + " ".join(words[:max_words]))
+            words = words[max_words:]
+        if n + len(words) > max_words and cur:
+            chunks.append(head + " ".join(cur))
+            cur, n = [], 0
+        cur.extend(words)
+        n += len(words)
+    if cur:
+        chunks.append(head + " ".join(cur))
+    return chunks
+
+
+class KBIndex:
+    """Indice BM25 di un cliente. Postings ordinati per termine:
+    post_doc[term_ptr[t]:term_ptr[t+1]] = chunk che contengono t, post_w = peso BM25."""
+
+    __slots__ = ("version", "chunks", "vocab", "term_ptr", "post_doc", "post_w", "path")
+
+    def __init__(self, version: str, chunks: List[str], vocab: Dict[str, int],
+                 term_ptr: np.ndarray, post_doc: np.ndarray, post_w: np.ndarray,
+                 path: Optional[str] = None):
+        self.version = version
+        self.path = path  # cartella degli array mappati (None = in memoria)
+        self.chunks = chunks
+        self.vocab = vocab
+        self.term_ptr = term_ptr
+        self.post_doc = post_doc
+        self.post_w = post_w
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def search(self, query: str, k: int = 3, min_score: float = 0.0) -> List[Tuple[float, str]]:
+        if not self.chunks:
+            return []
+        cols = {self.vocab[t] for t in _terms(query) if t in self.vocab}
+        if not cols:
+            return []
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        for c in cols:
+            s, e = self.term_ptr[c], self.term_ptr[c + 1]
+            scores[self.post_doc[s:e]] += self.post_w[s:e]  # chunk unici per termine
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), self.chunks[i]) for i in top if scores[i] > 0 and scores[i] >= min_score]
+
+
+def build_index(version: str, docs: Sequence[Tuple[str, str]],
+                mmap_dir: Optional[str] = None) -> KBIndex:
+    """Chunking + indice BM25 (CPU: chiamare fuori dall'event loop).
+    Con `mmap_dir` gli array vengono salvati in una sottocartella nuova di
+    `mmap_dir` e riletti memory-mapped."""
+    chunks = [c for title, content in docs for c in chunk(title, content)]
+    vocab: Dict[str, int] = {}
+    t_ids: List[int] = []
+    d_ids: List[int] = []
+    tfs: List[int] = []
+    dl = np.zeros(len(chunks), dtype=np.float32)
+    for d, c in enumerate(chunks):
+        counts = Counter(_terms(c))
+        dl[d] = sum(counts.values())
+        for term, tf in counts.items():
+            t_ids.append(vocab.setdefault(term, len(vocab)))
+            d_ids.append(d)
+            tfs.append(tf)
+
+    term = np.asarray(t_ids, dtype=np.int32)
+    doc = np.asarray(d_ids, dtype=np.int32)
+    tf = np.asarray(tfs, dtype=np.float32)
+    n = max(len(chunks), 1)
+    df = np.bincount(term, minlength=len(vocab)).astype(np.float32)
+    idf = np.log1p((n - df + 0.5) / (df + 0.5))
+    avgdl = float(dl.mean()) if len(chunks) else 1.0
+    w = idf[term] * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * dl[doc] / max(avgdl, 1e-6)))
+
+    order = np.argsort(term, kind="stable")
+    term_ptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+    np.cumsum(df.astype(np.int64), out=term_ptr[1:])
+    post_doc = doc[order]
+    post_w = w[order].astype(np.float32)
+
+    path = None
+    if mmap_dir:
+        # cartella NUOVA per ogni build: riscrivere file mappati = SIGBUS / punteggi sbagliati
+        os.makedirs(mmap_dir, exist_ok=True)
+        path = tempfile.mkdtemp(prefix="idx_", dir=mmap_dir)
+        for name, arr in (("term_ptr", term_ptr), ("post_doc", post_doc), ("post_w", post_w)):
+            np.save(os.path.join(path, f"{name}.npy"), arr)
+        term_ptr, post_doc, post_w = (
+            np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+            for name in ("term_ptr", "post_doc", "post_w")
+        )
+    return KBIndex(version, chunks, vocab, term_ptr, post_doc, post_w, path)
+
+
+def prune(mmap_dir: str, keep: Optional[str], min_age_sec: float = 300.0) -> int:
+    """Rimuove le build vecchie in `mmap_dir` tranne `keep`, solo dopo lo swap.
+    Su POSIX togliere un file mappato è sicuro (la mappa resta valida finché
+    serve); `min_age_sec` evita di togliere una build appena scritta da un
+    altro processo che non l'ha ancora riletta."""
+    removed = 0
+    try:
+        entries = os.listdir(mmap_dir)
+    except FileNotFoundError:
+        return 0
+    now = time()
+    for name in entries:
+        path = os.path.join(mmap_dir, name)
+        if not name.startswith("idx_") or path == keep:
+            continue
+        try:
+            if now - os.path.getmtime(path) < min_age_sec:
+                continue
+            shutil.rmtree(path)
+            removed += 1
+        except OSError:
+            pass
+    return removed
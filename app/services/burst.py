@@ -0,0 +1,75 @@
+# app/services/burst.py
+# ------------------------------------------------------------
+# Coalescenza dei DM "a raffica": gli utenti IG spesso mandano 3-4 messaggi
+# brevi in pochi secondi. Per ogni thread i testi arrivati dentro la finestra
+# (debounce) si accumulano qui; allo scadere on_due(key) viene chiamato una
+# volta sola e il chiamante prende tutto con pop() -> UNA chiamata LLM.
+# La finestra si allunga a ogni messaggio, ma mai oltre max_wait dal primo.
+# Allo shutdown flush_all() chiude subito tutte le raffiche aperte.
+# ------------------------------------------------------------
+import asyncio
+from time import monotonic
+from typing import Any, Callable, Dict, List, Optional
+
+from app.services import metrics
+
+_BUFS: Dict[str, Dict[str, Any]] = {}
+
+
+def add(key: str, text_msg: str, window: float, max_wait: float,
+        on_due: Callable[[str], None], meta: Optional[Dict[str, Any]] = None) -> bool:
+    """Accoda il testo per il thread `key`. True se apre una nuova raffica."""
+    loop = asyncio.get_running_loop()
+    now = monotonic()
+    buf = _BUFS.get(key)
+    first = buf is None
+    if first:
+        buf = _BUFS[key] = {"texts": [], "first_at": now, "timer": None, "meta": meta or {}}
+    else:
+        metrics.incr("burst.coalesced")
+    buf["texts"].append(text_msg)
+    if buf["timer"] is not None:
+        buf["timer"].cancel()
+    delay = max(0.0, min(window, buf["first_at"] + max_wait - now))
+    buf["timer"] = loop.call_later(delay, _fire, key, on_due)
+    return first
+
+
+def _fire(key: str, on_due: Callable[[str], None]) -> None:
+    buf = _BUFS.get(key)
+    if buf is not None:
+        buf["timer"] = None
+    on_due(key)
+
+
+def pop(key: str) -> Optional[Dict[str, Any]]:
+    """Rimuove e ritorna la raffica ({"texts", "meta", ...}) se c'è."""
+    buf = _BUFS.pop(key, None)
+    if buf is not None and buf["timer"] is not None:
+        buf["timer"].cancel()
+    if buf is not None:
+        metrics.incr("burst.flushed")
+    return buf
+
+
+def flush_all(on_due: Callable[[str], None]) -> int:
+    """Chiude subito tutte le raffiche aperte (shutdown): on_due(key) per ognuna."""
+    keys = list(_BUFS)
+    for key in keys:
+        buf = _BUFS[key]
+        if buf["timer"] is not None:
+            buf["timer"].cancel()
+            buf["timer"] = None
+        on_due(key)
+    return len(keys)
+
+
+def pending(key: str) -> bool:
+    return key in _BUFS
+
+
+def join(texts: List[str]) -> str:
+    return "\n".join(t.strip() for t in texts if t and t.strip())
+
+
+metrics.register_gauge("burst.open", lambda: len(_BUFS))
@@ -0,0 +1,159 @@
+# app/services/circuit.py
+# ------------------------------------------------------------
+# Circuit breaker + timeout adattivo per upstream ("openai", "graph").
+# - closed: tutto passa; esiti e latenze delle ultime CIRCUIT_WINDOW_SEC
+#   aprono il circuito se, con almeno CIRCUIT_MIN_CALLS chiamate, la quota
+#   di errori (eccezioni, 5xx, 429) supera CIRCUIT_ERROR_RATE oppure quella
+#   di chiamate lente (oltre CIRCUIT_<NOME>_SLOW_MS) supera CIRCUIT_SLOW_RATE
+# - open: le chiamate vengono rifiutate subito (il chiamante usa il fallback)
+#   per CIRCUIT_OPEN_SEC
+# - half_open: passa UNA chiamata di prova; ok -> closed, errore -> open
+# Timeout di lettura = p99 delle latenze recenti x CIRCUIT_TIMEOUT_FACTOR,
+# limitato tra min e max dell'upstream (max = il vecchio timeout fisso).
+# ------------------------------------------------------------
+import os
+import logging
+from collections import deque
+from time import monotonic
+from typing import Deque, Dict, Tuple
+
+import httpx
+
+from app.services import metrics
+
+logger = logging.getLogger("circuit")
+
+WINDOW_SEC     = float(os.getenv("CIRCUIT_WINDOW_SEC", "30"))
+MIN_CALLS      = int(os.getenv("CIRCUIT_MIN_CALLS", "10"))
+ERROR_RATE     = float(os.getenv("CIRCUIT_ERROR_RATE", "0.5"))
+SLOW_RATE      = float(os.getenv("CIRCUIT_SLOW_RATE", "0.8"))
+OPEN_SEC       = float(os.getenv("CIRCUIT_OPEN_SEC", "20"))
+TIMEOUT_FACTOR = float(os.getenv("CIRCUIT_TIMEOUT_FACTOR", "2.0"))
+TIMEOUT_MIN_SAMPLES = int(os.getenv("CIRCUIT_TIMEOUT_MIN_SAMPLES", "20"))
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+# nome -> (read timeout min, read timeout max, connect timeout) in secondi, soglia "lenta" in ms
+_LIMITS: Dict[str, Tuple[float, float, float, float]] = {
+    "openai": (float(os.getenv("CIRCUIT_OPENAI_TIMEOUT_MIN", "4")),
+               float(os.getenv("CIRCUIT_OPENAI_TIMEOUT_MAX", "12")), 6.0,
+               float(os.getenv("CIRCUIT_OPENAI_SLOW_MS", "8000"))),
+    "graph":  (float(os.getenv("CIRCUIT_GRAPH_TIMEOUT_MIN", "2")),
+               float(os.getenv("CIRCUIT_GRAPH_TIMEOUT_MAX", "12")), 6.0,
+               float(os.getenv("CIRCUIT_GRAPH_SLOW_MS", "4000"))),
+}
+
+
+class Breaker:
+    __slots__ = ("name", "state", "opened_at", "probing", "calls")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probing = False
+        self.calls: Deque[Tuple[float, bool, bool]] = deque()  # (t, ok, lenta)
+
+    def _trim(self, now: float) -> None:
+        while self.calls and now - self.calls[0][0] > WINDOW_SEC:
+            self.calls.popleft()
+
+    def _probe_due(self, now: float) -> bool:
+        # open scaduto, oppure prova half-open rimasta appesa (cancellata senza esito)
+        return now - self.opened_at >= OPEN_SEC
+
+    def available(self) -> bool:
+        """True se una chiamata potrebbe partire ora (senza prenotare la prova half-open)."""
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and not self.probing:
+            return True
+        return self._probe_due(monotonic())
+
+    def allow(self) -> bool:
+        """Da chiamare prima della richiesta: False = circuito aperto, non chiamare."""
+        if self.state == CLOSED:
+            return True
+        now = monotonic()
+        if self.state == OPEN and self._probe_due(now):
+            self.state = HALF_OPEN
+            self.probing = False
+        if self.state == HALF_OPEN and (not self.probing or self._probe_due(now)):
+            self.probing = True
+            self.opened_at = now
+            return True
+        metrics.incr(f"circuit.{self.name}.rejected")
+        return False
+
+    def record(self, ok: bool, latency_ms: float) -> None:
+        now = monotonic()
+        slow = latency_ms >= _LIMITS[self.name][3]
+        if ok:
+            metrics.observe(f"circuit.{self.name}.latency_ms", latency_ms)
+        else:
+            metrics.incr(f"circuit.{self.name}.errors")
+        if self.state == HALF_OPEN:
+            self.probing = False
+            if ok and not slow:
+                self._close()
+            else:
+                self._open(now, "probe fallita")
+            return
+        self.calls.append((now, ok, slow))
+        self._trim(now)
+        if self.state == CLOSED and len(self.calls) >= MIN_CALLS:
+            n = len(self.calls)
+            errors = sum(1 for _, o, _ in self.calls if not o)
+            slows = sum(1 for _, _, s in self.calls if s)
+            if errors / n >= ERROR_RATE:
+                self._open(now, f"errori {errors}/{n}")
+            elif slows / n >= SLOW_RATE:
+                self._open(now, f"lente {slows}/{n}")
+
+    def _open(self, now: float, why: str) -> None:
+        self.state = OPEN
+        self.opened_at = now
+        self.calls.clear()
+        metrics.incr(f"circuit.{self.name}.opened")
+        logger.warning("circuit %s OPEN (%s) per %.0fs", self.name, why, OPEN_SEC)
+
+    def _close(self) -> None:
+        self.state = CLOSED
+        self.calls.clear()
+        logger.info("circuit %s CLOSED", self.name)
+
+    def timeout(self) -> httpx.Timeout:
+        """Timeout di lettura dal p99 recente, tra min e max dell'upstream."""
+        lo, hi, connect, _ = _LIMITS[self.name]
+        metric = f"circuit.{self.name}.latency_ms"
+        read = hi
+        if metrics.samples(metric) >= TIMEOUT_MIN_SAMPLES:
+            p99 = metrics.percentile(metric, 0.99)
+            if p99 is not None:
+                read = min(hi, max(lo, p99 / 1000.0 * TIMEOUT_FACTOR))
+        return httpx.Timeout(read, connect=min(connect, read))
+
+    def stats(self) -> dict:
+        self._trim(monotonic())
+        n = len(self.calls)
+        return {
+            "state": self.state,
+            "calls": n,
+            "error_rate": round(sum(1 for _, o, _ in self.calls if not o) / n, 3) if n else None,
+            "read_timeout_s": round(self.timeout().read, 2),
+        }
+
+
+_BREAKERS: Dict[str, Breaker] = {name: Breaker(name) for name in _LIMITS}
+
+
+def get(name: str) -> Breaker:
+    return _BREAKERS[name]
+
+
+def failed_status(status_code: int) -> bool:
+    """Esiti che indicano un upstream in difficoltà (i 4xx sono errori NOSTRI, non suoi)."""
+    return status_code >= 500 or status_code == 429
+
+
+metrics.register_gauge("circuits", lambda: {name: b.stats() for name, b in _BREAKERS.items()})
@@ -0,0 +1,78 @@
+# app/services/client_cache.py
+# ------------------------------------------------------------
+# Cache per cliente di oggetti costruiti da una tabella mfai_app.<tabella>
+# (indice KB, automa dei trigger...), ricostruiti solo quando i dati cambiano:
+# - versione economica (count, max(id), max(updated_at)) ricontrollata al più
+#   ogni check_sec; invalidate() locale forza il controllo al prossimo get()
+# - un lock per cliente: richieste concorrenti fanno UNA ricostruzione
+# ------------------------------------------------------------
+import asyncio
+from time import monotonic
+from typing import Awaitable, Callable, Dict, Generic, ItemsView, List, Optional, TypeVar
+
+from sqlalchemy import text
+
+from app.db import engine
+
+T = TypeVar("T")
+
+# build(client_id, versione) -> oggetto nuovo; swapped(client_id, nuovo) dopo la sostituzione
+Build = Callable[[int, str], Awaitable[T]]
+Swapped = Callable[[int, T], Awaitable[None]]
+
+
+class VersionedCache(Generic[T]):
+    def __init__(self, table: str, check_sec: float, build: Build,
+                 swapped: Optional[Swapped] = None):
+        self.check_sec = check_sec
+        self._build = build
+        self._swapped = swapped
+        self._version_sql = text(f"""
+            SELECT count(*) AS n, COALESCE(max(id), 0) AS max_id,
+                   COALESCE(EXTRACT(EPOCH FROM max(updated_at)), 0) AS upd
+            FROM mfai_app.{table}
+            WHERE client_id = :c
+        """)
+        self._items: Dict[int, T] = {}
+        self._meta: Dict[int, List] = {}  # client_id -> [versione, controllato_at]
+        self._locks: Dict[int, asyncio.Lock] = {}
+
+    async def _db_version(self, client_id: int) -> str:
+        async with engine.connect() as conn:
+            r = (await conn.execute(self._version_sql, {"c": client_id})).mappings().one()
+        return f"{r['n']}:{r['max_id']}:{float(r['upd']):.3f}"
+
+    def _fresh(self, client_id: int) -> bool:
+        meta = self._meta.get(client_id)
+        return meta is not None and monotonic() - meta[1] < self.check_sec
+
+    async def get(self, client_id: int) -> T:
+        """Oggetto del cliente; ricostruito se la versione in DB è cambiata."""
+        if self._fresh(client_id):
+            return self._items[client_id]
+        async with self._locks.setdefault(client_id, asyncio.Lock()):
+            if self._fresh(client_id):
+                return self._items[client_id]
+            version = await self._db_version(client_id)
+            meta = self._meta.get(client_id)
+            if meta is not None and meta[0] == version:
+                meta[1] = monotonic()
+                return self._items[client_id]
+            obj = await self._build(client_id, version)
+            self._items[client_id] = obj
+            self._meta[client_id] = [version, monotonic()]
+            if self._swapped is not None:
+                await self._swapped(client_id, obj)
+            return obj
+
+    def invalidate(self, client_id: int) -> None:
+        """Dopo una modifica dall'admin: il prossimo get() ricontrolla la versione."""
+        meta = self._meta.get(client_id)
+        if meta is not None:
+            meta[1] = 0.0
+
+    def items(self) -> ItemsView[int, T]:
+        return self._items.items()
+
+    def __len__(self) -> int:
+        return len(self._items)
@@ -2,6 +2,7 @@ import os, time, asyncio
 from typing import Dict
 from sqlalchemy import text
 from app.db import engine
+from app.services import tenant_registry
 
 _TTL = float(os.getenv("PROMPTS_CACHE_TTL", "60"))
 _CACHE: Dict[int, Dict[str, str]] = {}
@@ -76,4 +77,5 @@ async def upsert_prompt_for_client(client_id: int, key: str, value: str) -> str:
             DO UPDATE SET value = EXCLUDED.value, updated_at = now()
         """), {"cid": client_id, "k": k, "v": v})
     await _refresh(client_id)
+    tenant_registry.invalidate(client_id=client_id)
     return k
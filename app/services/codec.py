@@ -0,0 +1,27 @@
+# app/services/codec.py
+# ------------------------------------------------------------
+# JSON veloce per il percorso caldo del webhook: orjson se installato,
+# altrimenti json standard (stesso comportamento, solo più lento).
+# ------------------------------------------------------------
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - dipendenza opzionale
+    orjson = None
+
+
+def loads(data: Union[bytes, bytearray, memoryview, str]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = bytes(data).decode("utf-8")
+    return json.loads(data)
+
+
+def dumps(obj: Any) -> str:
+    """Serializza in str (UTF-8, niente escape ASCII), pronto per colonne TEXT."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, default=str)
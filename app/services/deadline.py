@@ -0,0 +1,101 @@
+# app/services/deadline.py
+# ------------------------------------------------------------
+# Budget di tempo end-to-end per ogni evento, dalla ricezione del webhook.
+# - Deadline(received_at): scadenza = ricezione + REPLY_DEADLINE_SEC
+#   (per cliente: setting REPLY_DEADLINE_SEC in client_prompts)
+# - bind(): la scadenza viaggia in un ContextVar, così i helper HTTP in fondo
+#   alla catena (OpenAI, Graph) la leggono senza passarla a mano; i task
+#   creati da lì (typing, hedge) ereditano il contesto
+# - fit(): ogni stadio stringe il proprio timeout al budget residuo
+# - can_afford(): se il budget non copre una chiamata LLM + l'invio,
+#   il chiamante manda subito la risposta statica
+# - stage(): tempo speso per stadio (metriche + log OUT)
+# ------------------------------------------------------------
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import monotonic, time
+from typing import Dict, Iterator, Optional
+
+import httpx
+
+from app.services import metrics
+
+BUDGET_SEC       = float(os.getenv("REPLY_DEADLINE_SEC", "20"))
+LLM_MIN_SEC      = float(os.getenv("DEADLINE_LLM_MIN_SEC", "3"))    # sotto: niente LLM
+SEND_RESERVE_SEC = float(os.getenv("DEADLINE_SEND_RESERVE_SEC", "2"))  # tenuti per l'invio
+MIN_TIMEOUT_SEC  = float(os.getenv("DEADLINE_MIN_TIMEOUT_SEC", "1"))   # mai timeout più corti
+LOOKUP_MAX_SEC   = float(os.getenv("DEADLINE_LOOKUP_MAX_SEC", "2"))     # letture DB prima dell'LLM
+
+_CURRENT: ContextVar[Optional["Deadline"]] = ContextVar("mfai_deadline", default=None)
+
+
+class Deadline:
+    __slots__ = ("received_at", "at", "stages")
+
+    def __init__(self, received_at: Optional[float] = None, budget: float = BUDGET_SEC):
+        # received_at è un epoch (time()) salvato in coda: la scadenza resta in epoch
+        self.received_at = received_at or time()
+        self.at = self.received_at + budget
+        self.stages: Dict[str, float] = {}
+
+    def set_budget(self, budget: float) -> None:
+        self.at = self.received_at + budget
+
+    def remaining(self) -> float:
+        return self.at - time()
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def can_afford(self, need_sec: float) -> bool:
+        """C'è tempo per uno stadio da `need_sec` secondi lasciando la riserva per l'invio?"""
+        return self.remaining() - SEND_RESERVE_SEC >= need_sec
+
+    def timeout(self, cap: float, reserve: float = 0.0) -> float:
+        return max(MIN_TIMEOUT_SEC, min(cap, self.remaining() - reserve))
+
+    def mark(self, name: str, t0: float) -> None:
+        """Tempo dello stadio `name` iniziato a monotonic() == t0."""
+        ms = (monotonic() - t0) * 1000.0
+        self.stages[name] = round(self.stages.get(name, 0.0) + ms, 1)
+        metrics.observe(f"stage.{name}_ms", ms)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        t0 = monotonic()
+        try:
+            yield
+        finally:
+            self.mark(name, t0)
+
+    def finish(self) -> None:
+        metrics.observe("stage.total_ms", (time() - self.received_at) * 1000.0)
+        if self.expired():
+            metrics.incr("deadline.missed")
+
+
+def current() -> Optional[Deadline]:
+    return _CURRENT.get()
+
+
+@contextmanager
+def bind(dl: Deadline) -> Iterator[Deadline]:
+    """Rende `dl` la scadenza corrente per il blocco (e per i task creati dentro)."""
+    token = _CURRENT.set(dl)
+    try:
+        yield dl
+    finally:
+        _CURRENT.reset(token)
+
+
+def fit(base: httpx.Timeout, reserve: float = 0.0) -> httpx.Timeout:
+    """`base` stretto al budget residuo della scadenza corrente (invariato se non ce n'è una)."""
+    dl = _CURRENT.get()
+    if dl is None:
+        return base
+
+    def _cap(v: Optional[float]) -> Optional[float]:
+        return dl.timeout(v if v is not None else BUDGET_SEC, reserve)
+    return httpx.Timeout(connect=_cap(base.connect), read=_cap(base.read),
+                         write=_cap(base.write), pool=_cap(base.pool))
@@ -0,0 +1,57 @@
+# app/services/dedup.py
+# ------------------------------------------------------------
+# Idempotenza del webhook Meta: Meta ri-consegna gli eventi che considera
+# lenti. Qui teniamo un insieme limitato (LRU) degli id visti di recente;
+# la garanzia "forte" tra istanze/restart è l'indice UNIQUE su
+# mfai_app.inbound_events(dedup_key).
+# ------------------------------------------------------------
+import os
+import hashlib
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from app.services import codec, metrics
+
+_MAX = int(os.getenv("WEBHOOK_DEDUP_MAX", "20000"))
+_SEEN: "OrderedDict[str, None]" = OrderedDict()
+
+
+def event_key(ig_user_id: str, entry_time: Any, evt: Dict[str, Any]) -> Optional[str]:
+    """message.mid quando c'è; altrimenti timestamp entry/evento + mittente + contenuto
+    (due messaggi diversi nello stesso istante restano distinti).
+    None = evento non deduplicabile (nessun identificativo stabile)."""
+    message = evt.get("message")
+    mid = message.get("mid") if isinstance(message, dict) else None
+    if mid:
+        return f"{ig_user_id}:mid:{mid}"
+    ts = evt.get("timestamp") or entry_time
+    if not ts:
+        return None
+    sender = str((evt.get("sender") or {}).get("id") or "")
+    # contenuto dell'evento (testo, allegati, postback...): una ri-consegna è identica
+    body = codec.dumps({k: evt[k] for k in sorted(evt) if k not in ("sender", "recipient", "timestamp")})
+    h = hashlib.sha1(f"{ig_user_id}|{ts}|{sender}|{body}".encode("utf-8")).hexdigest()[:20]
+    return f"{ig_user_id}:ts:{h}"
+
+
+def seen(key: Optional[str]) -> bool:
+    """True se la chiave è già passata di recente; altrimenti la registra."""
+    if key is None:
+        return False
+    if key in _SEEN:
+        _SEEN.move_to_end(key)
+        metrics.incr("webhook.dedup.dropped_memory")
+        return True
+    _SEEN[key] = None
+    if len(_SEEN) > _MAX:
+        _SEEN.popitem(last=False)
+    return False
+
+
+def forget(key: Optional[str]) -> None:
+    """Da usare se l'evento non è stato accettato (es. 503): la ri-consegna deve passare."""
+    if key is not None:
+        _SEEN.pop(key, None)
+
+
+metrics.register_gauge("webhook.dedup.recent_ids", lambda: len(_SEEN))
@@ -0,0 +1,110 @@
+# app/services/hedge.py
+# ------------------------------------------------------------
+# Richieste "hedged" verso l'LLM (opt-in): se la prima chiamata non ha
+# risposto entro una soglia adattiva (percentile HEDGE_PERCENTILE delle
+# latenze recenti della stessa route, mai sotto HEDGE_MIN_MS) ne parte una
+# seconda identica; vince la prima risposta valida, l'altra viene cancellata.
+# - niente hedge finché non ci sono HEDGE_MIN_SAMPLES latenze osservate
+# - tetto: al massimo HEDGE_MAX_RATE hedge per chiamata nella finestra
+#   HEDGE_WINDOW_SEC, così un rallentamento generale non raddoppia il carico
+# ------------------------------------------------------------
+import os
+import asyncio
+from collections import deque
+from time import monotonic
+from typing import Awaitable, Callable, Deque, Optional, TypeVar
+
+from app.services import metrics
+
+ENABLED      = os.getenv("LLM_HEDGE_ENABLED", "false").lower() == "true"
+PERCENTILE   = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+MIN_MS       = float(os.getenv("HEDGE_MIN_MS", "1500"))
+MIN_SAMPLES  = int(os.getenv("HEDGE_MIN_SAMPLES", "50"))
+MAX_RATE     = float(os.getenv("HEDGE_MAX_RATE", "0.1"))
+WINDOW_SEC   = float(os.getenv("HEDGE_WINDOW_SEC", "60"))
+
+T = TypeVar("T")
+
+_CALLS: Deque[float] = deque()
+_HEDGES: Deque[float] = deque()
+
+
+def _trim(now: float) -> None:
+    for q in (_CALLS, _HEDGES):
+        while q and now - q[0] > WINDOW_SEC:
+            q.popleft()
+
+
+def threshold_ms(latency_metric: str) -> Optional[float]:
+    """Soglia oltre cui partire con la seconda richiesta; None = dati insufficienti."""
+    if metrics.samples(latency_metric) < MIN_SAMPLES:
+        return None
+    p = metrics.percentile(latency_metric, PERCENTILE)
+    return max(MIN_MS, p) if p is not None else None
+
+
+def _allow(now: float) -> bool:
+    _trim(now)
+    return len(_HEDGES) + 1 <= MAX_RATE * max(len(_CALLS), 1)
+
+
+async def _cancel(task: asyncio.Task) -> None:
+    task.cancel()
+    try:
+        await task
+    except BaseException:
+        pass
+
+
+async def call(make: Callable[[], Awaitable[T]], latency_metric: str) -> T:
+    """Esegue make(); dopo la soglia adattiva lancia un secondo make() e tiene il primo che risponde.
+    Se una delle due fallisce si aspetta l'altra; se falliscono entrambe si rilancia il primo errore."""
+    now = monotonic()
+    _CALLS.append(now)
+    metrics.incr("llm.hedge.calls")
+    limit = threshold_ms(latency_metric)
+    primary = asyncio.ensure_future(make())
+    if limit is None:
+        return await primary
+
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=limit / 1000.0)
+        if done:
+            return primary.result()
+        if not _allow(monotonic()):
+            metrics.incr("llm.hedge.capped")
+            return await primary
+        _HEDGES.append(monotonic())
+        metrics.incr("llm.hedge.fired")
+        secondary = asyncio.ensure_future(make())
+    except BaseException:
+        await _cancel(primary)
+        raise
+
+    pending = {primary, secondary}
+    first_error: Optional[BaseException] = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    metrics.incr("llm.hedge.won" if task is secondary else "llm.hedge.primary_won")
+                    return task.result()
+                first_error = first_error or task.exception()
+        raise first_error  # entrambe fallite
+    finally:
+        for task in pending:
+            await _cancel(task)
+
+
+def _stats() -> dict:
+    _trim(monotonic())
+    return {
+        "enabled": ENABLED,
+        "window_calls": len(_CALLS),
+        "window_hedges": len(_HEDGES),
+        "rate": round(len(_HEDGES) / len(_CALLS), 3) if _CALLS else None,
+    }
+
+
+metrics.register_gauge("llm.hedge", _stats)
@@ -1,19 +1,116 @@
+# app/services/http.py
+# ------------------------------------------------------------
+# Registry dei client HTTP in uscita: UN AsyncClient long-lived per upstream
+# ("openai", "graph", "self"), ognuno con i suoi limiti di pool e keep-alive.
+# - HTTP/2 solo se il pacchetto h2 è installato (e HTTP2_ENABLED non è "false")
+# - metriche per host: richieste, connessioni TCP/TLS aperte, tempo alla
+#   risposta (ttfb) e stato dei pool su /__metrics
+# Tutte le chiamate in uscita passano da client(nome): niente handshake TLS
+# pagato a ogni messaggio.
+# ------------------------------------------------------------
+import os
+import importlib.util
+from time import monotonic
+from typing import Dict, Optional
+
 import httpx
 
-_client = None
+from app.services import metrics
 
-def get_client() -> httpx.AsyncClient:
-    global _client
-    if _client is None:
-        _client = httpx.AsyncClient(
-            http2=True,
-            timeout=httpx.Timeout(8.0, read=30.0),
-            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "true").lower() == "true" and \
+    importlib.util.find_spec("h2") is not None
+
+# nome -> (timeout, limiti pool, http2)
+_UPSTREAMS: Dict[str, tuple] = {
+    "openai": (
+        httpx.Timeout(30.0, connect=6.0),
+        httpx.Limits(max_connections=int(os.getenv("HTTP_OPENAI_MAX_CONN", "64")),
+                     max_keepalive_connections=32, keepalive_expiry=60.0),
+        True,
+    ),
+    "graph": (
+        httpx.Timeout(12.0, connect=6.0),
+        httpx.Limits(max_connections=int(os.getenv("HTTP_GRAPH_MAX_CONN", "64")),
+                     max_keepalive_connections=32, keepalive_expiry=60.0),
+        True,
+    ),
+    # chiamate verso la nostra stessa app (es. /save-token): uvicorn parla solo HTTP/1.1
+    "self": (
+        httpx.Timeout(15.0, connect=5.0),
+        httpx.Limits(max_connections=10, max_keepalive_connections=5, keepalive_expiry=30.0),
+        False,
+    ),
+}
+
+_CLIENTS: Dict[str, httpx.AsyncClient] = {}
+
+
+def _tracer(host: str):
+    async def trace(event: str, info: dict) -> None:
+        # eventi httpcore: conta solo le connessioni nuove (il costo che vogliamo evitare)
+        if event == "connection.connect_tcp.complete":
+            metrics.incr(f"http.{host}.connect")
+        elif event == "connection.start_tls.complete":
+            metrics.incr(f"http.{host}.tls_handshake")
+    return trace
+
+
+async def _on_request(request: httpx.Request) -> None:
+    host = request.url.host
+    metrics.incr(f"http.{host}.requests")
+    request.extensions["trace"] = _tracer(host)
+    request.extensions["mfai_t0"] = monotonic()
+
+
+async def _on_response(response: httpx.Response) -> None:
+    request = response.request
+    host = request.url.host
+    t0 = request.extensions.get("mfai_t0")
+    if t0 is not None:
+        metrics.observe(f"http.{host}.ttfb_ms", (monotonic() - t0) * 1000.0)
+    metrics.incr(f"http.{host}.{response.status_code // 100}xx")
+
+
+def client(name: str) -> httpx.AsyncClient:
+    """Client condiviso per l'upstream `name` ("openai" | "graph" | "self")."""
+    c = _CLIENTS.get(name)
+    if c is None or c.is_closed:
+        timeout, limits, h2 = _UPSTREAMS[name]
+        c = _CLIENTS[name] = httpx.AsyncClient(
+            http2=h2 and HTTP2_ENABLED,
+            timeout=timeout,
+            limits=limits,
+            event_hooks={"request": [_on_request], "response": [_on_response]},
         )
-    return _client
+    return c
+
+
+def get_client() -> httpx.AsyncClient:
+    """Compatibilità: client OpenAI."""
+    return client("openai")
+
+
+async def close_all() -> None:
+    for name in list(_CLIENTS):
+        c = _CLIENTS.pop(name)
+        await c.aclose()
+
+
+async def close_client() -> None:
+    await close_all()
+
+
+def _pool_stats(c: httpx.AsyncClient) -> Optional[dict]:
+    # pool httpcore: attributi interni, letti solo per le metriche
+    pool = getattr(getattr(c, "_transport", None), "_pool", None)
+    conns = getattr(pool, "connections", None)
+    if conns is None:
+        return None
+    idle = sum(1 for x in conns if x.is_idle())
+    return {"connections": len(conns), "idle": idle, "active": len(conns) - idle}
+
 
-async def close_client():
-    global _client
-    if _client is not None:
-        await _client.aclose()
-        _client = None
+metrics.register_gauge("http.pools", lambda: {
+    name: {"http2": HTTP2_ENABLED and _UPSTREAMS[name][2], "pool": _pool_stats(c)}
+    for name, c in _CLIENTS.items()
+})
@@ -0,0 +1,232 @@
+# app/services/inbound_queue.py
+# ------------------------------------------------------------
+# Coda persistente degli eventi webhook su Postgres (mfai_app.inbound_events).
+# - il receiver scrive gli eventi UNA volta (un solo INSERT multi-riga)
+# - ogni istanza ha un poller che reclama lotti con FOR UPDATE SKIP LOCKED
+#   e li passa al worker_pool locale
+# - visibility timeout: un evento "processing" con locked_until scaduto
+#   (istanza morta / deploy) torna reclamabile; dopo MAX_ATTEMPTS -> 'dead'
+# - ordine per thread anche tra istanze: un evento non è reclamabile finché
+#   esiste un evento precedente dello stesso thread ancora pending/processing
+# - received_at (da cui partono budget di coda e scadenza della risposta) è
+#   created_at al primo tentativo; su un evento riconsegnato (crash, visibility
+#   timeout, retry) è l'istante del reclamo, altrimenti arriverebbe già scaduto
+#   e finirebbe sempre nella risposta statica
+# ------------------------------------------------------------
+import os
+import socket
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlalchemy import text
+
+from app.db import engine
+from app.services import codec, metrics
+
+logger = logging.getLogger("inbound_queue")
+
+ENABLED        = os.getenv("INBOUND_QUEUE", "db").lower() == "db"
+VISIBILITY_SEC = float(os.getenv("INBOUND_VISIBILITY_SEC", "120"))
+MAX_ATTEMPTS   = int(os.getenv("INBOUND_MAX_ATTEMPTS", "5"))
+POLL_SEC       = float(os.getenv("INBOUND_POLL_SEC", "2"))
+CLAIM_BATCH    = int(os.getenv("INBOUND_CLAIM_BATCH", "32"))
+RETENTION_H    = int(os.getenv("INBOUND_RETENTION_HOURS", "48"))
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# submit(row) -> bool: consegna al pool locale (False = pool pieno)
+Submit = Callable[[Dict[str, Any]], bool]
+
+_TASK: Optional[asyncio.Task] = None
+_WAKE: Optional[asyncio.Event] = None
+_LAST_PURGE = 0.0
+
+_INSERT_SQL = text("""
+    INSERT INTO mfai_app.inbound_events (ig_user_id, thread_key, payload, dedup_key)
+    SELECT * FROM unnest(CAST(:ig AS text[]), CAST(:k AS text[]), CAST(:p AS text[]), CAST(:d AS text[]))
+    ON CONFLICT (dedup_key) DO NOTHING
+    RETURNING id
+""")
+
+_CLAIM_SQL = text("""
+    UPDATE mfai_app.inbound_events e
+    SET status = 'processing',
+        attempts = e.attempts + 1,
+        locked_until = now() + make_interval(secs => :vis),
+        locked_by = :me
+    WHERE e.id IN (
+        SELECT c.id
+        FROM mfai_app.inbound_events c
+        WHERE ((c.status = 'pending' AND c.available_at <= now())
+            OR (c.status = 'processing' AND c.locked_until < now()))
+          AND NOT EXISTS (
+            SELECT 1 FROM mfai_app.inbound_events p
+            WHERE p.thread_key = c.thread_key
+              AND p.id < c.id
+              AND p.status IN ('pending', 'processing')
+          )
+        ORDER BY c.id
+        LIMIT :n
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING e.id, e.ig_user_id, e.thread_key, e.payload, e.attempts,
+              EXTRACT(EPOCH FROM CASE WHEN e.attempts > 1 THEN now() ELSE e.created_at END)
+                  AS received_at
+""")
+
+
+async def enqueue(items: List[Dict[str, Any]]) -> int:
+    """Persiste gli eventi normalizzati ({"ig_user_id","evt","raw","key","dedup"}) in un solo
+    round trip. Ritorna quanti erano nuovi: i dedup_key già presenti vengono scartati."""
+    if not items:
+        return 0
+    params = {
+        "ig": [i["ig_user_id"] for i in items],
+        "k":  [i["key"] for i in items],
+        "p":  [i.get("raw") or codec.dumps(i["evt"]) for i in items],
+        "d":  [i.get("dedup") for i in items],
+    }
+    async with engine.begin() as conn:
+        inserted = len((await conn.execute(_INSERT_SQL, params)).all())
+    metrics.incr("inbound.enqueued", inserted)
+    if inserted < len(items):
+        metrics.incr("webhook.dedup.dropped_db", len(items) - inserted)
+    if inserted:
+        wake()
+    return inserted
+
+
+async def claim(limit: int) -> List[Dict[str, Any]]:
+    async with engine.begin() as conn:
+        rows = (await conn.execute(_CLAIM_SQL, {
+            "vis": VISIBILITY_SEC, "me": WORKER_ID, "n": limit,
+        })).mappings().all()
+    out: List[Dict[str, Any]] = []
+    for r in sorted(rows, key=lambda r: r["id"]):
+        if r["attempts"] > MAX_ATTEMPTS:
+            await _set_dead(r["id"], "max attempts")
+            continue
+        out.append({
+            "qid": r["id"],
+            "ig_user_id": r["ig_user_id"],
+            "key": r["thread_key"],
+            "evt": codec.loads(r["payload"]),
+            "raw": r["payload"],
+            "attempts": r["attempts"],
+            "received_at": float(r["received_at"]),
+        })
+    if out:
+        metrics.incr("inbound.claimed", len(out))
+    return out
+
+
+async def ack(qid: int) -> None:
+    q = text("""
+        UPDATE mfai_app.inbound_events
+        SET status = 'done', locked_until = NULL
+        WHERE id = :id AND locked_by = :me
+    """)
+    async with engine.begin() as conn:
+        await conn.execute(q, {"id": qid, "me": WORKER_ID})
+    metrics.incr("inbound.done")
+    # il prossimo evento dello stesso thread ora è reclamabile
+    wake()
+
+
+async def fail(qid: int, error: str, attempts: int) -> None:
+    """Ritorna l'evento in coda con backoff esponenziale (o 'dead' a fine tentativi)."""
+    if attempts >= MAX_ATTEMPTS:
+        await _set_dead(qid, error)
+        return
+    q = text("""
+        UPDATE mfai_app.inbound_events
+        SET status = 'pending', locked_until = NULL, last_error = :err,
+            available_at = now() + make_interval(secs => :backoff)
+        WHERE id = :id AND locked_by = :me
+    """)
+    async with engine.begin() as conn:
+        await conn.execute(q, {"id": qid, "me": WORKER_ID, "err": error[:2000],
+                               "backoff": float(min(300, 2 ** attempts))})
+    metrics.incr("inbound.retried")
+
+
+async def release(qid: int) -> None:
+    """Restituisce un evento reclamato ma non consegnabile (pool pieno), senza contare il tentativo."""
+    q = text("""
+        UPDATE mfai_app.inbound_events
+        SET status = 'pending', locked_until = NULL, attempts = GREATEST(attempts - 1, 0)
+        WHERE id = :id AND locked_by = :me
+    """)
+    async with engine.begin() as conn:
+        await conn.execute(q, {"id": qid, "me": WORKER_ID})
+
+
+async def _set_dead(qid: int, error: str) -> None:
+    q = text("""
+        UPDATE mfai_app.inbound_events
+        SET status = 'dead', locked_until = NULL, last_error = :err
+        WHERE id = :id
+    """)
+    async with engine.begin() as conn:
+        await conn.execute(q, {"id": qid, "err": error[:2000]})
+    metrics.incr("inbound.dead")
+    logger.error("inbound event %s dead: %s", qid, error)
+
+
+async def _purge() -> None:
+    q = text("""
+        DELETE FROM mfai_app.inbound_events
+        WHERE status = 'done' AND created_at < now() - make_interval(hours => :h)
+    """)
+    async with engine.begin() as conn:
+        await conn.execute(q, {"h": RETENTION_H})
+
+
+def wake() -> None:
+    if _WAKE is not None:
+        _WAKE.set()
+
+
+def start(submit: Submit, capacity: Callable[[], int]) -> None:
+    """Avvia il poller (idempotente). `capacity()` = quanti eventi il pool può ancora prendere."""
+    global _TASK, _WAKE
+    if not ENABLED or _TASK is not None:
+        return
+    _WAKE = asyncio.Event()
+    _TASK = asyncio.create_task(_poll_loop(submit, capacity), name="inbound-poller")
+    logger.info("inbound queue poller started (%s)", WORKER_ID)
+
+
+async def stop() -> None:
+    global _TASK, _WAKE
+    if _TASK is None:
+        return
+    _TASK.cancel()
+    await asyncio.gather(_TASK, return_exceptions=True)
+    _TASK = None
+    _WAKE = None
+
+
+async def _poll_loop(submit: Submit, capacity: Callable[[], int]) -> None:
+    global _LAST_PURGE
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await asyncio.wait_for(_WAKE.wait(), timeout=POLL_SEC)
+        except asyncio.TimeoutError:
+            pass
+        _WAKE.clear()
+        try:
+            n = min(CLAIM_BATCH, capacity())
+            if n > 0:
+                for row in await claim(n):
+                    if not submit(row):
+                        await release(row["qid"])
+            if loop.time() - _LAST_PURGE > 3600:
+                _LAST_PURGE = loop.time()
+                await _purge()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("inbound poll error: %s", e)
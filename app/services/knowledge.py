@@ -0,0 +1,117 @@
+# app/services/knowledge.py
+# ------------------------------------------------------------
+# Knowledge base per cliente (FAQ, listini, orari...) con ricerca BM25 locale.
+# - documenti in mfai_app.kb_documents (caricati dall'admin API)
+# - chunking a paragrafi (~KB_CHUNK_WORDS parole) e indice BM25 in array
+#   NumPy (services/bm25): nessun servizio di embedding
+# - indici in memoria, oppure su disco memory-mapped se KB_MMAP_DIR è impostato
+# - ricostruzione quando i documenti cambiano (invalidate() locale + controllo
+#   di versione economico ogni KB_CHECK_SEC per le altre istanze)
+# Al momento della risposta solo i top-k chunk entrano nel prompt.
+# ------------------------------------------------------------
+import os
+import asyncio
+import logging
+from time import monotonic
+from typing import List, Optional, Sequence, Tuple
+
+from sqlalchemy import text
+
+from app.db import engine
+from app.services import metrics
+from app.services.bm25 import KBIndex, build_index, prune
+from app.services.client_cache import VersionedCache
+
+logger = logging.getLogger("knowledge")
+
+TOP_K        = int(os.getenv("KB_TOP_K", "3"))
+MIN_SCORE    = float(os.getenv("KB_MIN_SCORE", "1.0"))
+CHECK_SEC    = float(os.getenv("KB_CHECK_SEC", "60"))
+MMAP_DIR     = os.getenv("KB_MMAP_DIR") or None
+
+# ---------------- registry per cliente ----------------
+
+_DOCS_SQL = text("""
+    SELECT title, content FROM mfai_app.kb_documents
+    WHERE client_id = :c
+    ORDER BY id
+""")
+
+
+async def _build(client_id: int, version: str) -> KBIndex:
+    async with engine.connect() as conn:
+        docs = [(r[0] or "", r[1] or "") for r in (await conn.execute(_DOCS_SQL, {"c": client_id})).all()]
+    t0 = monotonic()
+    mmap_dir = os.path.join(MMAP_DIR, f"client_{client_id}") if MMAP_DIR else None
+    idx = await asyncio.to_thread(build_index, version, docs, mmap_dir)
+    metrics.observe("kb.build_ms", (monotonic() - t0) * 1000.0)
+    if docs:
+        logger.info("kb client %s: %s documenti, %s chunk, %s termini",
+                    client_id, len(docs), len(idx), len(idx.vocab))
+    return idx
+
+
+async def _swapped(client_id: int, idx: KBIndex) -> None:
+    if idx.path:  # build vecchie tolte solo dopo lo swap
+        await asyncio.to_thread(prune, os.path.dirname(idx.path), idx.path)
+
+
+_INDEXES: VersionedCache[KBIndex] = VersionedCache("kb_documents", CHECK_SEC, _build, _swapped)
+
+
+async def get_index(client_id: int) -> KBIndex:
+    """Indice del cliente (vuoto se non ha documenti); ricostruito se la versione è cambiata."""
+    return await _INDEXES.get(client_id)
+
+
+def invalidate(client_id: int) -> None:
+    """Dopo una modifica dall'admin: la prossima query ricontrolla la versione."""
+    _INDEXES.invalidate(client_id)
+
+
+async def version(client_id: Optional[int]) -> Optional[str]:
+    """Versione dei documenti del cliente (entra nella chiave della reply cache).
+    "" = nessun cliente (niente KB); None = versione sconosciuta (errore): niente cache."""
+    if client_id is None:
+        return ""
+    try:
+        return (await get_index(client_id)).version
+    except Exception as e:
+        metrics.incr("kb.failed")
+        logger.warning("kb version failed (client %s): %s", client_id, e)
+        return None
+
+
+async def search(client_id: Optional[int], query: str, k: int = TOP_K,
+                 min_score: float = MIN_SCORE) -> List[Tuple[float, str]]:
+    if client_id is None or not query or k <= 0:
+        return []
+    try:
+        idx = await get_index(client_id)
+    except Exception as e:
+        metrics.incr("kb.failed")
+        logger.warning("kb load failed (client %s): %s", client_id, e)
+        return []
+    if not len(idx):
+        return []
+    t0 = monotonic()
+    hits = idx.search(query, k, min_score)
+    metrics.observe("kb.query_ms", (monotonic() - t0) * 1000.0)
+    metrics.incr("kb.queries")
+    if hits:
+        metrics.incr("kb.chunks_used", len(hits))
+    return hits
+
+
+def format_for_prompt(hits: Sequence[Tuple[float, str]]) -> str:
+    """Blocco da accodare al system prompt con i chunk trovati."""
+    if not hits:
+        return ""
+    lines = "\n".join(f"- {c}" for _, c in hits)
+    return ("\n\nInformazioni dalla knowledge base dell'attività "
+            "(usale solo se pertinenti alla domanda):\n" + lines)
+
+
+metrics.register_gauge("kb.indexes", lambda: {
+    str(cid): {"chunks": len(idx), "terms": len(idx.vocab)} for cid, idx in _INDEXES.items()
+})
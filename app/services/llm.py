@@ -1,27 +1,127 @@
+# app/services/llm.py
+# ------------------------------------------------------------
+# Chat completion OpenAI in streaming (SSE) sul client condiviso (services/http).
+# - stream_chat(): yield dei pezzi di testo appena arrivano (+ TTFT in metriche)
+# - stream_segments(): raggruppa i pezzi in messaggi inviabili: la PRIMA frase
+#   completa esce subito, il resto a paragrafi, l'ultimo pezzo alla fine
+# - ai_reply(): testo completo (stream raccolto)
+# Circuit breaker "openai": circuito aperto = LLMError subito; timeout adattivo,
+# stretto al budget residuo dell'evento (services/deadline).
+# ------------------------------------------------------------
 import os
-from openai import AsyncOpenAI
-from app.services.http import get_client
-
-FAST_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
-MAX_TOKENS = int(os.getenv("OPENAI_MAX_TOKENS", "220"))
-
-_client = AsyncOpenAI(http_client=get_client())
-
-async def ai_reply(messages):
-    stream = await _client.chat.completions.create(
-        model=FAST_MODEL,
-        messages=messages,
-        temperature=0.3,
-        max_tokens=MAX_TOKENS,
-        stream=True,
-    )
+import re
+from time import monotonic
+from typing import AsyncIterator, Dict, List, Optional
+
+import httpx
+
+from app.services import circuit, codec, deadline, metrics
+from app.services.http import client
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+CHAT_URL       = "https://api.openai.com/v1/chat/completions"
+FAST_MODEL     = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+MAX_TOKENS     = int(os.getenv("OPENAI_MAX_TOKENS", "220"))
+FIRST_MIN_CHARS = int(os.getenv("STREAM_FIRST_MIN_CHARS", "20"))  # niente primo DM di 3 lettere
+
+# fine frase seguita da spazio ("3.5" e "www.x.it" non tagliano), oppure a capo
+_SENTENCE_END = re.compile(r"[.!?…]+[\"')\]]*\s|\n")
+
+
+class LLMError(Exception):
+    pass
+
+
+async def stream_chat(messages: List[Dict[str, str]], model: str = FAST_MODEL,
+                      temperature: float = 0.7, max_tokens: int = MAX_TOKENS,
+                      timeout: Optional[httpx.Timeout] = None,
+                      usage_out: Optional[dict] = None) -> AsyncIterator[str]:
+    """Yield dei delta di testo della risposta, man mano che arrivano.
+    `usage_out`, se passato, viene riempito con l'usage dell'ultimo evento."""
+    if not OPENAI_API_KEY:
+        raise LLMError("OPENAI_API_KEY assente")
+    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"}
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "stream": True,
+        "stream_options": {"include_usage": True},
+    }
+    breaker = circuit.get("openai")
+    if not breaker.allow():
+        raise LLMError("circuito OpenAI aperto")
+    t0 = monotonic()
+    first = True
+    recorded = False
+    try:
+        async with client("openai").stream("POST", CHAT_URL, headers=headers, json=payload,
+                                           timeout=timeout or deadline.fit(breaker.timeout())) as r:
+            breaker.record(not circuit.failed_status(r.status_code), (monotonic() - t0) * 1000.0)
+            recorded = True
+            if r.status_code != 200:
+                body = (await r.aread())[:500]
+                raise LLMError(f"OpenAI HTTP {r.status_code}: {body!r}")
+            async for line in r.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                ev = codec.loads(data)
+                usage = ev.get("usage")
+                if usage and usage.get("prompt_tokens"):
+                    metrics.observe("llm.prompt_tokens", usage["prompt_tokens"])
+                    if usage_out is not None:
+                        usage_out.update(usage)
+                for choice in ev.get("choices") or []:
+                    delta = (choice.get("delta") or {}).get("content")
+                    if not delta:
+                        continue
+                    if first:
+                        first = False
+                        metrics.observe("llm.ttft_ms", (monotonic() - t0) * 1000.0)
+                    yield delta
+    except httpx.HTTPError:
+        if not recorded:  # connessione / timeout prima degli header
+            breaker.record(False, (monotonic() - t0) * 1000.0)
+        raise
+    metrics.observe("llm.stream_total_ms", (monotonic() - t0) * 1000.0)
+
+
+def _cut(buf: str, first: bool) -> Optional[int]:
+    """Indice di taglio del prossimo messaggio nel buffer, None se non è ancora pronto."""
+    if first:
+        for m in _SENTENCE_END.finditer(buf):
+            if len(buf[:m.end()].strip()) >= FIRST_MIN_CHARS:
+                return m.end()
+        return None
+    i = buf.find("\n\n")
+    return i + 2 if i >= 0 else None
+
+
+async def stream_segments(deltas: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Delta -> messaggi: prima frase appena completa, poi paragrafi, poi il resto."""
+    buf = ""
+    first = True
+    async for d in deltas:
+        buf += d
+        while True:
+            cut = _cut(buf, first)
+            if cut is None:
+                break
+            seg, buf = buf[:cut].strip(), buf[cut:]
+            if seg:
+                first = False
+                yield seg
+    if buf.strip():
+        yield buf.strip()
+
+
+async def ai_reply(messages: List[Dict[str, str]]) -> str:
+    """Risposta completa (stream raccolto)."""
     buf = []
-    async for ev in stream:
-        delta = ev.choices[0].delta.get("content", "")
-        if not delta:
-            continue
+    async for delta in stream_chat(messages):
         buf.append(delta)
-        txt = "".join(buf)
-        if any(txt.endswith(p) for p in (".", "!", "?", "…")) and len(txt) >= 60:
-            break
     return "".join(buf).strip()
@@ -0,0 +1,124 @@
+# app/services/log_writer.py
+# ------------------------------------------------------------
+# Scrittura asincrona a lotti di mfai_app.message_logs.
+# Il webhook chiama write() (non blocca, niente await): i record finiscono
+# in una coda limitata e un task in background li inserisce con UN solo
+# INSERT multi-riga quando il lotto è pieno o scade l'intervallo.
+# Allo shutdown stop() svuota la coda.
+# ------------------------------------------------------------
+import os
+import asyncio
+import logging
+from typing import Any, List, Optional, Tuple
+
+from sqlalchemy import text
+
+from app.db import engine
+from app.services import codec, metrics
+
+logger = logging.getLogger("log_writer")
+
+QUEUE_MAX  = int(os.getenv("LOG_QUEUE_MAX", "5000"))
+BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "200"))
+FLUSH_SEC  = float(os.getenv("LOG_FLUSH_SEC", "1.0"))
+
+# (ig_account_id, direction, payload, peer_id, body): peer_id/body estratti per la
+# rilettura della history (vedi services/message_history), NULL se non pertinenti
+Record = Tuple[Optional[int], str, str, Optional[str], Optional[str]]
+
+_QUEUE: Optional[asyncio.Queue] = None
+_TASK: Optional[asyncio.Task] = None
+
+_INSERT_SQL = text("""
+    INSERT INTO mfai_app.message_logs (ig_account_id, direction, payload, peer_id, body)
+    SELECT * FROM unnest(CAST(:a AS bigint[]), CAST(:d AS text[]), CAST(:p AS text[]),
+                         CAST(:u AS text[]), CAST(:b AS text[]))
+""")
+
+
+def write(ig_account_id: Optional[int], direction: str, payload: Any,
+          peer_id: Optional[str] = None, body: Optional[str] = None) -> bool:
+    """Accoda un record. `payload` già serializzato (str) viene scritto così com'è.
+    `peer_id` = utente IG del thread, `body` = testo del turno (solo DM di testo).
+    False se la coda è piena (record scartato e contato)."""
+    if _QUEUE is None:
+        start()
+    rec: Record = (ig_account_id, direction, payload if isinstance(payload, str) else codec.dumps(payload),
+                   peer_id or None, body or None)
+    try:
+        _QUEUE.put_nowait(rec)
+    except asyncio.QueueFull:
+        metrics.incr("log_writer.dropped")
+        return False
+    return True
+
+
+async def _flush(batch: List[Record]) -> None:
+    try:
+        async with engine.begin() as conn:
+            await conn.execute(_INSERT_SQL, {
+                "a": [r[0] for r in batch],
+                "d": [r[1] for r in batch],
+                "p": [r[2] for r in batch],
+                "u": [r[3] for r in batch],
+                "b": [r[4] for r in batch],
+            })
+        metrics.incr("log_writer.rows", len(batch))
+        metrics.incr("log_writer.flushes")
+    except Exception as e:
+        metrics.incr("log_writer.failed_rows", len(batch))
+        logger.warning("message_logs batch insert failed (%s rows): %s", len(batch), e)
+
+
+async def _run() -> None:
+    loop = asyncio.get_running_loop()
+    queue = _QUEUE
+    while True:
+        first = await queue.get()
+        if first is None:  # sentinella di stop()
+            return
+        batch: List[Record] = [first]
+        closing = False
+        deadline = loop.time() + FLUSH_SEC
+        while len(batch) < BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                rec = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if rec is None:
+                closing = True
+                break
+            batch.append(rec)
+        await _flush(batch)
+        if closing:
+            return
+
+
+def start() -> None:
+    global _QUEUE, _TASK
+    if _TASK is not None:
+        return
+    _QUEUE = asyncio.Queue(maxsize=QUEUE_MAX)
+    _TASK = asyncio.create_task(_run(), name="message-log-writer")
+
+
+async def stop(timeout: float = 10.0) -> None:
+    """Scrive quello che resta in coda (sentinella in fondo alla coda), poi ferma il task."""
+    global _QUEUE, _TASK
+    if _TASK is None:
+        return
+    try:
+        await asyncio.wait_for(_QUEUE.put(None), timeout)
+        await asyncio.wait_for(_TASK, timeout)
+    except asyncio.TimeoutError:
+        logger.warning("log writer stop: timeout, %s record non scritti", _QUEUE.qsize())
+        _TASK.cancel()
+        await asyncio.gather(_TASK, return_exceptions=True)
+    _TASK = None
+    _QUEUE = None
+
+
+metrics.register_gauge("log_writer.queue_depth", lambda: _QUEUE.qsize() if _QUEUE is not None else 0)
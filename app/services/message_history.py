@@ -0,0 +1,58 @@
+# app/services/message_history.py
+# ------------------------------------------------------------
+# Ricostruzione della history di un thread da mfai_app.message_logs.
+# Dopo un riavvio la memoria conversazionale è vuota: al primo turno di un
+# thread "freddo" rileggiamo gli ultimi N turni (colonne peer_id/body,
+# indice coprente idx_message_logs_thread -> un solo range scan).
+# ------------------------------------------------------------
+import logging
+from typing import List, Optional
+
+from sqlalchemy import text
+
+from app.db import engine
+from app.services import metrics
+from app.services.sessions import ASSISTANT, USER, Turn
+
+logger = logging.getLogger("message_history")
+
+_ROLE_BY_DIRECTION = {"in": USER, "out": ASSISTANT}
+
+_TURNS_SQL = text("""
+    SELECT direction, body
+    FROM mfai_app.message_logs
+    WHERE ig_account_id = :a AND peer_id = :p
+      AND body IS NOT NULL
+      AND created_at > now() - make_interval(secs => :max_age)
+      AND created_at < to_timestamp(:before)
+    ORDER BY id DESC
+    LIMIT :n
+""")
+
+
+async def load_turns(ig_account_id: int, peer_id: str, limit: int,
+                     max_age: float, before: float) -> List[Turn]:
+    """Ultimi `limit` turni (vecchio -> nuovo) scritti prima di `before` (epoch)
+    e non più vecchi di `max_age` secondi. Lista vuota se nulla o in errore."""
+    try:
+        async with engine.connect() as conn:
+            rows = (await conn.execute(_TURNS_SQL, {
+                "a": ig_account_id, "p": peer_id, "n": limit,
+                "max_age": float(max_age), "before": float(before),
+            })).all()
+    except Exception as e:
+        metrics.incr("message_history.failed")
+        logger.warning("history rehydrate failed (%s/%s): %s", ig_account_id, peer_id, e)
+        return []
+    metrics.incr("message_history.loads")
+    metrics.incr("message_history.turns", len(rows))
+    return [(_ROLE_BY_DIRECTION[d], b) for d, b in reversed(rows) if d in _ROLE_BY_DIRECTION]
+
+
+def inbound_text(evt: dict) -> Optional[str]:
+    """Testo di un DM utente (non echo) da salvare in message_logs.body."""
+    message = evt.get("message")
+    if not isinstance(message, dict) or message.get("is_echo"):
+        return None
+    txt = message.get("text")
+    return txt if isinstance(txt, str) and txt.strip() else None
@@ -0,0 +1,77 @@
+# app/services/metrics.py
+# ------------------------------------------------------------
+# Metriche in-process (contatori + gauge + distribuzioni) esposte in JSON su /__metrics.
+# Niente dipendenze esterne: ogni istanza espone i propri numeri.
+# ------------------------------------------------------------
+from collections import deque
+from typing import Any, Callable, Deque, Dict
+
+_COUNTERS: Dict[str, int] = {}
+_GAUGES: Dict[str, Callable[[], Any]] = {}
+_SUMMARIES: Dict[str, Dict[str, Any]] = {}
+
+_WINDOW = 512  # ultimi valori tenuti per i percentili
+
+
+def incr(name: str, n: int = 1) -> None:
+    _COUNTERS[name] = _COUNTERS.get(name, 0) + n
+
+
+def counter(name: str) -> int:
+    return _COUNTERS.get(name, 0)
+
+
+def observe(name: str, value: float) -> None:
+    """Registra un valore (latenza, token, ...): count/sum/max + percentili sugli ultimi _WINDOW."""
+    s = _SUMMARIES.get(name)
+    if s is None:
+        s = _SUMMARIES[name] = {"count": 0, "sum": 0.0, "max": value, "recent": deque(maxlen=_WINDOW)}
+    s["count"] += 1
+    s["sum"] += value
+    if value > s["max"]:
+        s["max"] = value
+    s["recent"].append(value)
+
+
+def _pct(values: Deque[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def percentile(name: str, q: float) -> float | None:
+    """Percentile q (0..1) sugli ultimi valori osservati; None se non ce ne sono."""
+    s = _SUMMARIES.get(name)
+    if s is None or not s["recent"]:
+        return None
+    return _pct(s["recent"], q)
+
+
+def samples(name: str) -> int:
+    """Quanti valori recenti (max _WINDOW) ci sono per il percentile di `name`."""
+    s = _SUMMARIES.get(name)
+    return len(s["recent"]) if s is not None else 0
+
+
+def register_gauge(name: str, fn: Callable[[], Any]) -> None:
+    """Registra una funzione letta solo quando si chiede lo snapshot."""
+    _GAUGES[name] = fn
+
+
+def snapshot() -> Dict[str, Any]:
+    gauges: Dict[str, Any] = {}
+    for name, fn in sorted(_GAUGES.items()):
+        try:
+            gauges[name] = fn()
+        except Exception as e:
+            gauges[name] = f"error: {e}"
+    summaries = {
+        name: {
+            "count": s["count"],
+            "avg": round(s["sum"] / s["count"], 3),
+            "max": s["max"],
+            "p50": _pct(s["recent"], 0.50),
+            "p95": _pct(s["recent"], 0.95),
+        }
+        for name, s in sorted(_SUMMARIES.items())
+    }
+    return {"counters": dict(sorted(_COUNTERS.items())), "gauges": gauges, "summaries": summaries}
@@ -0,0 +1,149 @@
+# app/services/model_router.py
+# ------------------------------------------------------------
+# Scelta di modello e max_tokens per ogni risposta, da feature locali
+# (nessuna chiamata in più): lunghezza del messaggio, numero di domande,
+# profondità della history.
+#   fast    -> saluti e messaggi brevi (la maggioranza del traffico)
+#   default -> il resto
+#   complex -> messaggi lunghi / più domande / thread lunghi
+# Modello, max_tokens e soglie per route: env ROUTE_*, sovrascrivibili per
+# cliente in client_prompts con le stesse chiavi (ROUTING=off -> sempre default).
+# record() registra latenza, token e costo stimato per route (/__metrics).
+# ------------------------------------------------------------
+import os
+import re
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from app.services import metrics
+from app.services.account_context import AccountContext
+from app.services.llm import FAST_MODEL, MAX_TOKENS
+
+ROUTES = ("fast", "default", "complex")
+
+_ENV_DEFAULTS: Dict[str, str] = {
+    "ROUTE_FAST_MODEL":            os.getenv("ROUTE_FAST_MODEL", FAST_MODEL),
+    "ROUTE_FAST_MAX_TOKENS":       os.getenv("ROUTE_FAST_MAX_TOKENS", "120"),
+    "ROUTE_DEFAULT_MODEL":         os.getenv("ROUTE_DEFAULT_MODEL", FAST_MODEL),
+    "ROUTE_DEFAULT_MAX_TOKENS":    os.getenv("ROUTE_DEFAULT_MAX_TOKENS", str(MAX_TOKENS)),
+    "ROUTE_COMPLEX_MODEL":         os.getenv("ROUTE_COMPLEX_MODEL", FAST_MODEL),
+    "ROUTE_COMPLEX_MAX_TOKENS":    os.getenv("ROUTE_COMPLEX_MAX_TOKENS", "350"),
+    # soglie
+    "ROUTE_FAST_MAX_CHARS":        os.getenv("ROUTE_FAST_MAX_CHARS", "40"),
+    "ROUTE_FAST_MAX_TURNS":        os.getenv("ROUTE_FAST_MAX_TURNS", "4"),
+    "ROUTE_COMPLEX_MIN_CHARS":     os.getenv("ROUTE_COMPLEX_MIN_CHARS", "280"),
+    "ROUTE_COMPLEX_MIN_QUESTIONS": os.getenv("ROUTE_COMPLEX_MIN_QUESTIONS", "2"),
+    "ROUTE_COMPLEX_MIN_TURNS":     os.getenv("ROUTE_COMPLEX_MIN_TURNS", "12"),
+}
+ENABLED = os.getenv("ROUTING_ENABLED", "true").lower() == "true"
+
+# $ per 1M token (input/output); MODEL_PRICES="modello=in/out,..." aggiunge o sostituisce
+_PRICES: Dict[str, Tuple[float, float]] = {
+    "gpt-4o-mini":  (0.15, 0.60),
+    "gpt-4o":       (2.50, 10.00),
+    "gpt-4.1-nano": (0.10, 0.40),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1":      (2.00, 8.00),
+}
+for _item in filter(None, (os.getenv("MODEL_PRICES") or "").split(",")):
+    try:
+        _name, _pair = _item.split("=", 1)
+        _in, _out = _pair.split("/", 1)
+        _PRICES[_name.strip()] = (float(_in), float(_out))
+    except ValueError:
+        pass
+
+_QUESTIONS = re.compile(r"\?+")
+
+
+class Route(NamedTuple):
+    name: str
+    model: str
+    max_tokens: int
+
+
+class Features(NamedTuple):
+    chars: int
+    questions: int
+    turns: int  # turni precedenti nel thread
+
+
+DEFAULT = Route("default", _ENV_DEFAULTS["ROUTE_DEFAULT_MODEL"], int(_ENV_DEFAULTS["ROUTE_DEFAULT_MAX_TOKENS"]))
+
+
+def features(text_msg: str, history_turns: int, has_summary: bool = False) -> Features:
+    t = (text_msg or "").strip()
+    turns = history_turns
+    if has_summary:  # thread già riassunto: mai "fast", ma non per forza "complex"
+        turns = max(turns, int(_ENV_DEFAULTS["ROUTE_FAST_MAX_TURNS"]) + 1)
+    return Features(len(t), len(_QUESTIONS.findall(t)), turns)
+
+
+def _conf(ctx: Optional[AccountContext], key: str) -> float:
+    default = float(_ENV_DEFAULTS[key])
+    return ctx.setting_float(key, default) if ctx is not None else default
+
+
+def _route(ctx: Optional[AccountContext], name: str) -> Route:
+    prefix = f"ROUTE_{name.upper()}"
+    model = _ENV_DEFAULTS[f"{prefix}_MODEL"]
+    if ctx is not None:
+        model = ctx.setting(f"{prefix}_MODEL", model)
+    return Route(name, model, int(_conf(ctx, f"{prefix}_MAX_TOKENS")))
+
+
+def classify(f: Features, ctx: Optional[AccountContext] = None) -> str:
+    if f.chars >= _conf(ctx, "ROUTE_COMPLEX_MIN_CHARS") \
+            or f.questions >= _conf(ctx, "ROUTE_COMPLEX_MIN_QUESTIONS") \
+            or f.turns >= _conf(ctx, "ROUTE_COMPLEX_MIN_TURNS"):
+        return "complex"
+    if f.chars <= _conf(ctx, "ROUTE_FAST_MAX_CHARS") and f.questions <= 1 \
+            and f.turns <= _conf(ctx, "ROUTE_FAST_MAX_TURNS"):
+        return "fast"
+    return "default"
+
+
+def choose(ctx: Optional[AccountContext], f: Features) -> Route:
+    enabled = ctx.setting_bool("ROUTING", ENABLED) if ctx is not None else ENABLED
+    route = _route(ctx, classify(f, ctx) if enabled else "default")
+    metrics.incr(f"route.{route.name}")
+    return route
+
+
+def cost_usd(model: str, prompt_tokens: int, completion_tokens: int) -> Optional[float]:
+    price = _PRICES.get(model)
+    if price is None:
+        # "gpt-4o-mini-2024-07-18" -> prezzo di "gpt-4o-mini"
+        base = max((m for m in _PRICES if model.startswith(m)), key=len, default=None)
+        price = _PRICES.get(base) if base else None
+    if price is None:
+        return None
+    return (prompt_tokens * price[0] + completion_tokens * price[1]) / 1e6
+
+
+def record(route: Route, latency_ms: float, usage: Optional[dict]) -> None:
+    """Latenza, token e costo stimato della chiamata fatta con `route`."""
+    metrics.observe(f"route.{route.name}.latency_ms", latency_ms)
+    if not usage:
+        return
+    p, c = int(usage.get("prompt_tokens") or 0), int(usage.get("completion_tokens") or 0)
+    metrics.observe(f"route.{route.name}.completion_tokens", c)
+    cost = cost_usd(route.model, p, c)
+    if cost is not None:
+        metrics.observe(f"route.{route.name}.cost_usd", cost)
+        metrics.incr(f"route.{route.name}.cost_micro_usd", int(round(cost * 1e6)))
+
+
+def _stats() -> dict:
+    total = sum(metrics.counter(f"route.{n}") for n in ROUTES)
+    out = {}
+    for n in ROUTES:
+        cnt = metrics.counter(f"route.{n}")
+        out[n] = {
+            "share": round(cnt / total, 3) if total else None,
+            "p50_ms": metrics.percentile(f"route.{n}.latency_ms", 0.5),
+            "cost_usd_total": metrics.counter(f"route.{n}.cost_micro_usd") / 1e6,
+        }
+    return out
+
+
+metrics.register_gauge("routes", _stats)
@@ -1,11 +1,18 @@
-from typing import Dict
+from typing import Dict, Optional
 import time
+import asyncio
+import logging
 from sqlalchemy import text
 from app.db import engine  # async engine verso Neon
 
+logger = logging.getLogger("prompts")
+
 _CACHE: Dict[str, str] = {}
 _CACHE_TS: float = 0.0
 _TTL_SEC = 60.0
+_REFRESH: Optional[asyncio.Task] = None
+_REFRESH_TRIED: float = 0.0
+_RETRY_SEC = 10.0  # dopo un refresh fallito
 
 _DEFAULTS = {
     "GREETING": "Ciao! Come posso aiutarti?",
@@ -24,6 +31,35 @@ async def _refresh_cache():
     _CACHE = {k: v for k, v in rows} if rows else {}
     _CACHE_TS = time.time()
 
+def default_prompt(key: str) -> str:
+    return _DEFAULTS.get(key, "")
+
+def cached_prompt(key: str) -> str:
+    """Prompt senza I/O (per i percorsi di risposta sotto carico): cache o default.
+    Se la cache è vuota o scaduta la ricarica parte in background."""
+    refresh_soon()
+    return _CACHE.get(key) or _DEFAULTS.get(key, "")
+
+def refresh_soon() -> None:
+    """Se la cache è scaduta la ricarica in un task (uno alla volta), senza aspettarla."""
+    global _REFRESH, _REFRESH_TRIED
+    now = time.time()
+    if (now - _CACHE_TS) <= _TTL_SEC or (now - _REFRESH_TRIED) < _RETRY_SEC:
+        return
+    if _REFRESH is not None and not _REFRESH.done():
+        return
+    _REFRESH_TRIED = now
+    try:
+        _REFRESH = asyncio.get_running_loop().create_task(_refresh_quietly(), name="prompts-refresh")
+    except RuntimeError:  # nessun loop attivo
+        pass
+
+async def _refresh_quietly():
+    try:
+        await _refresh_cache()
+    except Exception as e:
+        logger.warning("prompts refresh failed: %s", e)
+
 async def get_prompt(key: str) -> str:
     now = time.time()
     if not _CACHE or (now - _CACHE_TS) > _TTL_SEC:
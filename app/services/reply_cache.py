@@ -0,0 +1,129 @@
+# app/services/reply_cache.py
+# ------------------------------------------------------------
+# Cache delle risposte per le domande ricorrenti (prezzi, orari, indirizzo...).
+# Chiave = (client_id, versione del system prompt, testo normalizzato):
+# cambiare il prompt del cliente invalida da sé le sue voci.
+# - TTL (REPLY_CACHE_TTL_SEC) + tetto di voci con eviction LRU
+# - single-flight: richieste identiche in contemporanea fanno UNA chiamata LLM
+# - solo messaggi di PRIMO turno (decide il chiamante): le risposte che
+#   dipendono dal contesto della conversazione non vengono mai riusate
+# ------------------------------------------------------------
+import os
+import re
+import asyncio
+import hashlib
+import unicodedata
+from collections import OrderedDict
+from functools import lru_cache
+from time import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from app.services import metrics
+
+# default globale; se usare la cache lo decide il chiamante (override per cliente REPLY_CACHE)
+ENABLED     = os.getenv("REPLY_CACHE_ENABLED", "true").lower() == "true"
+TTL_SEC     = float(os.getenv("REPLY_CACHE_TTL_SEC", "3600"))
+MAX_ENTRIES = int(os.getenv("REPLY_CACHE_MAX", "5000"))
+MAX_CHARS   = int(os.getenv("REPLY_CACHE_MAX_CHARS", "200"))  # messaggi lunghi = domande "uniche"
+
+CacheKey = Tuple[int, str, str]
+
+_DATA: "OrderedDict[CacheKey, Tuple[float, str]]" = OrderedDict()
+_INFLIGHT: Dict[CacheKey, asyncio.Future] = {}
+
+_NON_WORD = re.compile(r"[^\w\s]+", re.UNICODE)
+_SPACES = re.compile(r"\s+")
+
+
+def normalize(text_msg: str) -> str:
+    """Minuscolo, senza accenti, punteggiatura ed emoji, spazi compattati."""
+    t = unicodedata.normalize("NFKD", text_msg.lower())
+    t = "".join(c for c in t if not unicodedata.combining(c))
+    t = _NON_WORD.sub(" ", t)
+    return _SPACES.sub(" ", t).strip()
+
+
+@lru_cache(maxsize=1024)
+def prompt_version(system_prompt: Optional[str]) -> str:
+    return hashlib.sha1((system_prompt or "").encode("utf-8")).hexdigest()[:12]
+
+
+def make_key(client_id: Optional[int], system_prompt: Optional[str], text_msg: str) -> Optional[CacheKey]:
+    """None se il messaggio non è cacheabile (cliente ignoto, vuoto o troppo lungo)."""
+    if client_id is None or len(text_msg) > MAX_CHARS:
+        return None
+    norm = normalize(text_msg)
+    if not norm:
+        return None
+    return (client_id, prompt_version(system_prompt), norm)
+
+
+def get(key: CacheKey) -> Optional[str]:
+    hit = _DATA.get(key)
+    if hit is not None and hit[0] > time():
+        _DATA.move_to_end(key)
+        metrics.incr("reply_cache.hit")
+        return hit[1]
+    if hit is not None:
+        _DATA.pop(key, None)
+    metrics.incr("reply_cache.miss")
+    return None
+
+
+def put(key: CacheKey, reply_text: str) -> None:
+    if not reply_text:
+        return
+    _DATA[key] = (time() + TTL_SEC, reply_text)
+    _DATA.move_to_end(key)
+    while len(_DATA) > MAX_ENTRIES:
+        _DATA.popitem(last=False)
+        metrics.incr("reply_cache.evicted")
+
+
+async def compute_once(key: CacheKey, compute: Callable[[], Awaitable[str]]) -> str:
+    """Dopo un miss: calcola UNA volta per tutte le richieste identiche in volo e mette in cache.
+    Se compute() fallisce l'errore arriva a tutti i chiamanti e non si mette nulla in cache."""
+    fut = _INFLIGHT.get(key)
+    if fut is not None:
+        metrics.incr("reply_cache.coalesced")
+        return await asyncio.shield(fut)
+
+    fut = asyncio.get_running_loop().create_future()
+    _INFLIGHT[key] = fut
+    try:
+        reply_text = await compute()
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # segnato come letto anche se nessuno era in attesa
+        raise
+    else:
+        put(key, reply_text)
+        fut.set_result(reply_text)
+        return reply_text
+    finally:
+        _INFLIGHT.pop(key, None)
+
+
+async def get_or_compute(key: CacheKey, compute: Callable[[], Awaitable[str]]) -> str:
+    cached = get(key)
+    if cached is not None:
+        return cached
+    return await compute_once(key, compute)
+
+
+def _stats() -> dict:
+    # coalesced = miss che non ha fatto la sua chiamata LLM: conta come hit
+    coalesced = metrics.counter("reply_cache.coalesced")
+    hits = metrics.counter("reply_cache.hit") + coalesced
+    misses = metrics.counter("reply_cache.miss") - coalesced
+    return {
+        "entries": len(_DATA),
+        "inflight": len(_INFLIGHT),
+        "hit_rate": round(hits / (hits + misses), 3) if hits + misses else None,
+    }
+
+
+metrics.register_gauge("reply_cache", _stats)
@@ -0,0 +1,115 @@
+# app/services/send_retry.py
+# ------------------------------------------------------------
+# Coda in memoria dei DM rimandati mentre il circuito Graph è aperto.
+# Un loop ogni SEND_RETRY_POLL_SEC riprova gli invii scaduti quando il
+# circuito lascia passare, con backoff esponenziale. Si scarta dopo
+# SEND_RETRY_MAX_ATTEMPTS tentativi, dopo SEND_RETRY_MAX_AGE_SEC (una risposta
+# arrivata troppo tardi è peggio di nessuna) o se Graph rifiuta con un 4xx.
+# Coda limitata a SEND_RETRY_MAX: oltre, i DM più vecchi vengono scartati.
+# ------------------------------------------------------------
+import os
+import asyncio
+import logging
+from collections import deque
+from itertools import count
+from time import monotonic
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+from app.services import circuit, metrics
+
+logger = logging.getLogger("send_retry")
+
+POLL_SEC     = float(os.getenv("SEND_RETRY_POLL_SEC", "2"))
+MAX_ATTEMPTS = int(os.getenv("SEND_RETRY_MAX_ATTEMPTS", "5"))
+MAX_AGE_SEC  = float(os.getenv("SEND_RETRY_MAX_AGE_SEC", "600"))
+MAX_ITEMS    = int(os.getenv("SEND_RETRY_MAX", "2000"))
+BACKOFF_SEC  = float(os.getenv("SEND_RETRY_BACKOFF_SEC", "5"))
+
+# send() -> (ok, risposta Graph); retriable(resp) decide se un errore merita un altro tentativo
+Send = Callable[[], Awaitable[Tuple[bool, Dict[str, Any]]]]
+
+_IDS = count(1)
+_QUEUE: Deque[dict] = deque()
+_TASK: Optional[asyncio.Task] = None
+
+
+def defer(send: Send, label: str, retriable: Callable[[Dict[str, Any]], bool]) -> int:
+    """Accoda un invio da ripetere; ritorna l'id (per i log)."""
+    if len(_QUEUE) >= MAX_ITEMS:
+        old = _QUEUE.popleft()
+        metrics.incr("send_retry.dropped")
+        logger.warning("send_retry pieno: scartato %s", old["label"])
+    now = monotonic()
+    item = {"id": next(_IDS), "send": send, "label": label, "retriable": retriable,
+            "attempts": 0, "created": now, "next_at": now}
+    _QUEUE.append(item)
+    metrics.incr("send_retry.deferred")
+    return item["id"]
+
+
+async def _attempt(item: dict) -> bool:
+    """True = item concluso (inviato o scartato), False = da riprovare."""
+    item["attempts"] += 1
+    try:
+        ok, resp = await item["send"]()
+    except Exception as e:
+        ok, resp = False, {"error": str(e)}
+    if ok:
+        metrics.incr("send_retry.sent")
+        metrics.observe("send_retry.delay_ms", (monotonic() - item["created"]) * 1000.0)
+        logger.info("send_retry %s inviato al tentativo %s", item["label"], item["attempts"])
+        return True
+    if not item["retriable"](resp) or item["attempts"] >= MAX_ATTEMPTS:
+        metrics.incr("send_retry.failed")
+        logger.warning("send_retry %s abbandonato dopo %s tentativi: %s", item["label"], item["attempts"], resp)
+        return True
+    item["next_at"] = monotonic() + BACKOFF_SEC * (2 ** (item["attempts"] - 1))
+    return False
+
+
+async def _run_once() -> None:
+    """Un giro sulla coda. L'ordine resta quello di accodamento e un DM non
+    parte finché uno precedente con la stessa label (stesso destinatario) è in attesa."""
+    breaker = circuit.get("graph")
+    now = monotonic()
+    waiting = set()  # label con un invio precedente ancora in coda
+    for _ in range(len(_QUEUE)):
+        item = _QUEUE.popleft()
+        if now - item["created"] > MAX_AGE_SEC:
+            metrics.incr("send_retry.expired")
+            continue
+        if item["label"] in waiting or item["next_at"] > now or not breaker.available() \
+                or not await _attempt(item):
+            waiting.add(item["label"])
+            _QUEUE.append(item)
+
+
+async def _loop() -> None:
+    while True:
+        try:
+            await asyncio.sleep(POLL_SEC)
+            if _QUEUE:
+                await _run_once()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("send_retry loop error: %s", e)
+
+
+def start() -> None:
+    global _TASK
+    if _TASK is None or _TASK.done():
+        _TASK = asyncio.create_task(_loop(), name="send_retry")
+
+
+async def stop() -> None:
+    global _TASK
+    if _TASK is not None:
+        _TASK.cancel()
+        await asyncio.gather(_TASK, return_exceptions=True)
+        _TASK = None
+    if _QUEUE:
+        logger.warning("send_retry: %s DM non inviati allo shutdown", len(_QUEUE))
+
+
+metrics.register_gauge("send_retry", lambda: {"queued": len(_QUEUE)})
@@ -0,0 +1,257 @@
+# app/services/sessions.py
+# ------------------------------------------------------------
+# Memoria conversazionale in RAM con limiti rigidi:
+# - TTL di inattività (SESSION_TTL_SEC)
+# - tetto sul numero di thread (SESSION_MAX_ENTRIES) e sui byte (SESSION_MAX_BYTES)
+#   con eviction LRU
+# - sweeper periodico che rimuove sessioni scadute e flag "umano attivo" scaduti
+# Così la memoria resta piatta anche su istanze che girano per settimane.
+# ------------------------------------------------------------
+import os
+import sys
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from itertools import islice
+from time import time
+from typing import Deque, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from app.services import metrics
+
+logger = logging.getLogger("sessions")
+
+SESSION_TTL_SEC     = int(os.getenv("SESSION_TTL_SEC", "3600"))  # reset dopo 1h inattività
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "20000"))
+SESSION_MAX_BYTES   = int(os.getenv("SESSION_MAX_BYTES", str(64 * 1024 * 1024)))
+# tetto "di sicurezza": il taglio vero lo fa il budget di token (services/tokens)
+SESSION_MAX_TURNS   = int(os.getenv("SESSION_MAX_TURNS", "30"))
+SWEEP_SEC           = float(os.getenv("SESSION_SWEEP_SEC", "60"))
+
+# Ruoli come costanti interned: ogni turno punta alla stessa stringa
+USER      = sys.intern("user")
+ASSISTANT = sys.intern("assistant")
+_ROLES    = {USER: USER, ASSISTANT: ASSISTANT}
+
+# Chiave thread = tupla (ig_user_id, user_id), niente f-string ricostruite a ogni accesso
+ThreadKey = Tuple[str, str]
+# Turno = tupla (ruolo, testo): nessun dict per messaggio
+Turn = Tuple[str, str]
+
+_TURN_OVERHEAD = 64  # tupla (ruolo, testo) + slot nel deque, circa
+
+
+def _turn_bytes(content: str) -> int:
+    return sys.getsizeof(content) + _TURN_OVERHEAD
+
+
+class _Thread:
+    __slots__ = ("turns", "last_at", "nbytes", "summary")
+
+    def __init__(self, cap: int, now: float):
+        self.turns: Deque[Turn] = deque(maxlen=cap)  # ring a capacità fissa
+        self.last_at = now
+        self.nbytes = 0
+        self.summary = ""  # riassunto dei turni più vecchi (services/summarizer)
+
+
+def to_messages(turns: Iterable[Turn], last: Optional[int] = None) -> List[Dict[str, str]]:
+    """Turni compatti -> lista messaggi OpenAI ({"role","content"}), ultimi `last`."""
+    items = list(turns)
+    if last is not None:
+        items = items[-last:]
+    return [{"role": role, "content": content} for role, content in items]
+
+
+class SessionStore:
+    """Thread -> ring di turni (ruolo, testo), ordinati per ultimo uso (LRU)."""
+
+    def __init__(self, ttl: int = SESSION_TTL_SEC, max_entries: int = SESSION_MAX_ENTRIES,
+                 max_bytes: int = SESSION_MAX_BYTES, max_turns: int = SESSION_MAX_TURNS):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_turns = max_turns
+        self._data: "OrderedDict[ThreadKey, _Thread]" = OrderedDict()
+        self.total_bytes = 0
+        self.evicted_lru = 0
+        self.expired = 0
+
+    def _thread(self, key: ThreadKey) -> _Thread:
+        now = time()
+        t = self._data.get(key)
+        if t is not None and t.last_at + self.ttl < now:
+            self._drop(key)
+            self.expired += 1
+            t = None
+        if t is None:
+            t = self._data[key] = _Thread(self.max_turns, now)
+            self._enforce(keep=key)
+        else:
+            t.last_at = now
+            self._data.move_to_end(key)
+        return t
+
+    def get(self, key: ThreadKey) -> Deque[Turn]:
+        return self._thread(key).turns
+
+    def peek(self, key: ThreadKey) -> Optional[Deque[Turn]]:
+        """Come get() ma senza creare il thread: None se assente o scaduto."""
+        t = self._data.get(key)
+        if t is None:
+            return None
+        if t.last_at + self.ttl < time():
+            self._drop(key)
+            self.expired += 1
+            return None
+        return t.turns
+
+    def load(self, key: ThreadKey, turns: Iterable[Turn]) -> None:
+        """Inizializza un thread con turni già esistenti (es. riletti da message_logs)."""
+        self._drop(key)
+        for role, content in turns:
+            self.add(key, role, content)
+
+    def add(self, key: ThreadKey, role: str, content: str) -> None:
+        t = self._thread(key)
+        turns = t.turns
+        added = _turn_bytes(content)
+        if len(turns) == turns.maxlen:
+            added -= _turn_bytes(turns[0][1])  # il più vecchio esce dal ring
+        turns.append((_ROLES.get(role) or sys.intern(role), content))
+        t.nbytes += added
+        self.total_bytes += added
+        self._enforce(keep=key)
+
+    def summary(self, key: ThreadKey) -> str:
+        t = self._data.get(key)
+        return t.summary if t is not None else ""
+
+    def fold(self, key: ThreadKey, summary: str, folded: Sequence[Turn]) -> bool:
+        """Sostituisce i turni più vecchi `folded` con `summary`.
+        False (nessuna modifica) se nel frattempo la testa della history è cambiata."""
+        t = self._data.get(key)
+        n = len(folded)
+        if t is None or list(islice(t.turns, n)) != list(folded):
+            return False
+        freed = 0
+        for _ in range(n):
+            freed += _turn_bytes(t.turns.popleft()[1])
+        delta = sys.getsizeof(summary) - (sys.getsizeof(t.summary) if t.summary else 0) - freed
+        t.summary = summary
+        t.nbytes += delta
+        self.total_bytes += delta
+        return True
+
+    def clear(self, key: ThreadKey) -> None:
+        self._drop(key)
+
+    def _drop(self, key: ThreadKey) -> None:
+        t = self._data.pop(key, None)
+        if t is not None:
+            self.total_bytes -= t.nbytes
+
+    def _enforce(self, keep: Optional[ThreadKey] = None) -> None:
+        # eviction LRU: i thread usati meno di recente escono per primi
+        while self._data and (len(self._data) > self.max_entries or self.total_bytes > self.max_bytes):
+            oldest = next(iter(self._data))
+            if oldest == keep:
+                if len(self._data) == 1:
+                    break
+                self._data.move_to_end(oldest)
+                continue
+            self._drop(oldest)
+            self.evicted_lru += 1
+
+    def sweep(self) -> int:
+        """Rimuove le sessioni scadute; ritorna quante."""
+        cutoff = time() - self.ttl
+        # l'OrderedDict è in ordine di uso: le scadute sono in testa
+        n = 0
+        for key, t in list(self._data.items()):
+            if t.last_at >= cutoff:
+                break
+            self._drop(key)
+            n += 1
+        self.expired += n
+        return n
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._data),
+            "bytes": self.total_bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "evicted_lru": self.evicted_lru,
+            "expired": self.expired,
+        }
+
+
+class HandoverFlags:
+    """Thread -> scadenza della pausa AI (umano attivo), con sweep delle scadute."""
+
+    def __init__(self):
+        self._until: Dict[ThreadKey, float] = {}
+        self.expired = 0
+
+    def active(self, key: ThreadKey) -> bool:
+        until = self._until.get(key)
+        if until is None:
+            return False
+        if until > time():
+            return True
+        self._until.pop(key, None)
+        self.expired += 1
+        return False
+
+    def mark(self, key: ThreadKey, ttl: int) -> None:
+        self._until[key] = time() + ttl
+
+    def clear(self, key: ThreadKey) -> None:
+        self._until.pop(key, None)
+
+    def sweep(self) -> int:
+        now = time()
+        dead = [k for k, until in self._until.items() if until <= now]
+        for k in dead:
+            self._until.pop(k, None)
+        self.expired += len(dead)
+        return len(dead)
+
+    def stats(self) -> dict:
+        return {"entries": len(self._until), "expired": self.expired}
+
+
+SESSIONS = SessionStore()
+HANDOVER = HandoverFlags()
+
+_TASK: Optional[asyncio.Task] = None
+
+
+async def _sweep_loop() -> None:
+    while True:
+        await asyncio.sleep(SWEEP_SEC)
+        try:
+            n_sess = SESSIONS.sweep()
+            n_hand = HANDOVER.sweep()
+            if n_sess or n_hand:
+                logger.info("sweep: %s sessioni, %s flag handover scaduti", n_sess, n_hand)
+        except Exception as e:
+            logger.warning("session sweep error: %s", e)
+
+
+def start_sweeper() -> None:
+    global _TASK
+    if _TASK is None:
+        _TASK = asyncio.create_task(_sweep_loop(), name="session-sweeper")
+
+
+async def stop_sweeper() -> None:
+    global _TASK
+    if _TASK is not None:
+        _TASK.cancel()
+        await asyncio.gather(_TASK, return_exceptions=True)
+        _TASK = None
+
+
+metrics.register_gauge("sessions", SESSIONS.stats)
+metrics.register_gauge("handover", HANDOVER.stats)
@@ -0,0 +1,453 @@
+# app/services/state.py
+# ------------------------------------------------------------
+# Backend dello stato conversazionale (history + pausa "umano attivo").
+# STATE_BACKEND:
+#   memory   -> stato nel processo (sessions.SESSIONS / sessions.HANDOVER);
+#               va bene con UN solo worker uvicorn
+#   postgres -> stato condiviso in mfai_app.conv_turns / conv_handover, con
+#               piccola cache locale in lettura (STATE_CACHE_SEC) così più
+#               worker/istanze vedono la stessa history e le stesse pause
+# In caso di errore DB il backend postgres ripiega sullo stato in memoria.
+# Scadenza come in memoria: un thread intero scade dopo SESSION_TTL_SEC di
+# inattività (dall'ultimo turno), non turno per turno.
+# ------------------------------------------------------------
+import os
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from time import time
+from typing import Any, Optional, Sequence
+
+from sqlalchemy import text
+
+from app.db import engine
+from app.services import metrics, sessions
+from app.services.sessions import ThreadKey, Turn
+
+logger = logging.getLogger("state")
+
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+CACHE_SEC     = float(os.getenv("STATE_CACHE_SEC", "2"))
+CACHE_MAX     = int(os.getenv("STATE_CACHE_MAX", "5000"))
+
+
+class StateBackend(ABC):
+    """Interfaccia: tutte le operazioni per thread (ig_user_id, user_id)."""
+
+    name = "base"
+
+    @abstractmethod
+    async def history(self, key: ThreadKey) -> Sequence[Turn]:
+        ...
+
+    @abstractmethod
+    async def append(self, key: ThreadKey, role: str, content: str) -> None:
+        ...
+
+    @abstractmethod
+    async def clear(self, key: ThreadKey) -> None:
+        ...
+
+    async def is_cold(self, key: ThreadKey) -> bool:
+        """True se per il thread non c'è history (es. dopo un riavvio)."""
+        return not await self.history(key)
+
+    async def seed(self, key: ThreadKey, turns: Sequence[Turn]) -> None:
+        """Carica turni esistenti in un thread freddo."""
+        for role, content in turns:
+            await self.append(key, role, content)
+
+    @abstractmethod
+    async def summary(self, key: ThreadKey) -> str:
+        """Riassunto dei turni già "piegati" (stringa vuota se nessuno)."""
+
+    @abstractmethod
+    async def fold(self, key: ThreadKey, summary: str, folded: Sequence[Turn]) -> None:
+        """Sostituisce i turni più vecchi `folded` con il nuovo riassunto."""
+
+    @abstractmethod
+    async def human_active(self, key: ThreadKey) -> bool:
+        ...
+
+    @abstractmethod
+    async def mark_human(self, key: ThreadKey, ttl: int) -> None:
+        ...
+
+    @abstractmethod
+    async def clear_human(self, key: ThreadKey) -> None:
+        ...
+
+    def start(self) -> None:
+        sessions.start_sweeper()
+
+    async def stop(self) -> None:
+        await sessions.stop_sweeper()
+
+    def stats(self) -> dict:
+        return {"backend": self.name}
+
+
+class MemoryBackend(StateBackend):
+    name = "memory"
+
+    async def history(self, key: ThreadKey) -> Sequence[Turn]:
+        return sessions.SESSIONS.get(key)
+
+    async def append(self, key: ThreadKey, role: str, content: str) -> None:
+        sessions.SESSIONS.add(key, role, content)
+
+    async def clear(self, key: ThreadKey) -> None:
+        sessions.SESSIONS.clear(key)
+
+    async def is_cold(self, key: ThreadKey) -> bool:
+        return sessions.SESSIONS.peek(key) is None
+
+    async def seed(self, key: ThreadKey, turns: Sequence[Turn]) -> None:
+        sessions.SESSIONS.load(key, turns)
+
+    async def summary(self, key: ThreadKey) -> str:
+        return sessions.SESSIONS.summary(key)
+
+    async def fold(self, key: ThreadKey, summary: str, folded: Sequence[Turn]) -> None:
+        if not sessions.SESSIONS.fold(key, summary, folded):
+            metrics.incr("state.fold_conflict")
+
+    async def human_active(self, key: ThreadKey) -> bool:
+        return sessions.HANDOVER.active(key)
+
+    async def mark_human(self, key: ThreadKey, ttl: int) -> None:
+        sessions.HANDOVER.mark(key, ttl)
+
+    async def clear_human(self, key: ThreadKey) -> None:
+        sessions.HANDOVER.clear(key)
+
+
+# thread attivo = ultimo turno (indice idx_conv_turns_thread) più recente del TTL
+_ACTIVE = """
+    (SELECT l.created_at FROM mfai_app.conv_turns l
+     WHERE l.ig_user_id = :ig AND l.user_id = :u
+     ORDER BY l.id DESC LIMIT 1) > now() - make_interval(secs => :ttl)
+"""
+
+_HISTORY_SQL = text(f"""
+    SELECT role, content
+    FROM mfai_app.conv_turns
+    WHERE ig_user_id = :ig AND user_id = :u
+      AND {_ACTIVE}
+    ORDER BY id DESC
+    LIMIT :n
+""")
+
+# thread scaduto che riceve un nuovo turno: si riparte da zero (come in memoria)
+_EXPIRE_SQL = [
+    text(f"""
+        DELETE FROM mfai_app.conv_summaries
+        WHERE ig_user_id = :ig AND user_id = :u AND NOT COALESCE({_ACTIVE}, FALSE)
+    """),
+    text(f"""
+        DELETE FROM mfai_app.conv_turns
+        WHERE ig_user_id = :ig AND user_id = :u AND NOT COALESCE({_ACTIVE}, FALSE)
+    """),
+]
+
+_APPEND_SQL = text("""
+    INSERT INTO mfai_app.conv_turns (ig_user_id, user_id, role, content)
+    VALUES (:ig, :u, :role, :content)
+""")
+
+# come il deque a capienza fissa in memoria: restano solo gli ultimi :n turni
+_TRIM_SQL = text("""
+    DELETE FROM mfai_app.conv_turns
+    WHERE ig_user_id = :ig AND user_id = :u
+      AND id < (
+        SELECT min(w.id) FROM (
+            SELECT id FROM mfai_app.conv_turns
+            WHERE ig_user_id = :ig AND user_id = :u
+            ORDER BY id DESC
+            LIMIT :n
+        ) w
+      )
+""")
+
+_SEED_SQL = text("""
+    INSERT INTO mfai_app.conv_turns (ig_user_id, user_id, role, content)
+    SELECT :ig, :u, r, c FROM unnest(CAST(:roles AS text[]), CAST(:contents AS text[])) AS t(r, c)
+""")
+
+_SUMMARY_SQL = text(f"""
+    SELECT summary FROM mfai_app.conv_summaries
+    WHERE ig_user_id = :ig AND user_id = :u
+      AND {_ACTIVE}
+""")
+
+# fold: si bloccano i turni visibili (gli stessi di history()), si confronta la
+# testa con i turni riassunti e si cancellano esattamente quegli id
+_FOLD_WINDOW_SQL = text("""
+    SELECT id, role, content
+    FROM mfai_app.conv_turns
+    WHERE ig_user_id = :ig AND user_id = :u
+    ORDER BY id DESC
+    LIMIT :n
+    FOR UPDATE
+""")
+
+_FOLD_SQL = [
+    text("""
+        INSERT INTO mfai_app.conv_summaries (ig_user_id, user_id, summary, updated_at)
+        VALUES (:ig, :u, :summary, now())
+        ON CONFLICT (ig_user_id, user_id) DO UPDATE
+          SET summary = EXCLUDED.summary, updated_at = now()
+    """),
+    text("DELETE FROM mfai_app.conv_turns WHERE id = ANY(CAST(:ids AS bigint[]))"),
+]
+
+_CLEAR_SQL = text("DELETE FROM mfai_app.conv_turns WHERE ig_user_id = :ig AND user_id = :u")
+
+_HUMAN_SQL = text("""
+    SELECT EXTRACT(EPOCH FROM human_until) AS until
+    FROM mfai_app.conv_handover
+    WHERE ig_user_id = :ig AND user_id = :u
+""")
+
+_MARK_SQL = text("""
+    INSERT INTO mfai_app.conv_handover (ig_user_id, user_id, human_until)
+    VALUES (:ig, :u, now() + make_interval(secs => :ttl))
+    ON CONFLICT (ig_user_id, user_id) DO UPDATE SET human_until = EXCLUDED.human_until
+""")
+
+_UNMARK_SQL = text("DELETE FROM mfai_app.conv_handover WHERE ig_user_id = :ig AND user_id = :u")
+
+# thread inattivi (nessun turno negli ultimi :ttl secondi), per intero
+_PURGE_SQL = [
+    text("""
+        DELETE FROM mfai_app.conv_summaries s
+        WHERE s.updated_at < now() - make_interval(secs => :ttl)
+          AND NOT EXISTS (
+            SELECT 1 FROM mfai_app.conv_turns l
+            WHERE l.ig_user_id = s.ig_user_id AND l.user_id = s.user_id
+              AND l.created_at >= now() - make_interval(secs => :ttl)
+          )
+    """),
+    text("""
+        DELETE FROM mfai_app.conv_turns t
+        WHERE t.created_at < now() - make_interval(secs => :ttl)
+          AND NOT EXISTS (
+            SELECT 1 FROM mfai_app.conv_turns l
+            WHERE l.ig_user_id = t.ig_user_id AND l.user_id = t.user_id
+              AND l.created_at >= now() - make_interval(secs => :ttl)
+          )
+    """),
+    text("DELETE FROM mfai_app.conv_handover WHERE human_until < now()"),
+]
+
+
+class _ReadCache:
+    """Cache LRU piccola con scadenza breve: key -> (caricato_at, valore)."""
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: "OrderedDict[ThreadKey, tuple]" = OrderedDict()
+
+    def get(self, key: ThreadKey) -> Optional[Any]:
+        hit = self._data.get(key)
+        if hit is None or hit[0] + self.ttl < time():
+            return None
+        return hit[1]
+
+    def put(self, key: ThreadKey, value: Any) -> None:
+        self._data[key] = (time(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: ThreadKey) -> None:
+        self._data.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+def _p(key: ThreadKey, **kw) -> dict:
+    return {"ig": key[0], "u": key[1], **kw}
+
+
+class PostgresBackend(StateBackend):
+    """Stato condiviso su Postgres; scrive anche in memoria come ripiego."""
+
+    name = "postgres"
+
+    def __init__(self):
+        self._hist = _ReadCache(CACHE_SEC, CACHE_MAX)
+        self._human = _ReadCache(CACHE_SEC, CACHE_MAX)
+        self._summary = _ReadCache(CACHE_SEC, CACHE_MAX)
+        self._task: Optional[asyncio.Task] = None
+
+    async def history(self, key: ThreadKey) -> Sequence[Turn]:
+        cached = self._hist.get(key)
+        if cached is not None:
+            metrics.incr("state.cache.hit")
+            return cached
+        metrics.incr("state.cache.miss")
+        try:
+            async with engine.connect() as conn:
+                rows = (await conn.execute(_HISTORY_SQL, _p(
+                    key, ttl=float(sessions.SESSION_TTL_SEC), n=sessions.SESSION_MAX_TURNS,
+                ))).all()
+        except Exception as e:
+            metrics.incr("state.db_error")
+            logger.warning("state history read failed: %s", e)
+            return sessions.SESSIONS.get(key)
+        turns = [(r[0], r[1]) for r in reversed(rows)]
+        self._hist.put(key, turns)
+        return turns
+
+    async def append(self, key: ThreadKey, role: str, content: str) -> None:
+        sessions.SESSIONS.add(key, role, content)
+        cached = self._hist.get(key)
+        if cached is not None:
+            self._hist.put(key, (cached + [(role, content)])[-sessions.SESSION_MAX_TURNS:])
+        try:
+            async with engine.begin() as conn:
+                for stmt in _EXPIRE_SQL:
+                    await conn.execute(stmt, _p(key, ttl=float(sessions.SESSION_TTL_SEC)))
+                await conn.execute(_APPEND_SQL, _p(key, role=role, content=content))
+                await conn.execute(_TRIM_SQL, _p(key, n=sessions.SESSION_MAX_TURNS))
+        except Exception as e:
+            metrics.incr("state.db_error")
+            logger.warning("state append failed: %s", e)
+
+    async def seed(self, key: ThreadKey, turns: Sequence[Turn]) -> None:
+        turns = list(turns)[-sessions.SESSION_MAX_TURNS:]
+        sessions.SESSIONS.load(key, turns)
+        self._hist.put(key, turns)
+        try:
+            async with engine.begin() as conn:
+                for stmt in _EXPIRE_SQL:
+                    await conn.execute(stmt, _p(key, ttl=float(sessions.SESSION_TTL_SEC)))
+                await conn.execute(_SEED_SQL, _p(
+                    key, roles=[t[0] for t in turns], contents=[t[1] for t in turns],
+                ))
+                await conn.execute(_TRIM_SQL, _p(key, n=sessions.SESSION_MAX_TURNS))
+        except Exception as e:
+            metrics.incr("state.db_error")
+            logger.warning("state seed failed: %s", e)
+
+    async def summary(self, key: ThreadKey) -> str:
+        cached = self._summary.get(key)
+        if cached is not None:
+            return cached
+        try:
+            async with engine.connect() as conn:
+                val = (await conn.execute(_SUMMARY_SQL, _p(key, ttl=float(sessions.SESSION_TTL_SEC)))).scalar()
+        except Exception as e:
+            metrics.incr("state.db_error")
+            logger.warning("state summary read failed: %s", e)
+            return sessions.SESSIONS.summary(key)
+        val = val or ""
+        self._summary.put(key, val)
+        return val
+
+    async def fold(self, key: ThreadKey, summary: str, folded: Sequence[Turn]) -> None:
+        sessions.SESSIONS.fold(key, summary, folded)
+        self._hist.pop(key)
+        try:
+            async with engine.begin() as conn:
+                rows = (await conn.execute(_FOLD_WINDOW_SQL, _p(key, n=sessions.SESSION_MAX_TURNS))).all()
+                head = list(reversed(rows))[:len(folded)]
+                if [(r[1], r[2]) for r in head] != list(folded):
+                    # testa cambiata nel frattempo (altro fold, clear, scadenza): niente modifiche
+                    metrics.incr("state.fold_conflict")
+                    return
+                params = _p(key, summary=summary, ids=[r[0] for r in head])
+                for stmt in _FOLD_SQL:
+                    await conn.execute(stmt, params)
+        except Exception as e:
+            metrics.incr("state.db_error")
+            logger.warning("state fold failed: %s", e)
+            return
+        self._summary.put(key, summary)
+
+    async def clear(self, key: ThreadKey) -> None:
+        sessions.SESSIONS.clear(key)
+        self._hist.pop(key)
+        self._summary.pop(key)
+        try:
+            async with engine.begin() as conn:
+                await conn.execute(_CLEAR_SQL, _p(key))
+        except Exception as e:
+            metrics.incr("state.db_error")
+            logger.warning("state clear failed: %s", e)
+
+    async def human_active(self, key: ThreadKey) -> bool:
+        until = self._human.get(key)
+        if until is None:
+            try:
+                async with engine.connect() as conn:
+                    until = (await conn.execute(_HUMAN_SQL, _p(key))).scalar()
+            except Exception as e:
+                metrics.incr("state.db_error")
+                logger.warning("state handover read failed: %s", e)
+                return sessions.HANDOVER.active(key)
+            until = float(until or 0)
+            self._human.put(key, until)
+        return until > time()
+
+    async def mark_human(self, key: ThreadKey, ttl: int) -> None:
+        sessions.HANDOVER.mark(key, ttl)
+        self._human.put(key, time() + ttl)
+        try:
+            async with engine.begin() as conn:
+                await conn.execute(_MARK_SQL, _p(key, ttl=float(ttl)))
+        except Exception as e:
+            metrics.incr("state.db_error")
+            logger.warning("state handover mark failed: %s", e)
+
+    async def clear_human(self, key: ThreadKey) -> None:
+        sessions.HANDOVER.clear(key)
+        self._human.put(key, 0.0)
+        try:
+            async with engine.begin() as conn:
+                await conn.execute(_UNMARK_SQL, _p(key))
+        except Exception as e:
+            metrics.incr("state.db_error")
+            logger.warning("state handover clear failed: %s", e)
+
+    async def _purge_loop(self) -> None:
+        while True:
+            await asyncio.sleep(sessions.SWEEP_SEC)
+            try:
+                async with engine.begin() as conn:
+                    for stmt in _PURGE_SQL:
+                        await conn.execute(stmt, {"ttl": float(sessions.SESSION_TTL_SEC)})
+            except Exception as e:
+                logger.warning("state purge error: %s", e)
+
+    def start(self) -> None:
+        super().start()
+        if self._task is None:
+            self._task = asyncio.create_task(self._purge_loop(), name="state-purge")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await super().stop()
+
+    def stats(self) -> dict:
+        return {"backend": self.name, "cache_history": len(self._hist), "cache_handover": len(self._human)}
+
+
+def _make(name: str) -> StateBackend:
+    if name in ("postgres", "pg", "db"):
+        return PostgresBackend()
+    if name != "memory":
+        logger.warning("STATE_BACKEND=%s sconosciuto, uso memory", name)
+    return MemoryBackend()
+
+
+BACKEND: StateBackend = _make(STATE_BACKEND)
+
+metrics.register_gauge("state", BACKEND.stats)
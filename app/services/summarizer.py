@@ -0,0 +1,116 @@
+# app/services/summarizer.py
+# ------------------------------------------------------------
+# Riassunto progressivo dei thread lunghi, FUORI dal percorso di risposta.
+# Dopo ogni risposta maybe_schedule() controlla il thread: se supera
+# SUMMARY_TRIGGER_TURNS turni o SUMMARY_TRIGGER_TOKENS token stimati, un task
+# in background piega i turni più vecchi (tutti tranne gli ultimi
+# SUMMARY_KEEP_TURNS) nel riassunto salvato con la sessione.
+# La richiesta live manda poi: system + riassunto + turni recenti.
+# ------------------------------------------------------------
+import os
+import asyncio
+import logging
+from typing import Optional, Sequence, Set
+
+from app.services import http, metrics, state, tokens
+from app.services.sessions import ThreadKey, Turn
+
+logger = logging.getLogger("summarizer")
+
+OPENAI_API_KEY   = os.getenv("OPENAI_API_KEY")
+SUMMARY_MODEL    = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+TRIGGER_TURNS    = int(os.getenv("SUMMARY_TRIGGER_TURNS", "16"))
+TRIGGER_TOKENS   = int(os.getenv("SUMMARY_TRIGGER_TOKENS", "1200"))
+KEEP_TURNS       = int(os.getenv("SUMMARY_KEEP_TURNS", "6"))
+MAX_SUMMARY_TOK  = int(os.getenv("SUMMARY_MAX_TOKENS", "250"))
+CONCURRENCY      = int(os.getenv("SUMMARY_CONCURRENCY", "2"))
+
+_INFLIGHT: Set[ThreadKey] = set()
+_SEM: Optional[asyncio.Semaphore] = None
+
+_INSTRUCTIONS = (
+    "Riassumi la conversazione tra un cliente e l'assistente di un'attività su Instagram. "
+    "Tieni SOLO i fatti utili per continuare: richieste del cliente, dati forniti (nome, città, "
+    "date, preferenze), domande già fatte e risposte già date, impegni presi. "
+    "Massimo 8 punti brevi, in italiano, niente saluti."
+)
+
+
+def _sem() -> asyncio.Semaphore:
+    global _SEM
+    if _SEM is None:
+        _SEM = asyncio.Semaphore(CONCURRENCY)
+    return _SEM
+
+
+def needs_summary(turns: Sequence[Turn]) -> bool:
+    if len(turns) <= KEEP_TURNS:
+        return False
+    if len(turns) >= TRIGGER_TURNS:
+        return True
+    return sum(tokens.message_tokens(c) for _, c in turns) >= TRIGGER_TOKENS
+
+
+def format_for_prompt(summary: str) -> str:
+    """Blocco da accodare al system prompt della richiesta live."""
+    return f"\n\nRiassunto della conversazione precedente:\n{summary}" if summary else ""
+
+
+async def maybe_schedule(key: ThreadKey) -> bool:
+    """Avvia il riassunto in background se il thread ha superato la soglia. Non blocca."""
+    if not OPENAI_API_KEY or key in _INFLIGHT:
+        return False
+    turns = await state.BACKEND.history(key)
+    if not needs_summary(turns):
+        return False
+    _INFLIGHT.add(key)
+    asyncio.create_task(_run(key), name=f"summarize:{key[0]}:{key[1]}")
+    return True
+
+
+async def _summarize(previous: str, folded: Sequence[Turn]) -> str:
+    lines = []
+    if previous:
+        lines.append(f"Riassunto precedente:\n{previous}\n")
+    lines.append("Nuovi messaggi:")
+    for role, content in folded:
+        lines.append(f"{'Cliente' if role == 'user' else 'Assistente'}: {content}")
+    payload = {
+        "model": SUMMARY_MODEL,
+        "messages": [
+            {"role": "system", "content": _INSTRUCTIONS},
+            {"role": "user", "content": "\n".join(lines)},
+        ],
+        "temperature": 0.2,
+        "max_tokens": MAX_SUMMARY_TOK,
+    }
+    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"}
+    r = await http.client("openai").post("https://api.openai.com/v1/chat/completions",
+                                         headers=headers, json=payload)
+    r.raise_for_status()
+    return (r.json()["choices"][0]["message"]["content"] or "").strip()
+
+
+async def _run(key: ThreadKey) -> None:
+    try:
+        async with _sem():
+            turns = list(await state.BACKEND.history(key))
+            if not needs_summary(turns):
+                return
+            folded = turns[:-KEEP_TURNS]
+            previous = await state.BACKEND.summary(key)
+            summary = await _summarize(previous, folded)
+            if not summary:
+                return
+            await state.BACKEND.fold(key, summary, folded)
+            metrics.incr("summarizer.folded_turns", len(folded))
+            metrics.observe("summarizer.summary_tokens", tokens.estimate(summary))
+            logger.info("thread %s:%s: %s turni piegati nel riassunto", key[0], key[1], len(folded))
+    except Exception as e:
+        metrics.incr("summarizer.failed")
+        logger.warning("summarize %s:%s failed: %s", key[0], key[1], e)
+    finally:
+        _INFLIGHT.discard(key)
+
+
+metrics.register_gauge("summarizer.inflight", lambda: len(_INFLIGHT))
@@ -0,0 +1,168 @@
+# app/services/tenant_registry.py
+# ------------------------------------------------------------
+# Registry in memoria dei tenant (account IG -> AccountContext):
+# - snapshot completo all'avvio (instagram_accounts + tokens + client_prompts)
+# - lookup O(1) per ig_user_id, con voci negative per pagine sconosciute
+# - invalidazione immediata: i trigger sulle tabelle fanno NOTIFY su
+#   'mfai_tenant' e ogni istanza resta in LISTEN; le scritture admin
+#   chiamano anche invalidate() localmente
+# - reload completo periodico come rete di sicurezza (NOTIFY persi), in un
+#   task suo: gira anche quando la connessione LISTEN non si apre o cade
+# ------------------------------------------------------------
+import os
+import asyncio
+import logging
+from time import time
+from typing import Dict, Optional
+
+from app.db import engine
+from app.services import metrics
+from app.services.account_context import AccountContext, load_all_accounts, resolve_account
+
+logger = logging.getLogger("tenant_registry")
+
+CHANNEL      = "mfai_tenant"
+REFRESH_SEC  = float(os.getenv("TENANT_REGISTRY_REFRESH_SEC", "600"))
+NEG_TTL_SEC  = float(os.getenv("TENANT_REGISTRY_NEG_TTL_SEC", "300"))
+
+# ig_user_id -> (contesto, caricato_at); known=False = voce negativa
+_ENTRIES: Dict[str, tuple] = {}
+_LOADED_AT = 0.0
+_TASK: Optional[asyncio.Task] = None
+_RELOAD_TASK: Optional[asyncio.Task] = None
+# generazioni: invalidate() le incrementa, così un caricamento iniziato prima
+# di un'invalidazione non rimette in cache il contesto vecchio
+_GEN: Dict[str, int] = {}
+_GEN_ALL = 0
+
+
+def _gen(ig_user_id: str) -> tuple:
+    return _GEN_ALL, _GEN.get(ig_user_id, 0)
+
+
+async def get(ig_user_id: str) -> AccountContext:
+    hit = _ENTRIES.get(ig_user_id)
+    now = time()
+    if hit is not None:
+        ctx, at = hit
+        if ctx.known or (now - at) < NEG_TTL_SEC:
+            metrics.incr("tenant_registry.hit")
+            return ctx
+    metrics.incr("tenant_registry.miss")
+    gen = _gen(ig_user_id)
+    ctx = await resolve_account(ig_user_id)
+    if _gen(ig_user_id) == gen:  # invalidato durante il caricamento: non si salva
+        _ENTRIES[ig_user_id] = (ctx, now)
+    return ctx
+
+
+def invalidate(ig_user_id: Optional[str] = None,
+               ig_account_id: Optional[int] = None,
+               client_id: Optional[int] = None) -> None:
+    """Rimuove le voci interessate (nessun argomento = tutto)."""
+    global _GEN_ALL
+    if ig_user_id is None and ig_account_id is None and client_id is None:
+        _GEN_ALL += 1
+        _ENTRIES.clear()
+        return
+    if ig_user_id is not None:
+        ig_user_id = str(ig_user_id)
+        _GEN[ig_user_id] = _GEN.get(ig_user_id, 0) + 1
+        _ENTRIES.pop(ig_user_id, None)
+    if ig_account_id is not None or client_id is not None:
+        # il caricamento in corso non sa ancora account/cliente: si invalida tutto ciò che è in volo
+        _GEN_ALL += 1
+        for ig, (ctx, _) in list(_ENTRIES.items()):
+            if (ig_account_id is not None and ctx.ig_account_id == ig_account_id) or \
+               (client_id is not None and ctx.client_id == client_id):
+                _ENTRIES.pop(ig, None)
+    metrics.incr("tenant_registry.invalidated")
+
+
+async def reload() -> None:
+    global _LOADED_AT
+    gen_all, gens = _GEN_ALL, dict(_GEN)
+    snapshot = await load_all_accounts()
+    now = time()
+    _ENTRIES.clear()
+    if _GEN_ALL == gen_all:  # altrimenti snapshot forse vecchio: si ricarica on-demand
+        _ENTRIES.update({ig: (ctx, now) for ig, ctx in snapshot.items()
+                         if _GEN.get(ig, 0) == gens.get(ig, 0)})
+    _LOADED_AT = now
+    logger.info("tenant registry loaded: %s accounts", len(snapshot))
+
+
+def _on_notify(_conn, _pid, _channel, payload: str) -> None:
+    # payload: "ig:<ig_user_id>" | "acct:<id>" | "client:<id>" | "*"
+    kind, _, val = (payload or "*").partition(":")
+    try:
+        if kind == "ig":
+            invalidate(ig_user_id=val)
+        elif kind == "acct":
+            invalidate(ig_account_id=int(val))
+        elif kind == "client":
+            invalidate(client_id=int(val))
+        else:
+            invalidate()
+    except ValueError:
+        invalidate()
+
+
+async def _reload_loop() -> None:
+    while True:
+        await asyncio.sleep(5)
+        if time() - _LOADED_AT <= REFRESH_SEC:
+            continue
+        try:
+            await reload()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("tenant registry reload error: %s", e)
+            await asyncio.sleep(30)
+
+
+async def _listen_loop() -> None:
+    import asyncpg  # driver già usato da SQLAlchemy (postgresql+asyncpg)
+
+    dsn = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(dsn)
+            await conn.add_listener(CHANNEL, _on_notify)
+            # (ri)connesso: eventuali NOTIFY persi nel frattempo -> reload completo
+            await reload()
+            while not conn.is_closed():
+                await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("tenant registry listener error: %s", e)
+            await asyncio.sleep(5)
+        finally:
+            if conn is not None and not conn.is_closed():
+                try:
+                    await conn.close()
+                except Exception:
+                    pass
+
+
+def start() -> None:
+    global _TASK, _RELOAD_TASK
+    if _TASK is None:
+        _TASK = asyncio.create_task(_listen_loop(), name="tenant-registry-listener")
+    if _RELOAD_TASK is None:
+        _RELOAD_TASK = asyncio.create_task(_reload_loop(), name="tenant-registry-reload")
+
+
+async def stop() -> None:
+    global _TASK, _RELOAD_TASK
+    tasks = [t for t in (_TASK, _RELOAD_TASK) if t is not None]
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _TASK = _RELOAD_TASK = None
+
+
+metrics.register_gauge("tenant_registry.entries", lambda: len(_ENTRIES))
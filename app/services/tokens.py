@@ -0,0 +1,54 @@
+# app/services/tokens.py
+# ------------------------------------------------------------
+# Stima locale dei token di un prompt + taglio della history a budget.
+# - se tiktoken è installato usa l'encoding vero (o200k_base, famiglia gpt-4o)
+# - altrimenti una stima veloce: parole corte = 1 token, parole lunghe ~4 char
+#   per token, punteggiatura/emoji = 1 token (scarto tipico ±10% su IT/EN)
+# ------------------------------------------------------------
+import os
+import re
+from typing import List, Sequence, Tuple
+
+try:  # opzionale: stima esatta
+    import tiktoken
+    _ENC = tiktoken.get_encoding("o200k_base")
+except Exception:  # pragma: no cover - dipende dall'ambiente
+    _ENC = None
+
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+MESSAGE_OVERHEAD = 4  # token di contorno per ogni messaggio chat (ruolo, separatori)
+
+_PIECES = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+
+def estimate(text: str) -> int:
+    """Token stimati per un testo."""
+    if not text:
+        return 0
+    if _ENC is not None:
+        return len(_ENC.encode(text))
+    n = 0
+    for piece in _PIECES.findall(text):
+        n += 1 if len(piece) <= 4 else (len(piece) + 3) // 4
+    return n
+
+
+def message_tokens(content: str) -> int:
+    return estimate(content) + MESSAGE_OVERHEAD
+
+
+def trim_to_budget(system: str, turns: Sequence[Tuple[str, str]],
+                   budget: int) -> Tuple[List[Tuple[str, str]], int]:
+    """Ultimi turni (ruolo, testo) che stanno nel budget insieme al system prompt.
+    Il turno più recente (il messaggio utente corrente) è sempre incluso.
+    Ritorna (turni tenuti, token stimati del prompt)."""
+    used = message_tokens(system)
+    kept: List[Tuple[str, str]] = []
+    for role, content in reversed(turns):
+        cost = message_tokens(content)
+        if kept and used + cost > budget:
+            break
+        kept.append((role, content))
+        used += cost
+    kept.reverse()
+    return kept, used
@@ -0,0 +1,165 @@
+# app/services/triggers.py
+# ------------------------------------------------------------
+# Risposte fisse per parola chiave, per cliente, SENZA chiamata LLM.
+# - coppie trigger/risposta in mfai_app.client_triggers (gestite dall'admin API)
+# - match "exact": il messaggio normalizzato è uguale al trigger
+#   match "keyword": il trigger compare nel messaggio come parole intere
+#   (solo messaggi brevi, TRIGGER_MAX_CHARS: le domande lunghe vanno all'LLM)
+# - tutte le keyword di un cliente in UN automa Aho-Corasick: un passaggio
+#   sul testo qualunque sia il numero di trigger; vince il trigger più lungo
+# - automa ricostruito solo quando i trigger cambiano (invalidate() locale +
+#   controllo di versione ogni TRIGGER_CHECK_SEC per le altre istanze)
+# ------------------------------------------------------------
+import os
+import logging
+from time import perf_counter
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+from sqlalchemy import text
+
+from app.db import engine
+from app.services import metrics
+from app.services.client_cache import VersionedCache
+from app.services.reply_cache import normalize
+
+logger = logging.getLogger("triggers")
+
+CHECK_SEC  = float(os.getenv("TRIGGER_CHECK_SEC", "60"))
+MAX_CHARS  = int(os.getenv("TRIGGER_MAX_CHARS", "160"))
+MODES      = ("exact", "keyword")
+
+
+class Trigger(NamedTuple):
+    id: int
+    pattern: str   # normalizzato
+    response: str
+    mode: str
+
+
+class Automaton:
+    """Aho-Corasick sulle keyword (delimitate da spazi) + dizionario per gli exact."""
+
+    __slots__ = ("version", "exact", "keywords", "goto", "fail", "out")
+
+    def __init__(self, version: str, triggers: Sequence[Trigger]):
+        self.version = version
+        self.exact: Dict[str, Trigger] = {}
+        self.keywords: List[Trigger] = []
+        for t in triggers:
+            if t.mode == "exact":
+                self.exact.setdefault(t.pattern, t)
+            else:
+                self.keywords.append(t)
+        # stato 0 = radice; out[s] = indici delle keyword che finiscono in s
+        self.goto: List[Dict[str, int]] = [{}]
+        self.out: List[List[int]] = [[]]
+        for i, t in enumerate(self.keywords):
+            s = 0
+            for ch in f" {t.pattern} ":  # spazi = confini di parola
+                nxt = self.goto[s].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[s][ch] = nxt
+                    self.goto.append({})
+                    self.out.append([])
+                s = nxt
+            self.out[s].append(i)
+        self.fail = [0] * len(self.goto)
+        queue = list(self.goto[0].values())  # profondità 1: fail = radice
+        for s in queue:  # BFS: la coda cresce mentre la si scorre
+            for ch, nxt in self.goto[s].items():
+                queue.append(nxt)
+                f = self.fail[s]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def __len__(self) -> int:
+        return len(self.exact) + len(self.keywords)
+
+    def match(self, norm: str) -> Optional[Trigger]:
+        hit = self.exact.get(norm)
+        if hit is not None or not self.keywords or len(norm) > MAX_CHARS:
+            return hit
+        best = -1
+        s = 0
+        goto, fail, out = self.goto, self.fail, self.out
+        for ch in f" {norm} ":
+            while s and ch not in goto[s]:
+                s = fail[s]
+            s = goto[s].get(ch, 0)
+            for i in out[s]:
+                if best < 0 or len(self.keywords[i].pattern) > len(self.keywords[best].pattern):
+                    best = i
+        return self.keywords[best] if best >= 0 else None
+
+
+# ---------------- registry per cliente ----------------
+
+_TRIGGERS_SQL = text("""
+    SELECT id, trigger, response, match_mode
+    FROM mfai_app.client_triggers
+    WHERE client_id = :c AND active
+    ORDER BY id
+""")
+
+
+async def _build(client_id: int, version: str) -> Automaton:
+    async with engine.connect() as conn:
+        rows = (await conn.execute(_TRIGGERS_SQL, {"c": client_id})).all()
+    items = [Trigger(int(r[0]), normalize(r[1] or ""), r[2] or "", r[3] if r[3] in MODES else "keyword")
+             for r in rows]
+    ac = Automaton(version, [t for t in items if t.pattern and t.response])
+    metrics.incr("triggers.rebuilds")
+    if len(ac):
+        logger.info("triggers client %s: %s exact, %s keyword (%s stati)",
+                    client_id, len(ac.exact), len(ac.keywords), len(ac.goto))
+    return ac
+
+
+_AUTOMATA: VersionedCache[Automaton] = VersionedCache("client_triggers", CHECK_SEC, _build)
+
+
+async def get_automaton(client_id: int) -> Automaton:
+    """Automa del cliente (vuoto se non ha trigger); ricostruito se la versione è cambiata."""
+    return await _AUTOMATA.get(client_id)
+
+
+def invalidate(client_id: int) -> None:
+    """Dopo una modifica dall'admin: il prossimo messaggio ricontrolla la versione."""
+    _AUTOMATA.invalidate(client_id)
+
+
+async def match(client_id: Optional[int], text_msg: str) -> Optional[Trigger]:
+    """Trigger che risponde al messaggio, None se va all'LLM. Errori DB = nessun match."""
+    if client_id is None or not text_msg:
+        return None
+    try:
+        ac = await get_automaton(client_id)
+    except Exception as e:
+        metrics.incr("triggers.failed")
+        logger.warning("triggers load failed (client %s): %s", client_id, e)
+        return None
+    if not len(ac):
+        return None
+    t0 = perf_counter()
+    hit = ac.match(normalize(text_msg))
+    metrics.observe("triggers.match_us", (perf_counter() - t0) * 1e6)
+    metrics.incr("triggers.checked")
+    if hit is not None:
+        metrics.incr("triggers.hit")
+        metrics.incr(f"triggers.hit.{hit.mode}")
+    return hit
+
+
+def _stats() -> dict:
+    checked = metrics.counter("triggers.checked")
+    return {
+        "clients": len(_AUTOMATA),
+        "triggers": sum(len(a) for _, a in _AUTOMATA.items()),
+        "hit_rate": round(metrics.counter("triggers.hit") / checked, 3) if checked else None,
+    }
+
+
+metrics.register_gauge("triggers", _stats)
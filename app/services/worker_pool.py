@@ -0,0 +1,154 @@
+# app/services/worker_pool.py
+# ------------------------------------------------------------
+# Pool di worker asyncio per il webhook Meta:
+# il receiver accoda gli eventi normalizzati e risponde subito 200,
+# i worker li processano (DB, OpenAI, Graph) fuori dalla richiesta HTTP.
+#
+# Esecuzione "sharded" per conversazione: ogni chiave (_skey) ha la sua
+# corsia FIFO e al massimo un worker alla volta la possiede, quindi dentro
+# un thread l'ordine è rigoroso mentre thread diversi vanno in parallelo
+# (fino a WEBHOOK_WORKERS).
+# ------------------------------------------------------------
+import os
+import asyncio
+import logging
+from time import monotonic
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional
+
+from app.services import metrics
+
+logger = logging.getLogger("worker_pool")
+
+WORKERS    = int(os.getenv("WEBHOOK_WORKERS", "8"))        # thread processati in parallelo
+QUEUE_MAX  = int(os.getenv("WEBHOOK_QUEUE_MAX", "1000"))    # eventi in attesa (tutte le corsie)
+
+Handler = Callable[[Any], Awaitable[None]]
+
+# _READY contiene le chiavi con lavoro da fare; una chiave è in _READY
+# oppure in mano a un worker, mai entrambe (così l'ordine è garantito).
+_READY: Optional[asyncio.Queue] = None
+_LANES: Dict[Hashable, Deque[Any]] = {}
+_PENDING = 0
+_MAXSIZE = QUEUE_MAX
+_TASKS: List[asyncio.Task] = []
+_HANDLER: Optional[Handler] = None
+_BUSY = 0
+_BUSY_SEC = 0.0
+_STARTED_AT = 0.0
+
+
+def start(handler: Handler, workers: int = WORKERS, maxsize: int = QUEUE_MAX) -> None:
+    """Avvia i worker (idempotente)."""
+    global _READY, _HANDLER, _STARTED_AT, _MAXSIZE
+    if _TASKS:
+        return
+    _HANDLER = handler
+    _READY = asyncio.Queue()
+    _MAXSIZE = maxsize
+    _STARTED_AT = monotonic()
+    for i in range(max(1, workers)):
+        _TASKS.append(asyncio.create_task(_worker(i), name=f"webhook-worker-{i}"))
+    logger.info("worker pool started: workers=%s queue_max=%s", len(_TASKS), maxsize)
+
+
+async def stop(drain_timeout: float = 10.0) -> None:
+    """Prova a svuotare le corsie, poi cancella i worker."""
+    global _READY, _PENDING
+    if not _TASKS:
+        return
+    if _READY is not None:
+        try:
+            await asyncio.wait_for(_READY.join(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("worker pool stop: %s eventi non processati", _PENDING)
+    for t in _TASKS:
+        t.cancel()
+    await asyncio.gather(*_TASKS, return_exceptions=True)
+    _TASKS.clear()
+    _LANES.clear()
+    _PENDING = 0
+    _READY = None
+
+
+def submit(key: Hashable, item: Any) -> bool:
+    """Accoda nella corsia `key` senza attendere.
+    False se le code sono piene (o il pool non è avviato)."""
+    global _PENDING
+    if _READY is None:
+        return False
+    if _PENDING >= _MAXSIZE:
+        metrics.incr("webhook.queue.rejected")
+        return False
+    lane = _LANES.get(key)
+    if lane is None:
+        # corsia nuova: la chiave diventa pronta per un worker
+        _LANES[key] = deque((item,))
+        _READY.put_nowait(key)
+    else:
+        # la chiave è già in _READY o in mano a un worker: basta accodare
+        lane.append(item)
+    _PENDING += 1
+    metrics.incr("webhook.queue.enqueued")
+    return True
+
+
+async def _worker(idx: int) -> None:
+    global _BUSY, _BUSY_SEC, _PENDING
+    assert _READY is not None
+    ready = _READY
+    while True:
+        key = await ready.get()
+        lane = _LANES[key]
+        item = lane.popleft()
+        _PENDING -= 1
+        _BUSY += 1
+        t0 = monotonic()
+        try:
+            await _HANDLER(item)
+            metrics.incr("webhook.queue.processed")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            metrics.incr("webhook.queue.failed")
+            logger.exception("worker %s: handler error (key=%s): %s", idx, key, e)
+        finally:
+            _BUSY -= 1
+            _BUSY_SEC += monotonic() - t0
+            # un evento alla volta per corsia, poi la chiave torna in fondo
+            # a _READY: un thread molto attivo non monopolizza un worker
+            if lane:
+                ready.put_nowait(key)
+            else:
+                _LANES.pop(key, None)
+            ready.task_done()
+
+
+def running() -> bool:
+    return _READY is not None
+
+
+def capacity() -> int:
+    """Quanti eventi conviene ancora prelevare (es. dalla coda su DB):
+    circa due per worker, così le altre istanze possono prendere il resto."""
+    if _READY is None:
+        return 0
+    return max(0, min(_MAXSIZE - _PENDING, len(_TASKS) * 2 - _PENDING - _BUSY))
+
+
+def stats() -> dict:
+    workers = len(_TASKS)
+    uptime = (monotonic() - _STARTED_AT) if _STARTED_AT else 0.0
+    return {
+        "workers": workers,
+        "busy": _BUSY,
+        "queue_depth": _PENDING,
+        "queue_max": _MAXSIZE,
+        "lanes": len(_LANES),
+        "max_lane_depth": max((len(l) for l in _LANES.values()), default=0),
+        "utilisation": round(_BUSY / workers, 3) if workers else 0.0,
+        "utilisation_avg": round(_BUSY_SEC / (uptime * workers), 3) if workers and uptime else 0.0,
+    }
+
+
+metrics.register_gauge("webhook.pool", stats)
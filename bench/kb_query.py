@@ -0,0 +1,56 @@
+# bench/kb_query.py
+# ------------------------------------------------------------
+# Latenza di ricerca della knowledge base (services/bm25) al crescere del corpus.
+# Corpus sintetico con vocabolario a distribuzione Zipf (come testo reale):
+# per ogni taglia tempo di build e p50/p95 di una query da 3-6 parole.
+# Uso:  python -m bench.kb_query [query per taglia] [--mmap]
+# ------------------------------------------------------------
+import sys
+import tempfile
+from time import perf_counter
+
+import numpy as np
+
+from app.services.bm25 import build_index
+
+SIZES   = (1_000, 10_000, 50_000, 200_000)  # chunk (titolo "doc N" incluso nei termini)
+QUERIES = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 500
+MMAP    = "--mmap" in sys.argv
+VOCAB   = 30_000
+WORDS   = 80  # parole per chunk (un paragrafo)
+
+
+def _corpus(n_chunks: int, rng: np.random.Generator):
+    words = np.array([f"parola{i}" for i in range(VOCAB)])
+    ids = np.minimum(rng.zipf(1.2, size=(n_chunks, WORDS)), VOCAB) - 1
+    # un documento ogni 10 chunk: il chunking a 120 parole lascia ~1 chunk per paragrafo
+    docs = []
+    for d in range(0, n_chunks, 10):
+        paras = [" ".join(words[row]) for row in ids[d:d + 10]]
+        docs.append((f"doc {d}", "\n\n".join(paras)))
+    return docs, words
+
+
+def main() -> None:
+    rng = np.random.default_rng(7)
+    print(f"queries={QUERIES} per taglia, mmap={MMAP}")
+    print(f"{'chunks':>8} {'terms':>7} {'build s':>8} {'p50 ms':>7} {'p95 ms':>7}")
+    for size in SIZES:
+        docs, words = _corpus(size, rng)
+        t0 = perf_counter()
+        with tempfile.TemporaryDirectory() as tmp:
+            idx = build_index("bench", docs, tmp if MMAP else None)
+            build = perf_counter() - t0
+            # parole a media frequenza (rango 10..5000): query realistiche, non solo stopword
+            qs = [" ".join(words[rng.integers(10, 5000, size=rng.integers(3, 7))]) for _ in range(QUERIES)]
+            lat = []
+            for q in qs:
+                t = perf_counter()
+                idx.search(q, 3)
+                lat.append((perf_counter() - t) * 1000.0)
+            p50, p95 = np.percentile(lat, [50, 95])
+            print(f"{len(idx):>8} {len(idx.vocab):>7} {build:>8.2f} {p50:>7.3f} {p95:>7.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# bench/session_memory.py
+# ------------------------------------------------------------
+# Byte per thread della memoria conversazionale:
+#   prima  = dict f"{ig}:{user}" -> lista di dict {"role","content"} (+ dict last_at)
+#   dopo   = sessions.SessionStore (chiavi tupla, ring di tuple, ruoli interned)
+# Uso:  python -m bench.session_memory [thread] [turni]
+# ------------------------------------------------------------
+import sys
+import tracemalloc
+from time import time
+
+from app.services.sessions import SessionStore
+
+THREADS = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+TURNS   = int(sys.argv[2]) if len(sys.argv) > 2 else 12
+IG_USER = "17841400000000000"
+
+
+def _texts():
+    # testi brevi tipici da DM; creati fuori dalla misura, condivisi dalle due varianti
+    return [f"messaggio {i} ciao quanto costa la seduta?" for i in range(TURNS)]
+
+
+def _legacy(texts):
+    sess, last_at = {}, {}
+    for u in range(THREADS):
+        uid = str(10**15 + u)
+        for i, t in enumerate(texts):
+            key = f"{IG_USER}:{uid}"
+            s = sess.setdefault(key, [])
+            s.append({"role": "user" if i % 2 == 0 else "assistant", "content": t})
+            if len(s) > 12:
+                del s[: len(s) - 12]
+            last_at[key] = time()
+    return sess, last_at
+
+
+def _compact(texts):
+    store = SessionStore(ttl=3600, max_entries=THREADS + 1, max_bytes=1 << 40)
+    for u in range(THREADS):
+        uid = str(10**15 + u)
+        for i, t in enumerate(texts):
+            store.add((IG_USER, uid), "user" if i % 2 == 0 else "assistant", t)
+    return store
+
+
+def _measure(fn, texts):
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    obj = fn(texts)
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    del obj
+    return used
+
+
+def main() -> None:
+    texts = _texts()
+    before = _measure(_legacy, texts)
+    after = _measure(_compact, texts)
+    print(f"threads={THREADS} turns={TURNS} (testi esclusi, condivisi)")
+    print(f"before: {before / THREADS:8.0f} B/thread  ({before / 1e6:.1f} MB)")
+    print(f"after:  {after / THREADS:8.0f} B/thread  ({after / 1e6:.1f} MB)")
+    print(f"saving: {100 * (1 - after / before):.0f}%")
+
+
+if __name__ == "__main__":
+    main()